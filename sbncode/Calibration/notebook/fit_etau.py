@@ -0,0 +1,14 @@
+import sys
+from lib.dataset import load_df
+from lib import lifetime
+
+def main(output, inputs):
+    etaus = lifetime.fit_lifetimes(load_df(inputs), nproc="auto")
+    lifetime.write_lifetimes(etaus, output)
+
+if __name__ == "__main__":
+    printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
+    if printhelp:
+        print("Usage: python fit_etau.py [etau_run_data.txt] [etau.df|etau.parquet]")
+    else:
+        main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,19 @@
+import sys
+from lib.dataset import load_df
+from lib import drifttime
+
+def main(output, inputs, method="peak"):
+    tcathodes = drifttime.cathode_times(load_df(inputs), method=method)
+    drifttime.write_cathode_times(tcathodes, output)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    method = "peak"
+    if len(args) > 1 and args[0] == "--edge":
+        method = "edge"
+        args = args[1:]
+    printhelp = len(args) < 2 or args[0] == "-h"
+    if printhelp:
+        print("Usage: python fit_tcathode.py [--edge] [tcathode_run_data.txt] [driftV.df|driftV.parquet]")
+    else:
+        main(args[0], args[1], method)
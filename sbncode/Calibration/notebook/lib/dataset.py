@@ -0,0 +1,77 @@
+import os
+import uuid
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Parquet datasets for the calibration dataframes.
+#
+# The frames are written as a hive-partitioned dataset (e.g. run=123/cryostat=0/),
+# so they can be appended to and read back by run and column.
+
+METADATA_KEY = b"calib"
+
+def _flatten_columns(df):
+    if not isinstance(df.columns, pd.MultiIndex):
+        return df.columns, False
+    return [".".join(c for c in col if c) for col in df.columns], True
+
+def _unflatten_columns(columns):
+    npad = max(len(c.split(".")) for c in columns)
+    return pd.MultiIndex.from_tuples([tuple(c.split(".") + [""]*(npad - len(c.split(".")))) for c in columns])
+
+def write_parquet(df, output, partition_cols=("run", "cryostat"), compression="zstd", row_group_size=1024*1024):
+    df = df.copy(deep=False)
+    columns, multiindex = _flatten_columns(df)
+    df.columns = columns
+    index = [n for n in df.index.names if n is not None]
+    df = df.reset_index(drop=not index)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({METADATA_KEY: json.dumps({"index": index, "multiindex": multiindex})})
+
+    partitioning = ds.partitioning(table.select(list(partition_cols)).schema, flavor="hive")
+    # statistics on each row group let readers skip the ones outside a filter
+    file_options = ds.ParquetFileFormat().make_write_options(compression=compression, write_statistics=True)
+
+    ds.write_dataset(table, output, format="parquet", partitioning=partitioning, file_options=file_options,
+                     max_rows_per_group=row_group_size, min_rows_per_group=min(row_group_size, 64*1024),
+                     # a unique name for each write, so that writing to an existing dataset appends to it
+                     basename_template="part-%s-{i}.parquet" % uuid.uuid4().hex,
+                     existing_data_behavior="overwrite_or_ignore")
+
+def read_parquet(path, columns=None, runs=None, cryostats=None, filter=None, run_col="run"):
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    metadata = json.loads((dataset.schema.metadata or {}).get(METADATA_KEY, b"{}"))
+    index = metadata.get("index", [])
+
+    # Push the run/cryostat selection down to the partitions and row groups
+    if runs is not None:
+        f = ds.field(run_col).isin(list(runs))
+        filter = f if filter is None else filter & f
+    if cryostats is not None:
+        f = ds.field("cryostat").isin(list(cryostats))
+        filter = f if filter is None else filter & f
+
+    if columns is not None:
+        columns = [c for c in index if c not in columns] + list(columns)
+
+    df = dataset.to_table(columns=columns, filter=filter).to_pandas()
+    if index:
+        df = df.set_index(index).sort_index()
+    if metadata.get("multiindex"):
+        df.columns = _unflatten_columns(df.columns)
+    return df
+
+# Save a dataframe as Parquet if the output is a .parquet path, otherwise as HDF5
+def save_df(df, output, partition_cols=("run", "cryostat")):
+    if output.rstrip(os.sep).endswith(".parquet"):
+        write_parquet(df, output, partition_cols)
+    else:
+        df.to_hdf(output, key="df", mode="w")
+
+def load_df(path, **kwargs):
+    if path.rstrip(os.sep).endswith(".parquet"):
+        return read_parquet(path, **kwargs)
+    return pd.read_hdf(path, key="df")
@@ -0,0 +1,141 @@
+import functools
+import numpy as np
+import pandas as pd
+from .constants import *
+
+# Cathode times and drift velocities from the hit time extent of anode-cathode
+# crossing tracks (the output of make_driftV_df.py).
+#
+# For a crossing track the earliest hit is at the anode and the latest at the
+# cathode, so the extent (max - min hit time) peaks at the full drift window.
+
+# TPC's in the order of the cathode time table
+TPCNAMES = ["EE", "EW", "WE", "WW"]
+
+# Nominal cathode times [ticks], used for runs without a measurement
+TCATHODE_NOMINAL = np.array([
+    3198.5279397664003, # EE
+    3207.147982327826,  # EW
+    3200.883742841676,  # WE
+    3199.9763136348492, # WW
+])
+
+# Binning of the hit time extent [ticks]
+EXTENT_RANGE = (2000., 2700.)
+EXTENT_BINWIDTH = 0.5
+
+# Minimum number of tracks to measure a drift window
+MINCOUNT = 100
+
+# Hit time extent of each track in each TPC side. Returns (extent, tpc), each
+# of shape (ntrack, 2)
+def track_extents(df):
+    extent = np.stack([df.hit_max_time_p2_tpcE.values - df.hit_min_time_p2_tpcE.values,
+                       df.hit_max_time_p2_tpcW.values - df.hit_min_time_p2_tpcW.values], axis=-1)
+    tpc = df.cryostat.values[:, None]*2 + np.arange(2)[None, :]
+    return extent, tpc
+
+# Histograms of the extent in each (run, TPC). Filled with a single bincount.
+# Returns (runs, histograms of shape (nrun, 4, nbins), bin edges)
+def extent_histograms(df, extent_range=EXTENT_RANGE, binwidth=EXTENT_BINWIDTH):
+    df = df[df.selected == 1]
+    runs, irun = np.unique(df.meta.run.values, return_inverse=True)
+    extent, tpc = track_extents(df)
+
+    edges = np.arange(extent_range[0], extent_range[1] + binwidth/2., binwidth)
+    nbins = len(edges) - 1
+    ibin = np.floor((extent - extent_range[0]) / binwidth).astype(int)
+    valid = np.isfinite(extent) & (ibin >= 0) & (ibin < nbins)
+
+    key = ((irun[:, None]*len(TPCNAMES) + tpc)*nbins + ibin)[valid]
+    hists = np.bincount(key, minlength=len(runs)*len(TPCNAMES)*nbins)
+    return runs, hists.reshape(len(runs), len(TPCNAMES), nbins), edges
+
+def _smooth(hists, width):
+    # moving sum over width bins along the last axis
+    c = np.cumsum(np.pad(hists, [(0, 0)]*(hists.ndim - 1) + [(width//2 + 1, width//2)]), axis=-1)
+    return c[..., width:] - c[..., :-width]
+
+# Position of the peak of each histogram, with sub-bin precision from a
+# parabola through the maximum bin and its neighbours
+def find_peak(hists, edges, smooth=5):
+    h = _smooth(hists, smooth).astype(float)
+    imax = np.clip(np.argmax(h, axis=-1), 1, h.shape[-1] - 2)
+    y0 = np.take_along_axis(h, (imax - 1)[..., None], axis=-1)[..., 0]
+    y1 = np.take_along_axis(h, imax[..., None], axis=-1)[..., 0]
+    y2 = np.take_along_axis(h, (imax + 1)[..., None], axis=-1)[..., 0]
+    denom = y0 - 2*y1 + y2
+    shift = np.where(denom < 0, 0.5*(y0 - y2) / np.where(denom < 0, denom, 1.), 0.)
+
+    centers = (edges[:-1] + edges[1:]) / 2.
+    return centers[imax] + shift*(edges[1] - edges[0])
+
+# Position of the falling edge of each histogram, where it drops to half
+# its maximum after the peak, linearly interpolated between bins
+def find_edge(hists, edges, smooth=5):
+    h = _smooth(hists, smooth).astype(float)
+    imax = np.argmax(h, axis=-1)
+    half = np.max(h, axis=-1) / 2.
+    after = np.arange(h.shape[-1]) > imax[..., None]
+    iedge = np.argmax(after & (h < half[..., None]), axis=-1)
+    iedge = np.maximum(iedge, 1)
+
+    hlow = np.take_along_axis(h, (iedge - 1)[..., None], axis=-1)[..., 0]
+    hhigh = np.take_along_axis(h, iedge[..., None], axis=-1)[..., 0]
+    frac = np.where(hlow > hhigh, (hlow - half) / np.where(hlow > hhigh, hlow - hhigh, 1.), 0.)
+
+    centers = (edges[:-1] + edges[1:]) / 2.
+    return centers[iedge - 1] + frac*(edges[1] - edges[0])
+
+# Cathode time [ticks] and drift velocity [cm/us] in each (run, TPC)
+def cathode_times(df, method="peak", mincount=MINCOUNT, **kwargs):
+    runs, hists, edges = extent_histograms(df, **kwargs)
+    window = find_peak(hists, edges) if method == "peak" else find_edge(hists, edges)
+    window[hists.sum(axis=-1) < mincount] = np.nan
+
+    ret = pd.DataFrame(tanode + window, columns=["tcathode_%s" % t for t in TPCNAMES], index=pd.Index(runs, name="run"))
+    vdrift = a2c_dist / (window * tick_period / 1000.)
+    for i, t in enumerate(TPCNAMES):
+        ret["vdrift_%s" % t] = vdrift[:, i]
+    return ret
+
+# Write the table: a header line, then one line per run with the cathode
+# times [ticks] in each TPC followed by the drift velocities [cm/us]
+def write_cathode_times(tcathodes, output):
+    with open(output, "w") as f:
+        f.write(" ".join(["run"] + list(tcathodes.columns)) + "\n")
+        for run, row in tcathodes.iterrows():
+            f.write(" ".join([str(run)] + ["%.6f" % v for v in row.values]) + "\n")
+
+# Read a cathode time table. Cached, so each process reads a table once.
+@functools.lru_cache(maxsize=None)
+def load_cathode_times(path):
+    run_tcathodes = {}
+    with open(path) as f:
+        next(f) # Skip first (header) line
+        for line in f:
+            dat = line.split(" ")
+            run_tcathodes[int(dat[0])] = [float(d) for d in dat[1:len(TPCNAMES)+1]]
+    return run_tcathodes
+
+# Runs already warned about in this process, as ccross_t0 is called on
+# every chunk of a run
+_warned_runs = set()
+
+# The t0 [ticks] of anode-cathode crossing tracks, from the time of their
+# latest hit in each TPC side and the cathode time of their run
+def ccross_t0(df, run_tcathodes):
+    runs, irun = np.unique(df.meta.run.values, return_inverse=True)
+    tcathode = np.array([run_tcathodes.get(r, TCATHODE_NOMINAL) for r in runs], dtype=float).reshape(-1, len(TPCNAMES))
+    # runs without a measurement (or with a failed one) get the nominal values
+    missing = ~np.isfinite(tcathode)
+    tcathode[missing] = np.broadcast_to(TCATHODE_NOMINAL, tcathode.shape)[missing]
+    notfound = [int(r) for r in runs if r not in run_tcathodes and r not in _warned_runs]
+    if notfound:
+        print("Warning: no cathode times for runs %s. Using the nominal values." % notfound)
+        _warned_runs.update(notfound)
+
+    cryostat = df.cryostat.values
+    ccross_t0_E = df.hit_max_time_p2_tpcE.values - tcathode[irun, cryostat*2]
+    ccross_t0_W = df.hit_max_time_p2_tpcW.values - tcathode[irun, cryostat*2 + 1]
+    return (ccross_t0_E + ccross_t0_W) / 2.
@@ -0,0 +1,154 @@
+import numpy as np
+from .segment import SegmentReducer
+
+# Equalization maps from the hits of anode-cathode crossing tracks
+# (the output of make_equalibriate_df.py).
+#
+# The map in each (cryostat, TPC, wire) and (cryostat, TPC, y, z) cell is the
+# scale that brings the median lifetime-corrected dQ/dx in the cell to the
+# median over the whole detector.
+
+NCRYO = 2
+NTPC = 4
+NWIRE = 5760
+
+# YZ cells [cm]
+YBINS = np.linspace(-185., 135., 33)
+ZBINS = np.linspace(-900., 900., 181)
+
+# Minimum number of hits for a cell to get a scale
+MINCOUNT = 50
+
+def wire_key(df):
+    return (df.cryostat.values*NTPC + df.tpc.values)*NWIRE + df.wire.values
+
+def yz_key(df, ybins=YBINS, zbins=ZBINS):
+    ybin = np.clip(np.digitize(df.y.values, ybins) - 1, 0, len(ybins) - 2)
+    zbin = np.clip(np.digitize(df.z.values, zbins) - 1, 0, len(zbins) - 2)
+    return ((df.cryostat.values*NTPC + df.tpc.values)*(len(ybins) - 1) + ybin)*(len(zbins) - 1) + zbin
+
+def _scales(medians, counts, global_median, mincount):
+    scale = np.full(medians.shape, np.nan, dtype=np.float32)
+    valid = counts >= mincount
+    scale[valid] = global_median / medians[valid]
+    return scale
+
+# Exact medians of the sorted values in each cell. Returns (medians, counts)
+# as dense arrays with nkey entries
+def median_map(keys, values, nkey):
+    cells = SegmentReducer(keys)
+    medians = np.full(nkey, np.nan)
+    counts = np.zeros(nkey, dtype=np.uint32)
+    medians[cells.keys[0]] = cells.median(values)
+    counts[cells.keys[0]] = cells.counts
+    return medians, counts
+
+def equalization_maps(df, var="dqdx_corr", ybins=YBINS, zbins=ZBINS, mincount=MINCOUNT):
+    values = df[var].values
+    nyz = NCRYO*NTPC*(len(ybins) - 1)*(len(zbins) - 1)
+
+    wire_median, wire_count = median_map(wire_key(df), values, NCRYO*NTPC*NWIRE)
+    yz_median, yz_count = median_map(yz_key(df, ybins, zbins), values, nyz)
+    global_median = np.median(values)
+
+    return {
+        "wire_scale": _scales(wire_median, wire_count, global_median, mincount).reshape(NCRYO, NTPC, NWIRE),
+        "wire_count": wire_count.reshape(NCRYO, NTPC, NWIRE),
+        "yz_scale": _scales(yz_median, yz_count, global_median, mincount).reshape(NCRYO, NTPC, len(ybins) - 1, len(zbins) - 1),
+        "yz_count": yz_count.reshape(NCRYO, NTPC, len(ybins) - 1, len(zbins) - 1),
+        "ybins": ybins,
+        "zbins": zbins,
+        "median": global_median,
+    }
+
+# Approximate quantiles of the values in each of nkey cells, from a histogram
+# with log-spaced bins. Sketches of different chunks of data can be merged by
+# adding their counts, so the memory is fixed no matter how much data is filled.
+class QuantileSketch(object):
+    def __init__(self, nkey, low=50., high=1e4, nbins=256):
+        self.nkey = nkey
+        self.edges = np.geomspace(low, high, nbins+1)
+        # first and last bins are underflow and overflow
+        self.counts = np.zeros((nkey, nbins+2), dtype=np.uint32)
+
+    def fill(self, keys, values):
+        vbin = np.searchsorted(self.edges, values, side="right")
+        valid = np.isfinite(values) & (keys >= 0) & (keys < self.nkey)
+        flat = keys[valid].astype(np.int64)*self.counts.shape[1] + vbin[valid]
+        # count only the (cell, bin) pairs that are filled, a dense bincount
+        # would be as large as the whole sketch for every chunk
+        filled, n = np.unique(flat, return_counts=True)
+        self.counts.reshape(-1)[filled] += n.astype(np.uint32)
+
+    def merge(self, other):
+        assert(np.array_equal(self.edges, other.edges) and self.nkey == other.nkey)
+        self.counts += other.counts
+        return self
+
+    def total(self):
+        return self.counts.sum(axis=1)
+
+    def quantile(self, q):
+        total = self.total()
+        cdf = np.cumsum(self.counts, axis=1)
+        target = q*total
+
+        # bin containing the quantile, and linear interpolation inside it (in log-space)
+        ibin = np.argmax(cdf >= target[:, None], axis=1)
+        below = np.take_along_axis(cdf, ibin[:, None], axis=1)[:, 0] - self.counts[np.arange(self.nkey), ibin]
+        inbin = self.counts[np.arange(self.nkey), ibin]
+        frac = np.where(inbin > 0, (target - below) / np.maximum(inbin, 1), 0.5)
+
+        logedges = np.log(self.edges)
+        ilow = np.clip(ibin - 1, 0, len(self.edges) - 1)
+        ihigh = np.clip(ibin, 0, len(self.edges) - 1)
+        ret = np.exp(logedges[ilow] + frac*(logedges[ihigh] - logedges[ilow]))
+        ret[total == 0] = np.nan
+        return ret
+
+    def median(self):
+        return self.quantile(0.5)
+
+# Streaming version of equalization_maps(), for samples that do not fit in
+# memory. Fill it with one dataframe at a time.
+class EqualizationMapBuilder(object):
+    def __init__(self, var="dqdx_corr", ybins=YBINS, zbins=ZBINS, **sketchargs):
+        self.var = var
+        self.ybins = ybins
+        self.zbins = zbins
+        self.wire = QuantileSketch(NCRYO*NTPC*NWIRE, **sketchargs)
+        self.yz = QuantileSketch(NCRYO*NTPC*(len(ybins) - 1)*(len(zbins) - 1), **sketchargs)
+        self.all = QuantileSketch(1, **sketchargs)
+
+    def fill(self, df):
+        values = df[self.var].values
+        self.wire.fill(wire_key(df), values)
+        self.yz.fill(yz_key(df, self.ybins, self.zbins), values)
+        self.all.fill(np.zeros(len(values), dtype=int), values)
+
+    def merge(self, other):
+        self.wire.merge(other.wire)
+        self.yz.merge(other.yz)
+        self.all.merge(other.all)
+        return self
+
+    def maps(self, mincount=MINCOUNT):
+        global_median = self.all.median()[0]
+        nyz = (NCRYO, NTPC, len(self.ybins) - 1, len(self.zbins) - 1)
+        return {
+            "wire_scale": _scales(self.wire.median(), self.wire.total(), global_median, mincount).reshape(NCRYO, NTPC, NWIRE),
+            "wire_count": self.wire.total().reshape(NCRYO, NTPC, NWIRE),
+            "yz_scale": _scales(self.yz.median(), self.yz.total(), global_median, mincount).reshape(nyz),
+            "yz_count": self.yz.total().reshape(nyz),
+            "ybins": self.ybins,
+            "zbins": self.zbins,
+            "median": global_median,
+        }
+
+# Cells without enough hits have a scale of NaN
+def save_maps(maps, output):
+    np.savez_compressed(output, **maps)
+
+def load_maps(path):
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
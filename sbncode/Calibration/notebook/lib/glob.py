@@ -1,6 +1,7 @@
 import glob
 import numpy as np
 import uproot
+import awkward as ak
 import pandas as pd
 from tqdm.auto import tqdm
 from multiprocessing import Pool
@@ -73,9 +74,68 @@ def _loaddf(inp):
         dfE.set_index("__ntuple", append=True, inplace=True)
         dfE = dfE.reorder_levels([dfE.index.nlevels-1] + list(range(0, dfE.index.nlevels-1)))
 
-        dfW = dfW.append(dfE)
+        dfW = pd.concat([dfW, dfE])
     return dfW
 
+def _to_pandas(arrays, branches):
+    # Same layout as uproot's library="pd": one DataFrame per jagged collection,
+    # with the flat (per-track) branches broadcast into each of them. The
+    # branches of a split object (e.g. "hits2.h.time", "hits2.dqdx") are one
+    # collection; plain vector branches (e.g. "daughter_pdg") are grouped by
+    # their counts, as they have nothing else to tell them apart.
+    to_dataframe = getattr(ak, "to_dataframe", None) or ak.to_pandas # awkward 2 renamed to_pandas
+    flat = [b for b in branches if arrays[b].ndim == 1]
+    groups = []
+    for b in branches:
+        if b in flat:
+            continue
+        if "." in b:
+            key = b.split(".")[0]
+        else:
+            key = ak.to_numpy(ak.num(arrays[b], axis=1))
+        for g in groups:
+            if isinstance(key, str) == isinstance(g[0], str) and np.array_equal(g[0], key):
+                g[1].append(b)
+                break
+        else:
+            groups.append((key, [b]))
+
+    if not groups:
+        return to_dataframe(arrays[flat])
+    dfs = tuple(to_dataframe(arrays[flat + g], how="inner") for _, g in groups)
+    return dfs[0] if len(dfs) == 1 else dfs
+
+def _loaddfs(inp):
+    fname, procs, index = inp
+    allbranches = list(dict.fromkeys(b for branches, _ in procs.values() for b in branches))
+    ret = {}
+    with uproot.open(fname) as f:
+        # Read the union of the branches once per cryostat
+        arrW = f[names.folderW][names.tname].arrays(allbranches)
+        arrE = f[names.folderE][names.tname].arrays(allbranches)
+        for name, (branches, applyf) in procs.items():
+            dfs = []
+            for arr, i in [(arrW, index), (arrE, index + 1)]:
+                df = _makedf(_to_pandas(arr, branches))
+                df = applyf(*df) if applyf else df[0]
+                # Set an index on the NTuple number to make sure we keep track of what is where
+                df["__ntuple"] = i
+                df.set_index("__ntuple", append=True, inplace=True)
+                df = df.reorder_levels([df.index.nlevels-1] + list(range(0, df.index.nlevels-1)))
+                dfs.append(df)
+            ret[name] = pd.concat(dfs)
+    return ret
+
+def _fix_index(ret):
+    # Fix the index So that we don't need __ntuple
+    sub_index = ret.index.names[2:]
+    ret = ret.reset_index()
+    ret.entry = ret.groupby(["__ntuple", "entry"]).ngroup()
+    ret.set_index(["entry"] + sub_index, inplace=True, verify_integrity=True)
+    ret.sort_index(inplace=True)
+    del ret["__ntuple"]
+    return ret
+
 def _process(inp):
     fname = inp[0]
     with uproot.open(fname) as f:
@@ -148,16 +208,30 @@ class NTupleGlob(object):
                 ret.append(df)
 
         ret = pd.concat(ret, axis=0, ignore_index=False)
+        return _fix_index(ret)
+
+    # Run several reductions over the same files, reading the union of their
+    # branches only once per file.
+    #
+    # procs is a dict of {name: (branches, f)}. Returns a dict of {name: dataframe}.
+    def dataframes(self, procs, maxfile=None, nproc=1):
+        if nproc == "auto":
+            nproc = multiprocessing.cpu_count()
+
+        thisglob = self.glob
+        if maxfile:
+            thisglob = thisglob[:maxfile]
 
-        # Fix the index So that we don't need __ntuple
-        sub_index = ret.index.names[2:]
-        ret = ret.reset_index()
-        ret.entry = ret.groupby(["__ntuple", "entry"]).ngroup()
-        ret.set_index(["entry"] + sub_index, inplace=True, verify_integrity=True)
-        ret.sort_index(inplace=True)
-        del ret["__ntuple"]
+        procs = {name: (branches, NTupleProc(f, name) if f else None) for name, (branches, f) in procs.items()}
 
-        return ret
+        ret = {name: [] for name in procs}
+        with Pool(processes=nproc) as pool:
+            thisglob = [(g, procs, i*2) for i,g in enumerate(thisglob)]
+            for dfs in tqdm(pool.imap_unordered(_loaddfs, thisglob), total=len(thisglob), unit="file", delay=5):
+                for name, df in dfs.items():
+                    ret[name].append(df)
+
+        return {name: _fix_index(pd.concat(dfs, axis=0, ignore_index=False)) for name, dfs in ret.items()}
 
     def histogram(self, var, bins, when=NTupleProc(), flatten_runs=False, flatten_cryo=False, maxfile=None, nproc=1):
         if nproc == "auto":
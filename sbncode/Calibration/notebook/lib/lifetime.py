@@ -0,0 +1,137 @@
+import functools
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit
+from multiprocessing import Pool
+import multiprocessing
+from .segment import SegmentReducer
+from .constants import *
+
+# Electron lifetime fits on the chunked dQ/dx of anode-cathode crossing tracks
+# (the output of make_etau_df.py)
+
+# TPC's in the order of the lifetime table (and of run_etaus in the skim scripts)
+TPCNAMES = ["EE", "EW", "WE", "WW"]
+
+# Drift time binning [us]. Stay away from the anode and cathode.
+TBINS = np.linspace(100., 850., 16)
+
+# Minimum number of chunks for a drift time bin to be used in the fit
+MINCOUNT = 20
+
+def expo(t, A, tau):
+    return A*np.exp(-t/tau)
+
+def expo_jac(t, A, tau):
+    e = np.exp(-t/tau)
+    return np.stack([e, A*t*e/tau**2], axis=-1)
+
+def drift_time(df):
+    return (df.time * tick_period - df.ccross_t0 - tanode*tick_period) / 1000.
+
+def tpc_index(df):
+    return df.cryostat.values*2 + (~df.tpcE.values.astype(bool)).astype(int)
+
+# Median dQ/dx in bins of drift time for each (run, TPC)
+def binned_dqdx(df, tbins=TBINS, mincount=MINCOUNT):
+    thit = drift_time(df).values
+    tbin = np.digitize(thit, tbins) - 1
+    valid = (tbin >= 0) & (tbin < len(tbins) - 1) & np.isfinite(df.dqdx.values)
+
+    dqdx = df.dqdx.values[valid]
+    bins = SegmentReducer(df.run.values[valid], tpc_index(df)[valid], tbin[valid], names=["run", "tpc", "tbin"])
+    ret = bins.reduce({
+        "t": (thit[valid], "mean"),
+        "dqdx": (dqdx, "median"),
+        "dqdx_mean": (dqdx, "mean"),
+        "dqdx_sq": (dqdx**2, "mean"),
+    })
+    ret["n"] = bins.counts
+
+    # Uncertainty on the median, for a gaussian spread
+    std = np.sqrt(np.maximum(ret.dqdx_sq - ret.dqdx_mean**2, 0.))
+    ret["dqdx_err"] = 1.2533 * std / np.sqrt(ret.n)
+    ret = ret[(ret.n >= mincount) & (ret.dqdx_err > 0)]
+    return ret.drop(columns=["dqdx_mean", "dqdx_sq"])
+
+def fit_lifetime(t, dqdx, err):
+    # Start from a weighted log-linear fit
+    w = (dqdx / err)**2
+    slope, intercept = np.polyfit(t, np.log(dqdx), 1, w=np.sqrt(w))
+    tau0 = -1./slope if slope < 0 else 1e4
+    p0 = [np.exp(intercept), tau0]
+
+    popt, pcov = curve_fit(expo, t, dqdx, p0=p0, sigma=err, absolute_sigma=True, jac=expo_jac)
+    return popt, np.sqrt(np.diag(pcov))
+
+# Fit the lifetime in each TPC for one run. Returns (run, taus, errs), with the
+# lifetimes in ms.
+def _fit_run(inp):
+    run, bins = inp
+    taus = np.full(len(TPCNAMES), np.nan)
+    errs = np.full(len(TPCNAMES), np.nan)
+    for itpc, tpcbins in bins.groupby(level="tpc"):
+        if len(tpcbins) < 3:
+            continue
+        try:
+            popt, perr = fit_lifetime(tpcbins.t.values, tpcbins.dqdx.values, tpcbins.dqdx_err.values)
+        except RuntimeError: # fit failed to converge
+            continue
+        taus[itpc] = popt[1] / 1e3
+        errs[itpc] = perr[1] / 1e3
+    return run, taus, errs
+
+def fit_lifetimes(df, tbins=TBINS, mincount=MINCOUNT, nproc=1):
+    if nproc == "auto":
+        nproc = multiprocessing.cpu_count()
+
+    bins = binned_dqdx(df, tbins, mincount)
+    runs = [(run, runbins) for run, runbins in bins.groupby(level="run")]
+
+    ret = []
+    with Pool(processes=nproc) as pool:
+        for run, taus, errs in pool.imap_unordered(_fit_run, runs):
+            ret.append([run] + list(taus) + list(errs))
+
+    columns = ["run"] + ["etau_%s" % t for t in TPCNAMES] + ["etau_%s_err" % t for t in TPCNAMES]
+    return pd.DataFrame(ret, columns=columns).set_index("run").sort_index()
+
+# Write the table in the format of etau_run_data.txt: a header line, then
+# one line per run with the lifetimes [ms] in each TPC. The uncertainties
+# come after the lifetimes, so readers of the first four columns are unaffected.
+# Runs where a fit failed are left out, since the skim scripts need a
+# lifetime in every TPC.
+def write_lifetimes(etaus, output):
+    failed = ~np.isfinite(etaus[["etau_%s" % t for t in TPCNAMES]].values).all(axis=1)
+    if failed.any():
+        print("Warning: failed lifetime fits in runs %s. Left out of %s." % ([int(r) for r in etaus.index[failed]], output))
+    with open(output, "w") as f:
+        f.write(" ".join(["run"] + list(etaus.columns)) + "\n")
+        for run, row in etaus[~failed].iterrows():
+            f.write(" ".join([str(run)] + ["%g" % v for v in row.values]) + "\n")
+
+# Read a lifetime table. Runs without a lifetime in every TPC (from tables
+# written before failed fits were left out) are dropped, with a warning.
+# Cached, so each process reads a table once.
+@functools.lru_cache(maxsize=None)
+def load_lifetimes(path):
+    run_etaus = {}
+    failed = []
+    with open(path) as f:
+        next(f) # Skip first (header) line
+        for line in f:
+            dat = line.split(" ")
+            etaus = [float(d) for d in dat[1:]]
+            if not np.all(np.isfinite(etaus[:len(TPCNAMES)])):
+                failed.append(int(dat[0]))
+                continue
+            run_etaus[int(dat[0])] = etaus
+    if failed:
+        print("Warning: no lifetime in every TPC for runs %s in %s. Left out." % (failed, path))
+    return run_etaus
+
+# The lifetimes [ms] of a run in each TPC
+def run_lifetimes(run_etaus, run):
+    if run not in run_etaus:
+        raise ValueError("No electron lifetime for run %i. Fit it with fit_etau.py, or leave the run out." % run)
+    return run_etaus[run]
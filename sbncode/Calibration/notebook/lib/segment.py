@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+# Grouped reductions over contiguous segments of sorted keys.
+#
+# Equivalent to df.groupby(keys).agg(...), but the group boundaries are
+# computed once and every reduction is a reduceat-style kernel over them.
+# As in pandas, NaN values are skipped: a group with only NaN gives 0 for
+# sum and NaN for the other reductions.
+class SegmentReducer(object):
+    def __init__(self, *keys, names=None):
+        keys = [np.asarray(k) for k in keys]
+        self.names = names
+
+        # Keys need to be sorted so that each group is one contiguous segment
+        self.order = None
+        if not self._is_sorted(keys):
+            self.order = np.lexsort(keys[::-1])
+            keys = [k[self.order] for k in keys]
+
+        n = len(keys[0]) if keys else 0
+        change = np.zeros(max(n-1, 0), dtype=bool)
+        for k in keys:
+            change |= k[1:] != k[:-1]
+        self.starts = np.flatnonzero(np.concatenate([[True], change])) if n else np.zeros(0, dtype=int)
+        self.counts = np.diff(np.append(self.starts, n))
+        self.segid = np.repeat(np.arange(len(self.starts)), self.counts)
+        self.keys = [k[self.starts] for k in keys]
+
+    @staticmethod
+    def _is_sorted(keys):
+        # lexicographic order: later keys only need to be ordered where all earlier ones are equal
+        if not keys or len(keys[0]) < 2:
+            return True
+        same = np.ones(len(keys[0]) - 1, dtype=bool)
+        for k in keys:
+            if np.any(same & (k[1:] < k[:-1])):
+                return False
+            same &= k[1:] == k[:-1]
+        return True
+
+    def _values(self, v):
+        v = np.asarray(v)
+        return v if self.order is None else v[self.order]
+
+    @staticmethod
+    def _notnan(v):
+        # the non-NaN values, or None if v cannot hold NaN
+        return ~np.isnan(v) if np.issubdtype(v.dtype, np.floating) else None
+
+    def _sorted_in_segments(self, v):
+        # Sort values within each segment, keeping the segments in place (NaN last)
+        order = np.lexsort((v, self.segid))
+        return v[order]
+
+    def _count(self, notnan):
+        if notnan is None:
+            return self.counts
+        if not len(self.starts):
+            return np.zeros(0, dtype=int)
+        return np.add.reduceat(notnan.astype(int), self.starts)
+
+    def sum(self, v):
+        v = self._values(v)
+        if not len(self.starts):
+            return np.zeros(0, dtype=v.dtype)
+        notnan = self._notnan(v)
+        if notnan is not None:
+            v = np.where(notnan, v, 0.)
+        return np.add.reduceat(v, self.starts)
+
+    def count(self, v):
+        v = self._values(v)
+        return self._count(self._notnan(v))
+
+    def mean(self, v):
+        n = self.count(v)
+        return self.sum(v) / np.where(n > 0, n, np.nan)
+
+    def _first_valid(self, v, last):
+        v = self._values(v)
+        notnan = self._notnan(v)
+        if notnan is None:
+            return v[self.starts + self.counts - 1] if last else v[self.starts]
+        if not len(self.starts):
+            return np.zeros(0, dtype=v.dtype)
+        pos = np.arange(len(v))
+        if last:
+            ind = np.maximum.reduceat(np.where(notnan, pos, -1), self.starts)
+            found = ind >= self.starts
+        else:
+            ind = np.minimum.reduceat(np.where(notnan, pos, len(v)), self.starts)
+            found = ind < self.starts + self.counts
+        return np.where(found, v[np.where(found, ind, 0)], np.nan)
+
+    def first(self, v):
+        return self._first_valid(v, last=False)
+
+    def last(self, v):
+        return self._first_valid(v, last=True)
+
+    def _bools(self, v, skipped):
+        # v as booleans, with NaN replaced by the value that does not change the result
+        v = self._values(v)
+        notnan = self._notnan(v)
+        return v.astype(bool) if notnan is None else np.where(notnan, v.astype(bool), skipped)
+
+    def all(self, v):
+        if not len(self.starts):
+            return np.zeros(0, dtype=bool)
+        return np.logical_and.reduceat(self._bools(v, True), self.starts)
+
+    def any(self, v):
+        if not len(self.starts):
+            return np.zeros(0, dtype=bool)
+        return np.logical_or.reduceat(self._bools(v, False), self.starts)
+
+    def median(self, v):
+        v = self._values(v)
+        n = self._count(self._notnan(v))
+        v = self._sorted_in_segments(v)
+        if not len(v):
+            return np.zeros(0)
+        lo = self.starts + np.maximum(n - 1, 0) // 2
+        hi = self.starts + n // 2
+        hi = np.minimum(hi, self.starts + self.counts - 1)
+        return np.where(n > 0, (v[lo] + v[hi]) / 2., np.nan)
+
+    def nunique(self, v):
+        v = self._values(v)
+        notnan = self._notnan(v)
+        v = self._sorted_in_segments(v)
+        if not len(v):
+            return np.zeros(0, dtype=int)
+        new = np.concatenate([[True], (v[1:] != v[:-1]) | (self.segid[1:] != self.segid[:-1])])
+        if notnan is not None:
+            new &= ~np.isnan(v)
+        return np.add.reduceat(new.astype(int), self.starts)
+
+    def index(self):
+        if len(self.keys) == 1:
+            return pd.Index(self.keys[0], name=self.names[0] if self.names else None)
+        return pd.MultiIndex.from_arrays(self.keys, names=self.names)
+
+    # Evaluate a set of reductions into a DataFrame indexed by the group keys.
+    #
+    # aggs is a dict of {column name: (values, reduction)}, where reduction is
+    # the name of one of the methods above.
+    def reduce(self, aggs):
+        return pd.DataFrame({name: getattr(self, how)(v) for name, (v, how) in aggs.items()},
+                            index=self.index())
@@ -1,32 +1,22 @@
 import sys
-import datetime as dt
+import functools
 from lib.glob import NTupleGlob
 from lib import branches
+from lib import drifttime
+from lib import lifetime
+from lib.dataset import save_df
 import numpy as np
 
 # load constants
 from lib.constants import *
 
-# EXTERNAL INPUT: The drift window in each TPC
-tcathode_EE = 3198.5279397664003
-tcathode_EW = 3207.147982327826
-tcathode_WE = 3200.883742841676
-tcathode_WW = 3199.9763136348492
+# EXTERNAL INPUT: The drift window in each TPC, from fit_tcathode.py.
+# Read on first use, so that another table can be given with --tcathode
+TCATHODE_TABLE = "/icarus/app/users/gputnam/calib/plots2/tcathode_run_data.txt"
 
-# Get external information on run timing
-run_times = {}
-with open("/icarus/app/users/gputnam/calib/rundata") as f:
-    for line in f:
-        dat = line.split(" ")
-        run_times[int(dat[0])] = dt.datetime.strptime(dat[1].rstrip("\n"), "%Y-%m-%dT%H:%M:%S").date()
-
-# Get external information on electron lifetime
-run_etaus = {}
-with open("/icarus/app/users/gputnam/calib/plots2/etau_run_data.txt") as f:
-    next(f) # Skip first (header) line
-    for line in f:
-        dat = line.split(" ")
-        run_etaus[int(dat[0])] = [float(d) for d in dat[1:]]
+# EXTERNAL INPUT: The electron lifetime in each TPC, from fit_etau.py.
+# Read on first use, so that another table can be given with --etau
+ETAU_TABLE = "/icarus/app/users/gputnam/calib/plots2/etau_run_data.txt"
 
 plane2branches = [
     "h.time", "h.width", "h.tpc", "dqdx", "pitch", "rr", "dir.x",
@@ -47,18 +37,12 @@ def exp(t, *p):
 def isTPCE(df):
     return df.tpc <= 1
 
-def reduce_df(df, raydf=None):
-    # use the external input to build the t0
-    ccross_t0_E = df.hit_max_time_p2_tpcE - tcathode_EE
-    ccross_t0_E[df.cryostat==1] = df.hit_max_time_p2_tpcE - tcathode_WE
-
-    ccross_t0_W = df.hit_max_time_p2_tpcW - tcathode_EW
-    ccross_t0_W[df.cryostat==1] = df.hit_max_time_p2_tpcW - tcathode_WW
-
+def reduce_df(df, raydf=None, etau_table=ETAU_TABLE, tcathode_table=TCATHODE_TABLE):
     # Select stopping tracks
     select_track = df.selected == 0
 
-    df["ccross_t0"] = ((ccross_t0_E + ccross_t0_W) / 2.) * tick_period
+    # use the external input to build the t0
+    df["ccross_t0"] = drifttime.ccross_t0(df, drifttime.load_cathode_times(tcathode_table)) * tick_period
     df["tpcE"] = isTPCE(df.hits2.h)
     
     # What to save
@@ -88,11 +72,12 @@ def reduce_df(df, raydf=None):
     outdf["thit"] = (outdf.time * tick_period - outdf.ccross_t0 - tanode*tick_period) / 1000.
     if len(outdf):
         thisrun = outdf.run.iloc[0]
+        etaus = lifetime.run_lifetimes(lifetime.load_lifetimes(etau_table), thisrun)
         # Correct in each TPC
-        outdf["dqdx_corr"] = outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][0]*1e3)
-        outdf.loc[~outdf.tpcE & (outdf.cryostat==0), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][1]*1e3))[~outdf.tpcE & (outdf.cryostat==0)]
-        outdf.loc[outdf.tpcE &  (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][2]*1e3))[outdf.tpcE &  (outdf.cryostat==1)]
-        outdf.loc[~outdf.tpcE & (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][3]*1e3))[~outdf.tpcE & (outdf.cryostat==1)]
+        outdf["dqdx_corr"] = outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[0]*1e3)
+        outdf.loc[~outdf.tpcE & (outdf.cryostat==0), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[1]*1e3))[~outdf.tpcE & (outdf.cryostat==0)]
+        outdf.loc[outdf.tpcE &  (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[2]*1e3))[outdf.tpcE &  (outdf.cryostat==1)]
+        outdf.loc[~outdf.tpcE & (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[3]*1e3))[~outdf.tpcE & (outdf.cryostat==1)]
 
     # Save information on PFP daughters
     if raydf is not None:
@@ -101,14 +86,22 @@ def reduce_df(df, raydf=None):
 
     return outdf
 
-def main(output, inputs):
-    ntuples = NTupleGlob(inputs, branches.trkbranches + plane2branches + ray_branches)
-    df = ntuples.dataframe(nproc="auto", f=reduce_df)
-    df.to_hdf(output, key="df", mode="w")
+# All the branches read by reduce_df
+allbranches = branches.trkbranches + plane2branches + ray_branches
+
+def main(output, inputs, etau_table=ETAU_TABLE, tcathode_table=TCATHODE_TABLE):
+    ntuples = NTupleGlob(inputs, allbranches)
+    df = ntuples.dataframe(nproc="auto", f=functools.partial(reduce_df, etau_table=etau_table, tcathode_table=tcathode_table))
+    save_df(df, output)
 
 if __name__ == "__main__":
-    printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
+    args = sys.argv[1:]
+    tables = {"--etau": ETAU_TABLE, "--tcathode": TCATHODE_TABLE}
+    while len(args) > 1 and args[0] in tables:
+        tables[args[0]] = args[1]
+        args = args[2:]
+    printhelp = len(args) < 2 or args[0] == "-h"
     if printhelp:
-        print("Usage: python make_calib_df.py [output.df] [inputs.root,]")
+        print("Usage: python make_calib_df.py [--etau etau_run_data.txt] [--tcathode tcathode_run_data.txt] [output.df|output.parquet] [inputs.root,]")
     else:
-        main(sys.argv[1], sys.argv[2:])
+        main(args[0], args[1:], tables["--etau"], tables["--tcathode"])
@@ -1,15 +1,21 @@
 import sys
 from lib.glob import NTupleGlob
 from lib import branches
+from lib.dataset import save_df
+
+# All the branches read
+allbranches = branches.trkbranches
+# No reduction, save the track-level information
+reduce_df = None
 
 def main(output, inputs):
-    ntuples = NTupleGlob(inputs, branches.trkbranches)
+    ntuples = NTupleGlob(inputs, allbranches)
     df = ntuples.dataframe(nproc="auto")
-    df.to_hdf(output, key="df", mode="w")
+    save_df(df, output, partition_cols=("meta.run", "cryostat"))
 
 if __name__ == "__main__":
     printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
     if printhelp:
-        print("Usage: python make_driftV_df.py [output.df] [inputs.root,]")
+        print("Usage: python make_driftV_df.py [output.df|output.parquet] [inputs.root,]")
     else:
         main(sys.argv[1], sys.argv[2:])
@@ -1,35 +1,25 @@
 import sys
-import datetime as dt
+import functools
 from lib.glob import NTupleGlob
 from lib import branches
+from lib import drifttime
+from lib import lifetime
+from lib.dataset import save_df
 import numpy as np
 
 # load constants
 from lib.constants import *
 
-# EXTERNAL INPUT: The drift window in each TPC
-tcathode_EE = 3198.5279397664003
-tcathode_EW = 3207.147982327826
-tcathode_WE = 3200.883742841676
-tcathode_WW = 3199.9763136348492
+# EXTERNAL INPUT: The drift window in each TPC, from fit_tcathode.py.
+# Read on first use, so that another table can be given with --tcathode
+TCATHODE_TABLE = "/icarus/app/users/gputnam/calib/plots2/tcathode_run_data.txt"
 
-# Get external information on run timing
-run_times = {}
-with open("/icarus/app/users/gputnam/calib/rundata") as f:
-    for line in f:
-        dat = line.split(" ")
-        run_times[int(dat[0])] = dt.datetime.strptime(dat[1].rstrip("\n"), "%Y-%m-%dT%H:%M:%S").date()
-
-# Get external information on electron lifetime
-run_etaus = {}
-with open("/icarus/app/users/gputnam/calib/plots2/etau_run_data.txt") as f:
-    next(f) # Skip first (header) line
-    for line in f:
-        dat = line.split(" ")
-        run_etaus[int(dat[0])] = [float(d) for d in dat[1:]]
+# EXTERNAL INPUT: The electron lifetime in each TPC, from fit_etau.py.
+# Read on first use, so that another table can be given with --etau
+ETAU_TABLE = "/icarus/app/users/gputnam/calib/plots2/etau_run_data.txt"
 
 plane2branches = [
-    "h.time", "h.width", "h.tpc", "h.wire", "dqdx", "pitch",
+    "h.time", "h.width", "h.tpc", "h.wire", "h.p.y", "h.p.z", "dqdx", "pitch",
 ]
 
 plane2branches = ["hits2.%s" % s for s in plane2branches]
@@ -43,56 +33,62 @@ def exp(t, *p):
 def isTPCE(df):
     return df.tpc <= 1
 
-def reduce_df(df):
-    # use the external input to build the t0
-    ccross_t0_E = df.hit_max_time_p2_tpcE - tcathode_EE
-    ccross_t0_E[df.cryostat==1] = df.hit_max_time_p2_tpcE - tcathode_WE
-
-    ccross_t0_W = df.hit_max_time_p2_tpcW - tcathode_EW
-    ccross_t0_W[df.cryostat==1] = df.hit_max_time_p2_tpcW - tcathode_WW
-
+def reduce_df(df, etau_table=ETAU_TABLE, tcathode_table=TCATHODE_TABLE):
     # Select anode + cathode crossing tracks
     select_track = df.selected == 1
 
-    df["ccross_t0"] = ((ccross_t0_E + ccross_t0_W) / 2.) * tick_period
+    # use the external input to build the t0
+    df["ccross_t0"] = drifttime.ccross_t0(df, drifttime.load_cathode_times(tcathode_table)) * tick_period
     df["tpcE"] = isTPCE(df.hits2.h)
     
     # What to save
     outdf = df.loc[(df.hits2.dqdx > 0) & select_track, 
-                  [ ("hits2", "h", "time"),
-                    ("hits2", "h", "wire"),
-                    ("tpcE", "", ""),
-                    ("hits2", "dqdx", ""),
-                    ("hits2", "pitch", ""),
-                    ("ccross_t0", "", ""),
-                    ("meta", "run", ""),
-                    ("cryostat", "", ""),
+                  [ ("hits2", "h", "time", ""),
+                    ("hits2", "h", "wire", ""),
+                    ("hits2", "h", "tpc", ""),
+                    ("hits2", "h", "p", "y"),
+                    ("hits2", "h", "p", "z"),
+                    ("tpcE", "", "", ""),
+                    ("hits2", "dqdx", "", ""),
+                    ("hits2", "pitch", "", ""),
+                    ("ccross_t0", "", "", ""),
+                    ("meta", "run", "", ""),
+                    ("cryostat", "", "", ""),
                    ]
                   ].copy()
 
     # Simplify column names
-    outdf.columns = ["time", "wire", "tpcE", "dqdx_nocorr", "width", "ccross_t0", "run", "cryostat"]
+    outdf.columns = ["time", "wire", "tpc", "y", "z", "tpcE", "dqdx_nocorr", "width", "ccross_t0", "run", "cryostat"]
     
     # Correct for electron lifetime
     outdf["thit"] = (outdf.time * tick_period - outdf.ccross_t0 - tanode*tick_period) / 1000.
     if len(outdf):
         thisrun = outdf.run.iloc[0]
+        etaus = lifetime.run_lifetimes(lifetime.load_lifetimes(etau_table), thisrun)
         # Correct in each TPC
-        outdf["dqdx_corr"] = outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][0]*1e3)
-        outdf.loc[~outdf.tpcE & (outdf.cryostat==0), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][1]*1e3))[~outdf.tpcE & (outdf.cryostat==0)]
-        outdf.loc[outdf.tpcE &  (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][2]*1e3))[outdf.tpcE &  (outdf.cryostat==1)]
-        outdf.loc[~outdf.tpcE & (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -run_etaus[thisrun][3]*1e3))[~outdf.tpcE & (outdf.cryostat==1)]
+        outdf["dqdx_corr"] = outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[0]*1e3)
+        outdf.loc[~outdf.tpcE & (outdf.cryostat==0), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[1]*1e3))[~outdf.tpcE & (outdf.cryostat==0)]
+        outdf.loc[outdf.tpcE &  (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[2]*1e3))[outdf.tpcE &  (outdf.cryostat==1)]
+        outdf.loc[~outdf.tpcE & (outdf.cryostat==1), "dqdx_corr"] = (outdf.dqdx_nocorr * exp(outdf.thit, 1., -etaus[3]*1e3))[~outdf.tpcE & (outdf.cryostat==1)]
 
     return outdf
 
-def main(output, inputs):
-    ntuples = NTupleGlob(inputs, branches.trkbranches + plane2branches)
-    df = ntuples.dataframe(nproc="auto", f=reduce_df)
-    df.to_hdf(output, key="df", mode="w")
+# All the branches read by reduce_df
+allbranches = branches.trkbranches + plane2branches
+
+def main(output, inputs, etau_table=ETAU_TABLE, tcathode_table=TCATHODE_TABLE):
+    ntuples = NTupleGlob(inputs, allbranches)
+    df = ntuples.dataframe(nproc="auto", f=functools.partial(reduce_df, etau_table=etau_table, tcathode_table=tcathode_table))
+    save_df(df, output)
 
 if __name__ == "__main__":
-    printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
+    args = sys.argv[1:]
+    tables = {"--etau": ETAU_TABLE, "--tcathode": TCATHODE_TABLE}
+    while len(args) > 1 and args[0] in tables:
+        tables[args[0]] = args[1]
+        args = args[2:]
+    printhelp = len(args) < 2 or args[0] == "-h"
     if printhelp:
-        print("Usage: python make_equalibriate_df.py [output.df] [inputs.root,]")
+        print("Usage: python make_equalibriate_df.py [--etau etau_run_data.txt] [--tcathode tcathode_run_data.txt] [output.df|output.parquet] [inputs.root,]")
     else:
-        main(sys.argv[1], sys.argv[2:])
+        main(args[0], args[1:], tables["--etau"], tables["--tcathode"])
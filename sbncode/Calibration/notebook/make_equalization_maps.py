@@ -0,0 +1,17 @@
+import sys
+from lib.dataset import load_df
+from lib import equalize
+
+def main(output, inputs):
+    # Fill one input at a time, so the whole sample never has to be in memory
+    builder = equalize.EqualizationMapBuilder()
+    for inp in inputs:
+        builder.fill(load_df(inp))
+    equalize.save_maps(builder.maps(), output)
+
+if __name__ == "__main__":
+    printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
+    if printhelp:
+        print("Usage: python make_equalization_maps.py [output.npz] [equalibriate.df|equalibriate.parquet,]")
+    else:
+        main(sys.argv[1], sys.argv[2:])
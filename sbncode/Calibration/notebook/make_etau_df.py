@@ -1,24 +1,18 @@
 import sys
-import datetime as dt
+import functools
 from lib.glob import NTupleGlob
 from lib import branches
+from lib import drifttime
+from lib.dataset import save_df
+from lib.segment import SegmentReducer
 import numpy as np
 
 # load constants
 from lib.constants import *
 
-# EXTERNAL INPUT: The drift window in each TPC
-tcathode_EE = 3198.5279397664003
-tcathode_EW = 3207.147982327826
-tcathode_WE = 3200.883742841676
-tcathode_WW = 3199.9763136348492
-
-# Get external information on run timing
-run_times = {}
-with open("/icarus/app/users/gputnam/calib/rundata") as f:
-    for line in f:
-        dat = line.split(" ")
-        run_times[int(dat[0])] = dt.datetime.strptime(dat[1].rstrip("\n"), "%Y-%m-%dT%H:%M:%S").date()
+# EXTERNAL INPUT: The drift window in each TPC, from fit_tcathode.py.
+# Read on first use, so that another table can be given with --tcathode
+TCATHODE_TABLE = "/icarus/app/users/gputnam/calib/plots2/tcathode_run_data.txt"
 
 plane2branches = [
     "h.p.x", "h.p.y", "h.p.z", "h.time", "h.tpc", "dqdx", "dir.x", "dir.y", "dir.z",
@@ -28,32 +22,42 @@ plane2branches = ["hits2.%s" % s for s in plane2branches]
 def isTPCE(df):
     return df.tpc <= 1
 
-def reduce_df(df):
-    # use the external input to build the t0
-    ccross_t0_E = df.hit_max_time_p2_tpcE - tcathode_EE
-    ccross_t0_E[df.cryostat==1] = df.hit_max_time_p2_tpcE - tcathode_WE
-
-    ccross_t0_W = df.hit_max_time_p2_tpcW - tcathode_EW
-    ccross_t0_W[df.cryostat==1] = df.hit_max_time_p2_tpcW - tcathode_WW
+# Number of hits averaged into each chunk
+CHUNK_SIZE = 5
 
+def reduce_df(df, chunk_size=CHUNK_SIZE, tcathode_table=TCATHODE_TABLE):
     # Select anode + cathode crossing tracks
     select_track = df.selected == 1
 
-    df["ccross_t0"] = ((ccross_t0_E + ccross_t0_W) / 2.) * tick_period
-    
-    df = df[(df.hits2.dqdx > 0) & select_track].copy()
-    df["chunk"] = df.index.get_level_values(1) // 5
-    df["tpcE"] = isTPCE(df.hits2.h)
-    outdf = df.groupby(["entry", "chunk"])[('hits2', 'dqdx', '', ''),].median()
-    outdf = outdf.join(df.groupby(["entry", "chunk"])[[('hits2', 'h', 'p', 'x'),
-                                                      ('hits2', 'h', 'p', 'y'),
-                                                      ('hits2', 'h', 'p', 'z'),
-                                                      ('hits2', 'h', 'time', ''),
-                                                      ('hits2', 'dir', 'x', ''),
-                                                      ('hits2', 'dir', 'y', ''),
-                                                      ('hits2', 'dir', 'z', ''),]].mean())
+    # use the external input to build the t0
+    df["ccross_t0"] = drifttime.ccross_t0(df, drifttime.load_cathode_times(tcathode_table)) * tick_period
     
-    outdf.columns = ["dqdx", "x", "y", "z", "time", "dirx", "diry", "dirz"]
+    df = df[(df.hits2.dqdx > 0) & select_track]
+    tpcE = isTPCE(df.hits2.h)
+
+    # Group the hits in each track into chunks. The index is sorted by
+    # (entry, hit), so the groups only need to be found once
+    chunks = SegmentReducer(df.index.get_level_values(0), df.index.get_level_values(1) // chunk_size,
+                            names=["entry", "chunk"])
+    outdf = chunks.reduce({
+        "dqdx": (df.hits2.dqdx, "median"),
+        "x": (df.hits2.h.p.x, "mean"),
+        "y": (df.hits2.h.p.y, "mean"),
+        "z": (df.hits2.h.p.z, "mean"),
+        "time": (df.hits2.h.time, "mean"),
+        "dirx": (df.hits2.dir.x, "mean"),
+        "diry": (df.hits2.dir.y, "mean"),
+        "dirz": (df.hits2.dir.z, "mean"),
+        # TPC/Cryo info
+        "tpcE": (tpcE, "all"),
+        "ntpc": (tpcE, "nunique"),
+        # Save T0
+        "ccross_t0": (df.ccross_t0, "first"),
+        # also save the cryostat number
+        "cryostat": (df.cryostat, "first"),
+        # And run number
+        "run": (df.meta.run, "first"),
+    })
     
     # fix the direction normalization
     norm = np.sqrt(outdf.dirx**2 + outdf.diry**2 + outdf.dirz**2)
@@ -61,31 +65,32 @@ def reduce_df(df):
     outdf.diry = outdf.diry / norm
     outdf.dirz = outdf.dirz / norm
 
-    # TPC/Cryo info
-    outdf["tpcE"] = df.groupby(["entry", "chunk"]).tpcE.all()
-    outdf["tpcW"] = (~outdf.tpcE) & (df.groupby(["entry", "chunk"]).tpcE.nunique() == 1)
-
-    # Save T0
-    outdf["ccross_t0"] = df.groupby(["entry", "chunk"]).ccross_t0.first()
-    # also save the cryostat number
-    outdf["cryostat"] = df.groupby(["entry", "chunk"]).cryostat.first()
-    # And run number
-    outdf["run"] = df.groupby(["entry", "chunk"])[[('meta', 'run', '', ''),]].first()
-
     # Only save chunks that are all in one TPC
-    outdf = outdf[outdf.tpcE | outdf.tpcW].drop(columns=["tpcW"])
+    tpcW = (~outdf.tpcE) & (outdf.ntpc == 1)
+    outdf = outdf[outdf.tpcE | tpcW].drop(columns=["ntpc"])
    
     return outdf
 
+# All the branches read by reduce_df
+allbranches = branches.trkbranches + plane2branches
 
-def main(output, inputs):
-    ntuples = NTupleGlob(inputs, branches.trkbranches + plane2branches)
-    df = ntuples.dataframe(nproc="auto", f=reduce_df)
-    df.to_hdf(output, key="df", mode="w")
+def main(output, inputs, chunk_size=CHUNK_SIZE, tcathode_table=TCATHODE_TABLE):
+    ntuples = NTupleGlob(inputs, allbranches)
+    df = ntuples.dataframe(nproc="auto", f=functools.partial(reduce_df, chunk_size=chunk_size, tcathode_table=tcathode_table))
+    save_df(df, output)
 
 if __name__ == "__main__":
-    printhelp = len(sys.argv) < 3 or sys.argv[1] == "-h"
+    args = sys.argv[1:]
+    chunk_size = CHUNK_SIZE
+    tcathode_table = TCATHODE_TABLE
+    while len(args) > 1 and args[0] in ("-n", "--tcathode"):
+        if args[0] == "-n":
+            chunk_size = int(args[1])
+        else:
+            tcathode_table = args[1]
+        args = args[2:]
+    printhelp = len(args) < 2 or args[0] == "-h"
     if printhelp:
-        print("Usage: python make_etau_df.py [output.df] [inputs.root,]")
+        print("Usage: python make_etau_df.py [-n chunk_size] [--tcathode tcathode_run_data.txt] [output.df|output.parquet] [inputs.root,]")
     else:
-        main(sys.argv[1], sys.argv[2:])
+        main(args[0], args[1:], chunk_size, tcathode_table)
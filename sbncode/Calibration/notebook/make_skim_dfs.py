@@ -0,0 +1,54 @@
+import sys
+import inspect
+import functools
+import importlib
+from lib.glob import NTupleGlob
+from lib.dataset import save_df
+
+# The skims that can be made in one pass, and the scripts that define them.
+# Each script provides the branches it reads (allbranches) and its
+# reduction (reduce_df).
+skims = {
+    "calib": "make_calib_df",
+    "etau": "make_etau_df",
+    "equalibriate": "make_equalibriate_df",
+    "driftV": "make_driftV_df",
+}
+
+# Options for the external inputs, and the argument of the reductions
+# that take them
+tables = {
+    "--etau": "etau_table",
+    "--tcathode": "tcathode_table",
+}
+
+def main(outputs, inputs, tables={}):
+    procs = {}
+    for name in outputs:
+        skim = importlib.import_module(skims[name])
+        reduce_df = skim.reduce_df
+        if reduce_df is not None:
+            params = inspect.signature(reduce_df).parameters
+            reduce_df = functools.partial(reduce_df, **{k: v for k, v in tables.items() if k in params})
+        procs[name] = (skim.allbranches, reduce_df)
+
+    ntuples = NTupleGlob(inputs, [])
+    dfs = ntuples.dataframes(procs, nproc="auto")
+    for name, output in outputs.items():
+        # the track-level frame keeps the uproot column names
+        partition_cols = ("meta.run", "cryostat") if name == "driftV" else ("run", "cryostat")
+        save_df(dfs[name], output, partition_cols)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    given = {}
+    while len(args) > 1 and args[0] in tables:
+        given[tables[args[0]]] = args[1]
+        args = args[2:]
+    outputs = dict(a.split("=", 1) for a in args if "=" in a)
+    inputs = [a for a in args if "=" not in a]
+    printhelp = len(args) < 1 or args[0] == "-h" or not outputs or not inputs or any(o not in skims for o in outputs)
+    if printhelp:
+        print("Usage: python make_skim_dfs.py [%s path ...] [%s=output.df|output.parquet ...] [inputs.root,]" % (" path ".join(tables), "|".join(skims)))
+    else:
+        main(outputs, inputs, given)
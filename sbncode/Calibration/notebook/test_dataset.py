@@ -0,0 +1,71 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.dataset import save_df, load_df
+
+def _frame(n=1000, seed=1, runs=(5, 6, 7)):
+    # hits of tracks in a few runs, with the columns of the skims
+    rng = np.random.default_rng(seed)
+    columns = pd.MultiIndex.from_tuples([("hits2", "dqdx", ""), ("hits2", "h", "time"), ("run", "", ""),
+                                         ("cryostat", "", ""), ("tpcE", "", "")])
+    df = pd.DataFrame({
+        ("hits2", "dqdx", ""): rng.normal(1500., 100., n),
+        ("hits2", "h", "time"): rng.uniform(0., 4096., n),
+        ("run", "", ""): rng.choice(runs, n),
+        ("cryostat", "", ""): rng.integers(0, 2, n),
+        ("tpcE", "", ""): rng.random(n) < 0.5,
+    }, columns=columns)
+    df.index = pd.MultiIndex.from_arrays([np.repeat(np.arange(n//10), 10) + 100*seed, np.tile(np.arange(10), n//10)],
+                                         names=["entry", "hit"])
+    return df
+
+def _check_equal(loaded, df):
+    # the partition columns come back last, and as the types of the partition keys
+    assert sorted(loaded.columns) == sorted(df.columns)
+    pd.testing.assert_frame_equal(loaded[df.columns], df.sort_index(), check_dtype=False)
+
+def test_round_trip_parquet(tmp_path):
+    df = _frame()
+    output = str(tmp_path / "calib.parquet")
+    save_df(df, output)
+    assert os.path.isdir(os.path.join(output, "run=5", "cryostat=0"))
+    _check_equal(load_df(output), df)
+    # and with flat column names
+    flat = df.copy()
+    flat.columns = ["dqdx", "time", "run", "cryostat", "tpcE"]
+    save_df(flat, str(tmp_path / "flat.parquet"))
+    _check_equal(load_df(str(tmp_path / "flat.parquet")), flat)
+
+def test_round_trip_hdf5(tmp_path):
+    pytest.importorskip("tables")
+    df = _frame()
+    output = str(tmp_path / "calib.df")
+    save_df(df, output)
+    pd.testing.assert_frame_equal(load_df(output), df)
+
+def test_append(tmp_path):
+    output = str(tmp_path / "calib.parquet")
+    first, second = _frame(seed=1), _frame(seed=2)
+    save_df(first, output)
+    files = set(glob.glob(os.path.join(output, "*", "*", "*.parquet")))
+    save_df(second, output)
+    allfiles = set(glob.glob(os.path.join(output, "*", "*", "*.parquet")))
+    # new files for the second write, with other names, the first ones kept
+    assert files < allfiles and len(allfiles) == 2*len(files)
+    _check_equal(load_df(output), pd.concat([first, second]))
+
+def test_filter_pushdown(tmp_path):
+    df = _frame()
+    output = str(tmp_path / "calib.parquet")
+    save_df(df, output)
+    loaded = load_df(output, runs=[5, 7], cryostats=[1])
+    selected = df[df.run.isin([5, 7]) & (df.cryostat == 1)]
+    assert len(loaded) == len(selected) > 0
+    _check_equal(loaded, selected)
+    # only the columns asked for, with the index
+    dqdx = load_df(output, columns=["hits2.dqdx"], runs=[6])
+    assert list(dqdx.columns) == [("hits2", "dqdx")]
+    np.testing.assert_allclose(dqdx.hits2.dqdx.values, df[df.run == 6].sort_index().hits2.dqdx.values)
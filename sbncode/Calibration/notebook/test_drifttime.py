@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from lib import drifttime
+from lib.constants import a2c_dist, tanode, tick_period
+
+EDGES = np.arange(2000., 2700.25, 0.5)
+CENTERS = (EDGES[:-1] + EDGES[1:]) / 2.
+
+def test_find_peak():
+    # gaussians with their peak between the bin centers
+    peaks = np.array([[2300.3, 2412.85], [2150.1, 2555.6]])
+    hists = np.round(1e4*np.exp(-0.5*((CENTERS - peaks[..., None]) / 4.)**2))
+    np.testing.assert_allclose(drifttime.find_peak(hists, EDGES), peaks, atol=0.05)
+
+def test_find_edge():
+    # plateaus that fall to 0 at the edge, the rising edge before them
+    # is not taken
+    edges = np.array([2400., 2500.5, 2333.])
+    hists = np.where((2100. < CENTERS) & (CENTERS < edges[:, None]), 1000., 0.)
+    np.testing.assert_allclose(drifttime.find_edge(hists, EDGES), edges, atol=0.05)
+
+def _tracks(rng, counts, windows):
+    # anode-cathode crossing tracks of each run in both cryostats, with the
+    # hit time extent in each TPC around its drift window
+    dfs = []
+    for run, n in counts.items():
+        cryostat = np.repeat([0, 1], n)
+        window = np.array(windows)[cryostat[:, None]*2 + np.arange(2)]
+        extent = window + rng.normal(0., 2., window.shape)
+        tmin = rng.uniform(800., 900., window.shape)
+        dfs.append(pd.DataFrame({
+            ("selected", ""): np.r_[np.ones(2*n - 10, dtype=int), np.zeros(10, dtype=int)],
+            ("meta", "run"): run,
+            ("cryostat", ""): cryostat,
+            ("hit_min_time_p2_tpcE", ""): tmin[:, 0],
+            ("hit_max_time_p2_tpcE", ""): tmin[:, 0] + extent[:, 0],
+            ("hit_min_time_p2_tpcW", ""): tmin[:, 1],
+            ("hit_max_time_p2_tpcW", ""): tmin[:, 1] + extent[:, 1],
+        }))
+    return pd.concat(dfs, ignore_index=True)
+
+def test_cathode_times():
+    windows = [2348.5, 2357.2, 2350.9, 2350.]
+    df = _tracks(np.random.default_rng(3), {10: 5000, 11: 60}, windows)
+    for method in ["peak", "edge"]:
+        tcathodes = drifttime.cathode_times(df, method=method)
+        assert list(tcathodes.index) == [10, 11]
+        measured = tcathodes.loc[10, ["tcathode_%s" % t for t in drifttime.TPCNAMES]].values - tanode
+        if method == "peak":
+            np.testing.assert_allclose(measured, windows, atol=0.3)
+        else:
+            # half maximum after the peak of a gaussian with sigma 2
+            np.testing.assert_allclose(measured, np.array(windows) + 2.*np.sqrt(2.*np.log(2.)), atol=0.5)
+        np.testing.assert_allclose(tcathodes.loc[10, ["vdrift_%s" % t for t in drifttime.TPCNAMES]].values,
+                                   a2c_dist / (measured * tick_period / 1000.))
+        # too few tracks in the other run
+        assert tcathodes.loc[11].isna().all()
+
+def test_ccross_t0_warns_once(capsys):
+    df = _tracks(np.random.default_rng(4), {20: 50, 21: 50}, [2350.]*4)
+    run_tcathodes = {20: [tanode + 2350.]*4}
+    t0 = drifttime.ccross_t0(df, run_tcathodes)
+    assert np.all(np.isfinite(t0))
+    assert "[21]" in capsys.readouterr().out
+    drifttime.ccross_t0(df, run_tcathodes)
+    assert capsys.readouterr().out == ""
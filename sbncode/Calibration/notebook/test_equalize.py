@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from lib import equalize
+
+def _hits(n=50000, seed=2):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "cryostat": rng.integers(0, equalize.NCRYO, n),
+        "tpc": rng.integers(0, equalize.NTPC, n),
+        "wire": rng.integers(0, 30, n)*190,
+        "y": rng.uniform(-200., 150., n),
+        "z": rng.uniform(-950., 950., n),
+        "dqdx_corr": rng.lognormal(np.log(1500.), 0.3, n),
+    })
+    df.loc[rng.random(n) < 0.01, "dqdx_corr"] = np.nan
+    return df
+
+def test_wire_key():
+    df = _hits()
+    keys = equalize.wire_key(df)
+    assert keys.min() >= 0 and keys.max() < equalize.NCRYO*equalize.NTPC*equalize.NWIRE
+    cells = df[["cryostat", "tpc", "wire"]].drop_duplicates()
+    assert len(np.unique(equalize.wire_key(cells))) == len(cells)
+    # the wire is the fastest index of the maps
+    np.testing.assert_array_equal(np.unravel_index(keys, (equalize.NCRYO, equalize.NTPC, equalize.NWIRE)),
+                                  [df.cryostat.values, df.tpc.values, df.wire.values])
+
+def test_median_map():
+    df = _hits().dropna()
+    nkey = equalize.NCRYO*equalize.NTPC*equalize.NWIRE
+    medians, counts = equalize.median_map(equalize.wire_key(df), df.dqdx_corr.values, nkey)
+    grouped = df.groupby(equalize.wire_key(df)).dqdx_corr
+    np.testing.assert_allclose(medians[grouped.median().index], grouped.median().values)
+    np.testing.assert_array_equal(counts[grouped.size().index], grouped.size().values)
+    empty = np.ones(nkey, dtype=bool)
+    empty[grouped.size().index] = False
+    assert np.isnan(medians[empty]).all() and (counts[empty] == 0).all()
+
+def test_sketch_quantiles():
+    rng = np.random.default_rng(3)
+    nkey = 5
+    keys = rng.integers(-1, nkey + 1, 200000)
+    values = rng.lognormal(np.log(np.array([1., 300., 800., 1500., 3000., 6000., 1.]))[keys + 1], 0.3)
+    sketch = equalize.QuantileSketch(nkey)
+    sketch.fill(keys, values)
+    valid = (keys >= 0) & (keys < nkey)
+    np.testing.assert_array_equal(sketch.total(), np.bincount(keys[valid], minlength=nkey))
+    for q in [0.1, 0.5, 0.9]:
+        exact = [np.quantile(values[keys == k], q) for k in range(nkey)]
+        # within the 2% width of the log bins
+        np.testing.assert_allclose(sketch.quantile(q), exact, rtol=0.02)
+
+    # filled in chunks, or merged, the same counts
+    chunks = equalize.QuantileSketch(nkey)
+    for i in range(0, len(keys), 7000):
+        chunks.fill(keys[i:i+7000], values[i:i+7000])
+    np.testing.assert_array_equal(chunks.counts, sketch.counts)
+    half = len(keys)//2
+    first, second = equalize.QuantileSketch(nkey), equalize.QuantileSketch(nkey)
+    first.fill(keys[:half], values[:half])
+    second.fill(keys[half:], values[half:])
+    np.testing.assert_array_equal(first.merge(second).counts, sketch.counts)
+
+    # no entries, no quantile
+    assert np.isnan(equalize.QuantileSketch(2).median()).all()
+
+def test_builder_against_exact():
+    df = _hits()
+    exact = equalize.equalization_maps(df.dropna())
+    builder = equalize.EqualizationMapBuilder()
+    builder.fill(df.iloc[:20000])
+    builder.fill(df.iloc[20000:])
+    maps = builder.maps()
+    np.testing.assert_array_equal(maps["wire_count"], exact["wire_count"])
+    np.testing.assert_array_equal(maps["yz_count"], exact["yz_count"])
+    filled = np.isfinite(exact["wire_scale"])
+    np.testing.assert_array_equal(np.isfinite(maps["wire_scale"]), filled)
+    np.testing.assert_allclose(maps["wire_scale"][filled], exact["wire_scale"][filled], rtol=0.03)
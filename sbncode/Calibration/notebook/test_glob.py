@@ -0,0 +1,44 @@
+import numpy as np
+import awkward as ak
+import pandas as pd
+import uproot
+
+from lib import glob, names
+
+def _arrays(counts):
+    n = len(counts)
+    return ak.Array({
+        "meta.run": np.full(n, 1),
+        "start.x": np.arange(n, dtype=float),
+        "hits2.h.time": ak.unflatten(np.arange(counts.sum(), dtype=float), counts),
+        "hits2.dqdx": ak.unflatten(np.ones(counts.sum()), counts),
+        "daughter_pdg": ak.unflatten(np.full(counts.sum(), 13), counts),
+        "daughter_nsp": ak.unflatten(np.full(counts.sum(), 2), counts),
+    })
+
+def test_collections_with_equal_counts():
+    # the hits and the daughters have the same counts, but are separate frames
+    for counts in [np.array([2, 0, 3]), np.array([0, 0, 0])]:
+        arrays = _arrays(counts)
+        dfs = glob._to_pandas(arrays, list(arrays.fields))
+        assert isinstance(dfs, tuple) and len(dfs) == 2
+        assert sorted(dfs[0].columns) == ["hits2.dqdx", "hits2.h.time", "meta.run", "start.x"]
+        assert sorted(dfs[1].columns) == ["daughter_nsp", "daughter_pdg", "meta.run", "start.x"]
+        assert len(dfs[0]) == counts.sum()
+
+def test_loaddfs(tmp_path):
+    fname = str(tmp_path / "skim.root")
+    counts = np.array([2, 0, 3])
+    arrays = _arrays(counts)
+    with uproot.recreate(fname) as f:
+        for folder in [names.folderW, names.folderE]:
+            path = "%s/%s" % (folder, names.tname)
+            f.mktree(path, {b: arrays[b].type.content for b in arrays.fields})
+            f[path].extend({b: arrays[b] for b in arrays.fields})
+
+    procs = {"hits": (["meta.run", "hits2.h.time"], None)}
+    ret = glob._loaddfs((fname, procs, 0))
+    df = ret["hits"]
+    assert isinstance(df, pd.DataFrame)
+    assert len(df) == 2*counts.sum()
+    assert sorted(df.index.get_level_values("__ntuple").unique()) == [0, 1]
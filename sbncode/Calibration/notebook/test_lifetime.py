@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib import lifetime
+from lib.constants import tanode
+
+TAUS = [3000., 4000., 5000., 6000.] # us, in the order of lifetime.TPCNAMES
+
+def _chunks(run, itpc, tau, n, rng):
+    # chunks of one TPC with dQ/dx falling as exp(-t/tau), t in us
+    t = rng.uniform(100., 850., n)
+    return pd.DataFrame({
+        "run": run,
+        "cryostat": itpc // 2,
+        "tpcE": itpc % 2 == 0,
+        "ccross_t0": 0.,
+        "time": tanode + t*2.5,
+        "dqdx": 1000.*np.exp(-t/tau)*rng.normal(1., 0.05, n),
+    })
+
+def _sample(rng):
+    # run 2 has too few chunks in WW for a fit
+    return pd.concat([_chunks(run, itpc, tau, 40 if (run, itpc) == (2, 3) else 20000, rng)
+                      for run in [1, 2] for itpc, tau in enumerate(TAUS)], ignore_index=True)
+
+def test_fit_lifetimes():
+    etaus = lifetime.fit_lifetimes(_sample(np.random.default_rng(5)))
+    assert list(etaus.index) == [1, 2]
+    for itpc, tpc in enumerate(lifetime.TPCNAMES):
+        fitted = etaus.loc[1, "etau_%s" % tpc]
+        err = etaus.loc[1, "etau_%s_err" % tpc]
+        assert 0. < err < 0.05*fitted
+        assert abs(fitted - TAUS[itpc]/1e3) < 5*err
+    assert np.isnan(etaus.loc[2, "etau_WW"]) and np.isnan(etaus.loc[2, "etau_WW_err"])
+    assert np.isfinite(etaus.loc[2, ["etau_EE", "etau_EW", "etau_WE"]]).all()
+
+def test_fit_not_converging(monkeypatch):
+    bins = lifetime.binned_dqdx(_sample(np.random.default_rng(6)))
+    def fail(*args):
+        raise RuntimeError("Optimal parameters not found")
+    monkeypatch.setattr(lifetime, "fit_lifetime", fail)
+    run, taus, errs = lifetime._fit_run((1, bins.loc[1]))
+    assert run == 1 and np.isnan(taus).all() and np.isnan(errs).all()
+
+def test_failed_fits_left_out(tmp_path):
+    etaus = lifetime.fit_lifetimes(_sample(np.random.default_rng(7)))
+    output = str(tmp_path / "etau_run_data.txt")
+    lifetime.write_lifetimes(etaus, output)
+    run_etaus = lifetime.load_lifetimes(output)
+    assert list(run_etaus) == [1]
+    np.testing.assert_allclose(lifetime.run_lifetimes(run_etaus, 1)[:4], etaus.loc[1].values[:4], rtol=1e-5)
+    with pytest.raises(ValueError):
+        lifetime.run_lifetimes(run_etaus, 2)
+
+def test_load_table_with_nan(tmp_path):
+    # a table written before the failed fits were left out
+    output = str(tmp_path / "old_etau_run_data.txt")
+    with open(output, "w") as f:
+        f.write("run etau_EE etau_EW etau_WE etau_WW\n")
+        f.write("1 3 4 5 6\n")
+        f.write("2 3 4 5 nan\n")
+    run_etaus = lifetime.load_lifetimes(output)
+    assert run_etaus == {1: [3., 4., 5., 6.]}
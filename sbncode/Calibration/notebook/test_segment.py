@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from lib.segment import SegmentReducer
+
+def _sample(n=20000, seed=1):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "a": rng.integers(0, 50, n),
+        "b": rng.integers(0, 40, n),
+        "x": rng.normal(size=n),
+        "i": rng.integers(0, 5, n),
+    })
+    # NaN in some values, and groups with only NaN
+    df.loc[rng.random(n) < 0.3, "x"] = np.nan
+    df.loc[df.b == 7, "x"] = np.nan
+    return df
+
+def test_against_pandas():
+    df = _sample()
+    reducer = SegmentReducer(df.a.values, df.b.values, names=["a", "b"])
+    grouped = df.groupby(["a", "b"])
+    for how in ["sum", "mean", "first", "last", "median", "nunique", "count"]:
+        for col in ["x", "i"]:
+            ours = pd.Series(getattr(reducer, how)(df[col].values), index=reducer.index())
+            theirs = getattr(grouped[col], how)()
+            np.testing.assert_allclose(ours.values, theirs.loc[ours.index].values, equal_nan=True,
+                                       err_msg="%s of %s" % (how, col))
+
+    for how in ["all", "any"]:
+        ours = getattr(reducer, how)(df.x.values)
+        theirs = getattr(grouped.x, how)()
+        assert np.array_equal(ours, theirs.loc[reducer.index()].values), how
+
+def test_sorted_and_empty():
+    df = _sample().sort_values(["a", "b"])
+    reducer = SegmentReducer(df.a.values, df.b.values)
+    assert reducer.order is None
+    np.testing.assert_allclose(reducer.mean(df.x.values), df.groupby(["a", "b"]).x.mean().values, equal_nan=True)
+
+    empty = SegmentReducer(np.zeros(0, dtype=int))
+    for how in ["sum", "mean", "first", "median", "nunique", "all", "any"]:
+        assert len(getattr(empty, how)(np.zeros(0))) == 0
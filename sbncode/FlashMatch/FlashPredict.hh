@@ -46,6 +46,8 @@
 #include "TDirectory.h"
 #include "TH1.h"
 #include "TH2.h"
+#include "TH3.h"
+#include "TProfile.h"
 #include "TProfile3D.h"
 
 #include "sbncode/OpT0Finder/flashmatch/Base/OpT0FinderTypes.h"
@@ -56,6 +58,7 @@
 #include "nusimdata/SimulationBase/MCTruth.h"
 
 #include <algorithm>
+#include <cmath>
 #include <iterator>
 #include <limits>
 #include <list>
@@ -272,6 +275,8 @@ private:
   // art::InputTag fFlashProducer;
   void initTree(void);
   ReferenceMetrics loadMetrics(const std::string inputFilename) const;
+  TProfile3D* loadProfile3(TDirectory* infile, const std::string metric,
+                           const char* name) const;
   std::tuple<double, bool> cheatMCT0_IsNu(
     const std::vector<art::Ptr<recob::Hit>>& hits,
     const std::vector<art::Ptr<simb::MCParticle>>& mcParticles) const;
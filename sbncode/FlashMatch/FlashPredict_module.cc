@@ -675,18 +675,12 @@ FlashPredict::ReferenceMetrics FlashPredict::loadMetrics(
   // TODO: Test!
   // TODO: store 3D-arrays of means and spreads, instead of the
   // TProfile3D
-  TProfile3D* tmp1_prof3 = (TProfile3D*)infile->Get("dy_prof3");
-  rm.dYP3 = (TProfile3D*)tmp1_prof3->Clone("dYP3");
-  TProfile3D* tmp2_prof3 = (TProfile3D*)infile->Get("dz_prof3");
-  rm.dZP3 = (TProfile3D*)tmp2_prof3->Clone("dZP3");
-  TProfile3D* tmp3_prof3 = (TProfile3D*)infile->Get("rr_prof3");
-  rm.RRP3 = (TProfile3D*)tmp3_prof3->Clone("RRP3");
-  TProfile3D* tmp4_prof3 = (TProfile3D*)infile->Get("ratio_prof3");
-  rm.RatioP3 = (TProfile3D*)tmp4_prof3->Clone("RatioP3");
-  TProfile3D* tmp5_prof3 = (TProfile3D*)infile->Get("slope_prof3");
-  rm.SlopeP3 = (TProfile3D*)tmp5_prof3->Clone("SlopeP3");
-  TProfile3D* tmp6_prof3 = (TProfile3D*)infile->Get("petoq_prof3");
-  rm.PEToQP3 = (TProfile3D*)tmp6_prof3->Clone("PEToQP3");
+  rm.dYP3 = loadProfile3(infile, "dy", "dYP3");
+  rm.dZP3 = loadProfile3(infile, "dz", "dZP3");
+  rm.RRP3 = loadProfile3(infile, "rr", "RRP3");
+  rm.RatioP3 = loadProfile3(infile, "ratio", "RatioP3");
+  rm.SlopeP3 = loadProfile3(infile, "slope", "SlopeP3");
+  rm.PEToQP3 = loadProfile3(infile, "petoq", "PEToQP3");
 
   infile->Close();
   delete infile;
@@ -695,6 +689,44 @@ FlashPredict::ReferenceMetrics FlashPredict::loadMetrics(
 }
 
 
+// The 3D profile of a metric. Templates made with merged cells
+// (--min-entries3) have instead the sums of each leaf in a TProfile,
+// <metric>_leaves3, and the leaf bin of every cell in <metric>_index3,
+// 0 where it is empty; every cell then gets the sums of its leaf.
+TProfile3D* FlashPredict::loadProfile3(
+  TDirectory* infile, const std::string metric, const char* name) const
+{
+  auto prof3 = (TProfile3D*)infile->Get((metric + "_prof3").c_str());
+  if(prof3) return (TProfile3D*)prof3->Clone(name);
+
+  auto index3 = (TH3*)infile->Get((metric + "_index3").c_str());
+  auto leaves3 = (TProfile*)infile->Get((metric + "_leaves3").c_str());
+  if(!index3 || !leaves3) {
+    throw cet::exception("FlashPredict")
+      << "Metrics file has neither " << metric << "_prof3 nor "
+      << metric << "_leaves3 and " << metric << "_index3\n";
+  }
+  const TAxis* xa = index3->GetXaxis();
+  const TAxis* ya = index3->GetYaxis();
+  const TAxis* za = index3->GetZaxis();
+  prof3 = new TProfile3D(name, "",
+                         xa->GetNbins(), xa->GetXmin(), xa->GetXmax(),
+                         ya->GetNbins(), ya->GetXmin(), ya->GetXmax(),
+                         za->GetNbins(), za->GetXmin(), za->GetXmax(),
+                         leaves3->GetErrorOption());
+  double* sumwv = prof3->GetArray();
+  double* sumwv2 = prof3->GetSumw2()->GetArray();
+  for(int cell = 0; cell < index3->GetNcells(); ++cell) {
+    int leaf = std::lround(index3->GetBinContent(cell));
+    if(leaf <= 0) continue;
+    sumwv[cell] = leaves3->GetArray()[leaf];
+    sumwv2[cell] = leaves3->GetSumw2()->GetArray()[leaf];
+    prof3->SetBinEntries(cell, leaves3->GetBinEntries(leaf));
+  }
+  return prof3;
+}
+
+
 std::tuple<double, bool> FlashPredict::cheatMCT0_IsNu(
   const std::vector<art::Ptr<recob::Hit>>& hits,
   const std::vector<art::Ptr<simb::MCParticle>>& mcParticles) const
@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+######################################################################
+#
+# Name: benchmark_templates.py
+#
+# Purpose: Time the stages of the template generation on synthetic
+#          nuslicetrees, and check that the implementations agree
+#
+# Usage:
+#
+# benchmark_templates.py (--sbnd | --icarus) [-n N [N ...]] [--impl IMPL [IMPL ...]]
+#
+# Options:
+#
+# -n         - Slices in the synthetic nuslicetree (default 1e4 1e5 1e6),
+#              up to 1e7 and more as memory and disk allow
+# --impl     - Implementations to compare with the first one:
+#              columnar, columnar_in_memory, legacy (the per-event loops
+#              of the original generator, see legacy_templates.py; needs
+#              ROOT and fhicl, and has no --min-entries3)
+# --ftype    - Flash type (default: the first one of the detector)
+# --nsigma   - Tolerance of the comparisons, in statistical errors
+#
+# The arrays that do not depend on the random flash X estimates (the
+# rr and ratio metrics) have to agree to rounding. The others, which
+# change with the random numbers of each implementation, have to agree
+# within nsigma of their statistical errors.
+#
+######################################################################
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+import flashmatch_columnar as fmc
+import synthetic_nuslicetree as synth
+
+
+class dotDict(dict):
+    def __getattr__(self, val):
+        return self[val]
+
+
+def task_params(detector, pset, time_delay, min_entries3=0):
+    # as task_params() in generate_simple_weighted_template.py
+    return dotDict(detector=detector, ftype_long=pset.FlashType,
+                   drift_distance=pset.DriftDistance, x_bins=pset.XBins,
+                   xbin_width=pset.DriftDistance/pset.XBins,
+                   time_delay=time_delay, tolerable_time_diff=0.1,
+                   min_entries3=min_entries3)
+
+
+def run_columnar(job, chain):
+    timings = {}
+    templates = fmc.columnar_templates(job.pset, job.params, job.seed)
+    for stage in fmc.columnar_templates.STAGES:
+        start = time.perf_counter()
+        templates.fill(stage, chain)
+        templates.finish(stage)
+        timings[stage] = time.perf_counter() - start
+    start = time.perf_counter()
+    templates.scores(chain, lambda chunk, derived, scores: None)
+    timings['scores'] = time.perf_counter() - start
+    return fmc.columnar_flat_arrays(templates.md, templates.pol_coeffs), timings
+
+
+def columnar(job):
+    # reading the trees in chunks in every stage
+    return run_columnar(job, fmc.nuslice_chain(job.filename, job.trees))
+
+
+def columnar_in_memory(job):
+    # reading the trees once
+    start = time.perf_counter()
+    chunks = list(fmc.nuslice_chain(job.filename, job.trees, step_size="100 GB"))
+    read = time.perf_counter() - start
+    arrays, timings = run_columnar(job, chunks)
+    return arrays, dict(read=read, **timings)
+
+
+def legacy(job):
+    # the per-event loops of the original generator, with ROOT
+    import legacy_templates
+    return legacy_templates.generator(job.filename, job.trees, job.pset, job.params,
+                                      job.workdir, job.seed)
+
+
+IMPLEMENTATIONS = {'columnar': columnar, 'columnar_in_memory': columnar_in_memory,
+                   'legacy': legacy}
+
+
+def compare_templates(ref, other, nsigma=5.):
+    # Returns the names of the arrays of other that do not agree with ref
+    failed = []
+    for key, a in ref.items():
+        b = other.get(key)
+        if b is None or np.shape(a) != np.shape(b):
+            failed.append(key)
+            continue
+        name = key.split('_')[0]
+        if key.endswith('_index3'):
+            ok = np.array_equal(a, b)
+        elif name in ['rr', 'ratio'] or 'edges' in key:
+            ok = np.allclose(a, b, rtol=1e-9, atol=1e-12)
+        elif key.startswith('pol_coeffs'):
+            # the corrections along X, within 10% of their largest value
+            x = ref['x_edges']
+            pa = np.polynomial.polynomial.polyval(x, a)
+            pb = np.polynomial.polynomial.polyval(x, b)
+            ok = np.abs(pa - pb).max() <= 0.1*np.abs(pa).max() + 1e-6
+        else:
+            suffix = '3' if key.endswith('3') else ''
+            entries = ref[f"{name}_entries{suffix}"]
+            if 'entries' in key:
+                err = np.sqrt(entries) + 1.
+            else:
+                # error of the difference of two means or spreads of
+                # independent gaussian samples
+                spread = ref[f"{name}_spread{suffix}"]
+                err = spread*np.sqrt((2. if 'mean' in key else 1.)/np.maximum(entries, 1.))
+            ok = np.all((np.abs(a - b) <= nsigma*err + 1e-9) | (entries < 2))
+        if not ok:
+            failed.append(key)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark_templates.py')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--sbnd', action='store_true', help='Benchmark with SBND parameters')
+    group.add_argument('--icarus', action='store_true', help='Benchmark with ICARUS parameters')
+    parser.add_argument('-n', type=float, nargs='+', default=[1e4, 1e5, 1e6],
+                        help='Slices in the synthetic nuslicetree')
+    parser.add_argument('--impl', nargs='+', choices=list(IMPLEMENTATIONS),
+                        default=['columnar', 'columnar_in_memory'],
+                        help='Implementations, compared with the first one')
+    parser.add_argument('--ftype', default=None, help='Flash type')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--nsigma', type=float, default=5., help='Tolerance of the comparisons')
+    parser.add_argument('--min-entries3', type=int, default=0,
+                        help='Adaptive 3D profiles with this many entries per cell')
+    parser.add_argument('--workdir', default='benchmark_templates',
+                        help='Directory of the synthetic and output files')
+    args = parser.parse_args()
+
+    detector = "sbnd" if args.sbnd else "icarus"
+    fcl_params = synth.stub_fcl_params(detector)
+    ftypes = synth.flash_types(detector)
+    l_name, table, trees, t_delay = next((f for f in ftypes if f[0] == args.ftype), ftypes[0])
+    pset = dotDict(fcl_params[table])
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+
+    n_failed = 0
+    print(f"{'implementation':20s} {'slices':>10s} {'stage':12s} {'seconds':>10s} {'kHz':>10s}")
+    for n in [int(n) for n in args.n]:
+        filename = os.path.join(args.workdir, f"synthetic_{detector}_{n}.root")
+        synth.write_synthetic_file(filename, detector, n, args.seed, ftypes=[l_name])
+        # the ICARUS trees of both cryostats
+        nslices = n*len(trees)
+        job = dotDict(filename=filename, trees=trees, pset=pset, flash_type=l_name,
+                      params=task_params(detector, pset, t_delay, args.min_entries3),
+                      seed=args.seed,
+                      workdir=args.workdir)
+        ref = None
+        for impl in args.impl:
+            arrays, timings = IMPLEMENTATIONS[impl](job)
+            for stage, seconds in list(timings.items()) + [('total', sum(timings.values()))]:
+                print(f"{impl:20s} {nslices:10d} {stage:12s} {seconds:10.3f} "
+                      f"{nslices/seconds/1e3:10.1f}")
+            if ref is None:
+                ref = arrays
+                continue
+            failed = compare_templates(ref, arrays, args.nsigma)
+            if failed:
+                print(f"{impl} differs from {args.impl[0]} in {', '.join(failed)}")
+                n_failed += 1
+            else:
+                print(f"{impl} agrees with {args.impl[0]}")
+        os.remove(filename)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1030 @@
+######################################################################
+#
+# Name: flashmatch_columnar.py
+#
+# Purpose: Columnar (NumPy) engine for the flash matching templates
+#          made by generate_simple_weighted_template.py
+#
+# The nuslicetree is read once into NumPy arrays, and every histogram
+# and profile of the templates is kept as binned sums (entries, sum
+# and sum of squares in each bin), filled for all events at once.
+# Bins follow the ROOT numbering, with under/overflow in bins 0 and
+# nbins+1, so the sums map one to one into the ROOT objects.
+#
+######################################################################
+
+import re
+import mmap
+import struct
+import hashlib
+import zipfile
+import numpy as np
+
+# nuslicetree branches used to build the templates
+BRANCHES = ["slices", "is_nu", "mcT0", "flash_time", "score",
+            "charge_x", "charge_x_gl", "charge_y", "charge_z",
+            "flash_yb", "flash_zb", "flash_rr", "flash_ratio",
+            "flash_xw", "petoq", "y_skew", "z_skew"]
+
+METRICS = ['dy', 'dz', 'rr', 'ratio', 'slope', 'petoq']
+
+# friend tree with the derived columns, aligned by entry with the input
+DERIVED_TREE = "nuslicetree_derived"
+
+# Version of the flat template files, see write_flat_templates()
+FLAT_FORMAT_VERSION = 1
+
+
+class nuslice_chain:
+    # Lazy chain of nuslicetrees, e.g. of both ICARUS cryostats, in one or
+    # more files. Iterating over it reads the trees one after the other in
+    # chunks of step_size, with a 'cryostat' column with the position of
+    # the tree in tree_paths. Each iteration reads the files again, so only
+    # one chunk is in memory.
+    def __init__(self, filenames, tree_paths, branches=BRANCHES, step_size="100 MB"):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        self.tree_paths = list(tree_paths)
+        self.branches = branches
+        self.step_size = step_size
+
+    def __iter__(self):
+        import uproot
+        for filename in self.filenames:
+            with uproot.open(filename) as rootfile:
+                for cryostat, tree_path in enumerate(self.tree_paths):
+                    for chunk in rootfile[tree_path].iterate(self.branches, library="np",
+                                                             step_size=self.step_size):
+                        n = len(chunk[self.branches[0]])
+                        chunk['cryostat'] = np.full(n, cryostat, dtype=np.int32)
+                        yield chunk
+
+
+class derived_writer:
+    # Writes the derived columns chunk by chunk into a friend tree
+    def __init__(self, filename, tree_name=DERIVED_TREE):
+        import uproot
+        self.rootfile = uproot.recreate(filename)
+        self.tree_name = tree_name
+
+    def write(self, derived):
+        columns = {b: np.asarray(c, dtype=np.float64) for b, c in derived.items()}
+        if self.tree_name in self.rootfile:
+            self.rootfile[self.tree_name].extend(columns)
+        else:
+            self.rootfile[self.tree_name] = columns
+
+    def close(self):
+        self.rootfile.close()
+
+
+class regular_axis:
+    def __init__(self, nbins, low, up):
+        self.nbins = int(nbins)
+        self.low   = float(low)
+        self.up    = float(up)
+        self.width = (self.up - self.low) / self.nbins
+
+    def edges(self):
+        return np.linspace(self.low, self.up, self.nbins + 1)
+
+    def centers(self):
+        return self.low + self.width * (np.arange(self.nbins) + 0.5)
+
+    def find_bin(self, x):
+        # Same as TAxis::FindBin, NaNs go to the overflow like in ROOT
+        x = np.asarray(x, dtype=np.float64)
+        ibin = np.full(x.shape, self.nbins + 1, dtype=np.int64)
+        ibin[x < self.low] = 0
+        inside = (x >= self.low) & (x < self.up)
+        ibin[inside] = 1 + (self.nbins * (x[inside] - self.low) /
+                            (self.up - self.low)).astype(np.int64)
+        return ibin
+
+
+class binned_stats:
+    # Sum of weights, of weights squared, of weighted values and of
+    # weighted squared values in every cell of a regular N-D binning.
+    # For a histogram only the weights are used.
+    SUMS = ['sumw', 'sumw2', 'sumwv', 'sumwv2']
+
+    def __init__(self, axes, value_range=None):
+        self.axes  = axes
+        self.value_range = value_range  # TProfile only accepts values in range
+        self.shape = tuple(a.nbins + 2 for a in axes)
+        self.sumw   = np.zeros(self.shape)
+        self.sumw2  = np.zeros(self.shape)
+        self.sumwv  = np.zeros(self.shape)
+        self.sumwv2 = np.zeros(self.shape)
+        self.entries = 0
+
+    def cell_index(self, coords):
+        return np.ravel_multi_index([a.find_bin(c) for a, c in zip(self.axes, coords)],
+                                    self.shape)
+
+    def fill(self, coords, values=None, weights=None):
+        coords = [np.asarray(c, dtype=np.float64) for c in coords]
+        keep = np.ones(coords[0].shape, dtype=bool)
+        if values is not None:
+            values = np.asarray(values, dtype=np.float64)
+            keep &= ~np.isnan(values)
+            if self.value_range is not None:
+                keep &= (self.value_range[0] <= values) & (values <= self.value_range[1])
+        if weights is None:
+            weights = np.ones(coords[0].shape)
+        coords  = [c[keep] for c in coords]
+        weights = np.asarray(weights, dtype=np.float64)[keep]
+
+        cells = self.cell_index(coords)
+        size = self.sumw.size
+        self.sumw  += np.bincount(cells, weights, minlength=size).reshape(self.shape)
+        self.sumw2 += np.bincount(cells, weights**2, minlength=size).reshape(self.shape)
+        if values is not None:
+            values = values[keep]
+            self.sumwv  += np.bincount(cells, weights*values, minlength=size).reshape(self.shape)
+            self.sumwv2 += np.bincount(cells, weights*values**2, minlength=size).reshape(self.shape)
+        self.entries += len(cells)
+
+    def merge(self, other):
+        # the sums of two samples are the sums of their union
+        assert self.sumw.shape == other.sumw.shape
+        for a in self.SUMS:
+            getattr(self, a)[...] += getattr(other, a)
+        self.entries += other.entries
+        return self
+
+    def to_dict(self, prefix):
+        d = {f"{prefix}.{a}": getattr(self, a) for a in self.SUMS}
+        d[f"{prefix}.entries"] = np.array(self.entries)
+        return d
+
+    def from_dict(self, d, prefix):
+        for a in self.SUMS:
+            getattr(self, a)[...] = d[f"{prefix}.{a}"]
+        self.entries = int(d[f"{prefix}.entries"])
+        return self
+
+    def means(self):
+        # like TProfile::GetBinContent, empty bins are 0
+        return np.divide(self.sumwv, self.sumw,
+                         out=np.zeros_like(self.sumw), where=self.sumw != 0)
+
+    def spreads(self):
+        # like TProfile::GetBinError with option 's'
+        m = self.means()
+        sq = np.divide(self.sumwv2, self.sumw,
+                       out=np.zeros_like(self.sumw), where=self.sumw != 0)
+        return np.sqrt(np.abs(sq - m*m))
+
+    def inner(self, a):
+        # drop the under/overflow bins
+        return a[(Ellipsis,) + tuple(slice(1, -1) for _ in self.shape)]
+
+
+class bootstrap_stats(binned_stats):
+    # The sums of binned_stats for nboot bootstrap replicas of the sample,
+    # in arrays with the replica first. Each replica gets its own weights
+    # for the events, e.g. Poisson(1), in an (event, replica) matrix, so
+    # the replicas are filled as sums of its rows, in blocks of replicas
+    # that keep the float temporaries to BLOCK_ELEMENTS.
+    # size of the (event, replica) buffer of fill()
+    BLOCK_ELEMENTS = 1 << 22
+
+    def __init__(self, axes, nboot, value_range=None):
+        super().__init__(axes, value_range)
+        self.nboot = nboot
+        for a in self.SUMS:
+            setattr(self, a, np.zeros((nboot,) + self.shape))
+
+    def fill(self, coords, values, replica_weights):
+        coords = [np.asarray(c, dtype=np.float64) for c in coords]
+        values = np.asarray(values, dtype=np.float64)
+        keep = ~np.isnan(values)
+        if self.value_range is not None:
+            keep &= (self.value_range[0] <= values) & (values <= self.value_range[1])
+        index = np.flatnonzero(keep)
+        if len(index) == 0:
+            return
+
+        # sum the events of each cell for all replicas at once, over the
+        # events sorted by cell
+        cells = self.cell_index([c[index] for c in coords])
+        order = np.argsort(cells, kind='stable')
+        cells, starts = np.unique(cells[order], return_index=True)
+        index = index[order]
+        values = values[index][:, None]
+
+        # a block of replicas at a time, in one (event, replica) buffer
+        # reused for all the sums
+        block = max(1, min(self.nboot, self.BLOCK_ELEMENTS // len(index)))
+        buf = np.empty((len(index), block))
+        for first in range(0, self.nboot, block):
+            last = min(first + block, self.nboot)
+            w = buf[:, :last - first]
+
+            def add(a):
+                getattr(self, a).reshape(self.nboot, -1)[first:last, cells] += \
+                    np.add.reduceat(w, starts).T
+            np.copyto(w, replica_weights[index, first:last])
+            add('sumw')
+            np.multiply(w, w, out=w)
+            add('sumw2')
+            np.copyto(w, replica_weights[index, first:last])
+            np.multiply(w, values, out=w)
+            add('sumwv')
+            np.multiply(w, values, out=w)
+            add('sumwv2')
+        self.entries += len(values)
+
+    def errors(self):
+        # Standard deviation over the replicas of the mean and of the
+        # spread of each cell, without under/overflow. Replicas where the
+        # cell is empty are left out, cells empty in all of them are NaN.
+        empty = self.inner(self.sumw) == 0
+        n = np.maximum((~empty).sum(axis=0), 1)
+
+        def std(a):
+            a = np.where(empty, 0., self.inner(a))
+            m = a.sum(axis=0) / n
+            var = np.where(empty, 0., (a - m)**2).sum(axis=0) / n
+            return np.where(empty.all(axis=0), np.nan, np.sqrt(var))
+        return std(self.means()), std(self.spreads())
+
+
+def box_union(a, b):
+    # The box made of the boxes a and b, if they are next to each other
+    # along one axis and the same along the others, else None
+    differ = [i for i in range(len(a)) if a[i] != b[i]]
+    if len(differ) != 1:
+        return None
+    (lo_a, hi_a), (lo_b, hi_b) = a[differ[0]], b[differ[0]]
+    if hi_a != lo_b and hi_b != lo_a:
+        return None
+    union = list(a)
+    union[differ[0]] = (min(lo_a, lo_b), max(hi_a, hi_b))
+    return tuple(union)
+
+
+def merge_sparse(boxes, box_sum, min_entries):
+    # Merges neighbouring boxes that both have fewer than min_entries,
+    # while their union is a box, the pair with the fewest entries
+    # together first. Returns the boxes left, some of them with fewer
+    # than min_entries when they have no such neighbour.
+    boxes = list(boxes)
+    while True:
+        merges = [(box_sum(a) + box_sum(b), i, j, union)
+                  for i, a in enumerate(boxes) for j, b in enumerate(boxes[:i])
+                  if box_sum(a) < min_entries and box_sum(b) < min_entries
+                  for union in [box_union(a, b)] if union is not None]
+        if not merges:
+            return boxes
+        _, i, j, union = min(merges)
+        boxes = [b for k, b in enumerate(boxes) if k not in (i, j)] + [union]
+
+
+class adaptive_profile3:
+    # The cells of a 3D binned_stats merged octree-style: starting from the
+    # whole volume, a box is split in two along each axis (with more than
+    # one bin), and each child with min_entries is split again. A child
+    # with fewer entries is merged with a sibling next to it along one axis
+    # that also has too few, as long as their union is a box, and is
+    # otherwise a leaf of its own with fewer than min_entries; the children
+    # with min_entries are never merged. A box none of whose children has
+    # min_entries is a leaf. index maps every cell (without under/overflow)
+    # to its leaf, -1 for empty ones, and leaves has the sums of each leaf
+    # in its bins 1 to nleaves, as the TProfile <metric>_leaves3 of the
+    # metrics file.
+    SUMS = binned_stats.SUMS
+
+    def __init__(self, prof3, min_entries):
+        self.prof3 = prof3
+        self.min_entries = min_entries
+        sumw = prof3.inner(prof3.sumw)
+        shape = sumw.shape
+        # box sums from cumulative sums, with a leading 0 on each axis
+        cum = np.pad(sumw, [(1, 0)]*3).cumsum(0).cumsum(1).cumsum(2)
+
+        def box_sum(box):
+            (x0, x1), (y0, y1), (z0, z1) = box
+            return (cum[x1, y1, z1] - cum[x0, y1, z1] - cum[x1, y0, z1] - cum[x1, y1, z0] +
+                    cum[x0, y0, z1] + cum[x0, y1, z0] + cum[x1, y0, z0] - cum[x0, y0, z0])
+
+        self.index = np.full(shape, -1, dtype=np.int32)
+        self.nleaves = 0
+
+        def add_leaf(box):
+            self.index[tuple(slice(lo, hi) for lo, hi in box)] = self.nleaves
+            self.nleaves += 1
+
+        whole = tuple((0, n) for n in shape)
+        boxes = [whole] if box_sum(whole) > 0 else []
+        while boxes:
+            box = boxes.pop()
+            halves = [[(lo, (lo + hi)//2), ((lo + hi)//2, hi)] if hi - lo > 1 else [(lo, hi)]
+                      for lo, hi in box]
+            children = [(bx, by, bz) for bx in halves[0] for by in halves[1] for bz in halves[2]]
+            counts = [box_sum(c) for c in children]
+            if len(children) == 1 or max(counts) < min_entries:
+                add_leaf(box)
+                continue
+            boxes.extend(c for c, n in zip(children, counts) if n >= min_entries)
+            for leaf in merge_sparse([c for c, n in zip(children, counts) if 0 < n < min_entries],
+                                     box_sum, min_entries):
+                add_leaf(leaf)
+
+        # at least one bin, for a profile without entries
+        nbins = max(self.nleaves, 1)
+        self.leaves = binned_stats([regular_axis(nbins, 0., nbins)], prof3.value_range)
+        filled = self.index >= 0
+        for a in self.SUMS:
+            self.leaves.inner(getattr(self.leaves, a))[:self.nleaves] = np.bincount(
+                self.index[filled], prof3.inner(getattr(prof3, a))[filled],
+                minlength=self.nleaves)
+        self.leaves.entries = prof3.entries
+
+    def expanded(self):
+        # A binned_stats like prof3, with the sums of its leaf in every cell,
+        # so each cell has the mean and spread of its leaf
+        stats = binned_stats(self.prof3.axes, self.prof3.value_range)
+        filled = self.index >= 0
+        for a in self.SUMS:
+            full = getattr(self.prof3, a).copy()
+            inner = stats.inner(full)
+            leaf_sums = self.leaves.inner(getattr(self.leaves, a))
+            inner[...] = np.where(filled, leaf_sums[np.maximum(self.index, 0)], 0.)
+            setattr(stats, a, full)
+        stats.entries = self.prof3.entries
+        return stats
+
+
+class columnar_metric:
+    # NumPy counterpart of metrics_stuff in generate_simple_weighted_template.py
+    # With nboot > 0 the profiles are also filled for nboot bootstrap
+    # replicas, for the uncertainties on their means and spreads.
+    def __init__(self, name, pset, nboot=0):
+        self.name    = name
+        self.x_bins  = pset.XBins
+        self.xaxis   = regular_axis(pset.XBins, pset.x_low, pset.x_up)
+        self.vaxis   = regular_axis(pset[name]['bins'], pset[name]['low'], pset[name]['up'])
+        self.axes3   = [regular_axis(pset.x_bins_, pset.x_low, pset.x_up),
+                        regular_axis(pset.y_bins, pset.y_low, pset.y_up),
+                        regular_axis(pset.z_bins, pset.z_low, pset.z_up)]
+        self.h2      = binned_stats([self.xaxis, self.vaxis])
+        self.prof    = binned_stats([self.xaxis],
+                                    value_range=(pset[name]['low'], pset[name]['up']))
+        self.prof3   = binned_stats(self.axes3)
+        self.edges3  = [a.edges() for a in self.axes3]
+        self.means   = None
+        self.spreads = None
+        self.means3   = None
+        self.spreads3 = None
+        self.adaptive3 = None
+        self.entries3 = None
+        self.boot = self.boot3 = None
+        if nboot:
+            self.boot  = bootstrap_stats([self.xaxis], nboot, value_range=self.prof.value_range)
+            self.boot3 = bootstrap_stats(self.axes3, nboot)
+        self.mean_errs = self.spread_errs = None
+        self.mean_errs3 = self.spread_errs3 = None
+
+    def fill(self, x, y, z, value, replica_weights=None):
+        self.h2.fill([x, value])
+        self.prof.fill([x], value)
+        self.prof3.fill([x, y, z], value)
+        if self.boot is not None:
+            self.boot.fill([x], value, replica_weights)
+            self.boot3.fill([x, y, z], value, replica_weights)
+
+    def stats(self):
+        stats = {'h2': self.h2, 'prof': self.prof, 'prof3': self.prof3}
+        if self.boot is not None:
+            stats.update(boot=self.boot, boot3=self.boot3)
+        return stats
+
+    def update_metrics(self, min_entries3=0):
+        # With min_entries3, the 3D cells are merged until they have
+        # min_entries3 entries, see adaptive_profile3
+        self.means = self.prof.inner(self.prof.means())
+        self.spreads = self.prof.inner(self.prof.spreads())
+        for ib in np.flatnonzero(self.spreads <= 0.001):
+            print(f"Warning {self.name} spread close to zero.\n",
+                  f"index: {ib}. spread: {self.spreads[ib]} \n",
+                  "Setting to 0.001")
+        self.spreads = np.maximum(self.spreads, 0.001)
+        self.adaptive3 = None
+        prof3 = self.prof3
+        if min_entries3:
+            self.adaptive3 = adaptive_profile3(self.prof3, min_entries3)
+            prof3 = self.adaptive3.expanded()
+        self.means3 = prof3.inner(prof3.means())
+        self.spreads3 = prof3.inner(prof3.spreads())
+        self.entries3 = prof3.inner(prof3.sumw)
+        if self.boot is not None:
+            self.mean_errs, self.spread_errs = self.boot.errors()
+            self.mean_errs3, self.spread_errs3 = self.boot3.errors()
+            # tell apart spreads that are zero from too few events
+            for ib in np.flatnonzero(self.spreads <= 0.001):
+                print(f"{self.name} bin {ib}: bootstrap spread uncertainty "
+                      f"{self.spread_errs[ib]:.3g} with {self.prof.inner(self.prof.sumw)[ib]:g} entries")
+
+
+def quality_mask(cols, beam_spill_time_end, drift_distance):
+    # Same selection as quality_checks(). Note that it never applied
+    # the flash time window, so neither does this.
+    return ((cols['slices'] == 1) & (cols['is_nu'] == 1) &
+            (0. <= cols['mcT0']) & (cols['mcT0'] <= beam_spill_time_end) &
+            (0. <= cols['charge_x']) & (cols['charge_x'] <= drift_distance))
+
+
+class x_projection_lookup:
+    # Flash drift distance estimates from the ProjectionX of a (X, metric)
+    # H2. For each metric bin the projection is over the smallest window of
+    # metric bins around it with more than min_entries.
+    # All windows are worked out once from cumulative sums over the metric
+    # bins, with the RMS and the CDF of their projections, so the estimate
+    # for any number of events is a gather and an inverse-CDF sampling.
+    def __init__(self, h2, xbin_width, drift_distance, min_entries=100):
+        self.xaxis = h2.axes[0]
+        self.yaxis = h2.axes[1]
+        self.drift_distance = float(drift_distance)
+        ny = self.yaxis.nbins
+        nx = self.xaxis.nbins
+        counts = h2.sumw
+
+        # windows [low, high] tried for every Y bin and bin_buff, in order
+        ybin = np.arange(ny + 2)[:, None]
+        buff = np.arange(ny + 2)[None, :]
+        tried = (0 < ybin - buff) | (ybin + buff <= ny)
+        low = np.maximum(ybin - buff, 0)
+        high = np.where(ybin + buff <= ny, ybin + buff, ny + 1)
+        cum_entries = np.concatenate([[0.], np.cumsum(counts.sum(axis=0))])
+        enough = tried & (cum_entries[high + 1] - cum_entries[low] > min_entries)
+        found = enough.any(axis=1)
+        first = np.argmax(enough, axis=1)
+        self.window_low = low[ybin[:, 0], first]
+        self.window_high = high[ybin[:, 0], first]
+
+        # projections of the windows, one row per Y bin
+        cum = np.zeros((counts.shape[0], ny + 3))
+        cum[:, 1:] = np.cumsum(counts, axis=1)
+        proj = (cum[:, self.window_high + 1] - cum[:, self.window_low]).T[:, 1:-1]
+        total = proj.sum(axis=1)
+        nonempty = total > 0.
+        centers = self.xaxis.centers()
+        safe_total = np.where(nonempty, total, 1.)
+        mean = proj @ centers / safe_total
+        self.rms = np.where(nonempty,
+                            np.sqrt(np.maximum(proj @ centers**2 / safe_total - mean**2, 0.)),
+                            0.)
+        self.valid = found & (self.rms >= xbin_width/2.)
+        narrow = np.flatnonzero(found & ~self.valid)
+        if len(narrow):
+            print(f"Warning {len(narrow)} metric bins ({narrow.min()} to {narrow.max()}) "
+                  f"have an X projection narrower than half an X bin, no X estimates there")
+
+        # CDFs of the projections, shifted by the row index so that the
+        # rows can be searched all at once; unused rows are flat
+        self.cdf = np.ones((ny + 2, nx))
+        self.cdf[self.valid] = np.cumsum(proj[self.valid], axis=1) / total[self.valid, None]
+        self._shifted_cdf = (self.cdf + np.arange(ny + 2)[:, None]).ravel()
+
+    def estimate(self, metric_values, rng):
+        # Returns the X estimate and its RMS for every metric value. One
+        # random number is drawn per event, so a seeded rng gives the same
+        # result for the same events.
+        nx = self.xaxis.nbins
+        ybins = self.yaxis.find_bin(metric_values)
+        r = rng.random(len(ybins))
+        hypo_x = np.full(len(ybins), -10.)
+        hypo_rms = np.full(len(ybins), self.drift_distance)
+
+        valid = self.valid[ybins]
+        rows, r = ybins[valid], r[valid]
+        # same as TH1::GetRandom
+        ib = np.searchsorted(self._shifted_cdf, rows + r, side='right') - rows*nx
+        ib = np.clip(ib, 0, nx - 1)
+        cdf_high = self.cdf[rows, ib]
+        cdf_low = np.where(ib > 0, self.cdf[rows, np.maximum(ib - 1, 0)], 0.)
+        frac = (r - cdf_low) / np.where(cdf_high > cdf_low, cdf_high - cdf_low, 1.)
+        hypo_x[valid] = self.xaxis.low + self.xaxis.width * (ib + frac)
+        hypo_rms[valid] = self.rms[rows]
+        return hypo_x, hypo_rms
+
+
+def hypo_flashx(rr_x, rr_rms, ratio_x, ratio_rms):
+    # Vectorized hypo_flashx_from_H2()
+    drr2 = rr_rms * rr_rms
+    dratio2 = ratio_rms * ratio_rms
+    sum_weights = 1./drr2 + 1./dratio2
+    hypo_x = (rr_x/drr2 + ratio_x/dratio2) / sum_weights
+    # consistent estimates, resulting error is smaller
+    hypo_x_err = np.sqrt(1. / sum_weights)
+    # inconsistent estimates, resulting error is larger
+    inconsistent = np.abs(rr_x - ratio_x) > 2.*np.sqrt(drr2 + dratio2)
+    hypo_x_err[inconsistent] = np.sqrt(drr2 + dratio2)[inconsistent]
+    no_estimate = sum_weights < 0.0002
+    hypo_x[no_estimate] = -10.
+    hypo_x_err[no_estimate] = -10.
+    return hypo_x, hypo_x_err
+
+
+def sig_fig_round(number, digits=3):
+    power = "{:e}".format(number).split('e')[1]
+    return round(number, -(int(power) - digits))
+
+
+def polynomial_degree(fit_func):
+    # degree of a ROOT "polN" formula
+    match = re.fullmatch(r"\s*pol(\d+)\s*", fit_func)
+    if match is None:
+        raise ValueError(f"Only polN correction functions can be fitted, not {fit_func}")
+    return int(match.group(1))
+
+
+def profile_errors(prof, approximate=False):
+    # TProfile::GetBinError of the inner bins of a 1D binned_stats profile,
+    # with the default error option (error on the mean). A bin with a single
+    # entry (or equal values) has no spread, so its error is 0, as in ROOT,
+    # unless approximate: then, as with TProfile::Approximate(), it gets
+    # twice the spread of the whole profile.
+    sumw = prof.inner(prof.sumw)
+    sumw2 = prof.inner(prof.sumw2)
+    sumwv = prof.inner(prof.sumwv)
+    sumwv2 = prof.inner(prof.sumwv2)
+    filled = sumw != 0
+    safe_sumw = np.where(filled, sumw, 1.)
+    eprim2 = np.abs(sumwv2/safe_sumw - (sumwv/safe_sumw)**2)
+    eprim = np.sqrt(eprim2)
+    neff = np.divide(sumw**2, sumw2, out=np.zeros(sumw.shape), where=sumw2 > 0)
+    if approximate:
+        test = np.ones(sumw.shape)
+        low_neff = (sumwv2 != 0) & (neff < 5)
+        test[low_neff] = eprim2[low_neff]*sumw[low_neff]/sumwv2[low_neff]
+        ssum = sumw.sum()
+        seprim2 = np.abs(sumwv2.sum()/ssum - (sumwv.sum()/ssum)**2)
+        eprim = np.where((test < 1.e-4) | (eprim2 <= 0), 2*np.sqrt(seprim2), eprim)
+    errors = np.divide(eprim, np.sqrt(neff), out=np.zeros(sumw.shape), where=neff > 0)
+    return np.where(filled, errors, 0.)
+
+
+def fit_polynomial(prof, degree, approximate=False):
+    # Weighted least squares fit of a polynomial to a 1D binned_stats
+    # profile, like TProfile::Fit: the bin means at the bin centers with the
+    # errors of profile_errors(), skipping the bins with no error as the
+    # chi2 fit of ROOT does.
+    # Returns the coefficients (lowest order first) and their covariance.
+    means = prof.inner(prof.means())
+    errors = profile_errors(prof, approximate)
+    used = errors > 0
+    if used.sum() <= degree:
+        raise ValueError(f"Not enough filled bins to fit a pol{degree}")
+
+    vander = np.polynomial.polynomial.polyvander(prof.axes[0].centers()[used], degree)
+    a = vander / errors[used, None]
+    b = means[used] / errors[used]
+    coeffs = np.linalg.lstsq(a, b, rcond=None)[0]
+    cov = np.linalg.pinv(a.T @ a)
+    return coeffs, cov
+
+
+def correction_fitter(prof, var, fit_func, digits=3):
+    # NumPy counterpart of the ROOT fit of the correction profiles, with
+    # the coefficients rounded the same way
+    coeffs, cov = fit_polynomial(prof, polynomial_degree(fit_func))
+    errors = np.sqrt(np.diag(cov))
+    for i, (c, e) in enumerate(zip(coeffs, errors)):
+        print(f"  {var} p{i}: {c:.6g} +- {e:.3g}")
+    return [sig_fig_round(float(c), digits) for c in coeffs]
+
+
+def polynomial_correction(skew, hypo_x, pol_coeffs, skew_high_limit=10.):
+    # Vectorized polynomial_correction()
+    correction = np.polynomial.polynomial.polyval(hypo_x, pol_coeffs) * skew
+    no_correction = (np.abs(skew) > skew_high_limit) | np.isnan(skew) | np.isnan(hypo_x)
+    return np.where(no_correction, 0., correction)
+
+
+def tolerable_mask(cols, var, detector):
+    # HACK: Filter out from the fit the regions where discrepancy  is
+    # not as bad, to give more weight to the edges where there large discrepancy
+    if detector == "sbnd":
+        if var == "y":
+            return np.abs(cols['charge_y']) > 60.
+        return (cols['charge_z'] < 120.) | (380. < cols['charge_z'])
+    elif detector == "icarus":
+        if var == "y":
+            return (cols['charge_y'] < -65.) | (19. < cols['charge_y'])
+        return (cols['charge_z'] < -800.) | (800. < cols['charge_z'])
+    return np.ones(len(cols['charge_' + var]), dtype=bool)
+
+
+def correction_fit_mask(cols, new_hypo_x, var, params, x_low, x_up,
+                        beam_spill_time_end, skew_high_limit=10., skew_low_limit=0.05):
+    # Same filters as the TTree::Draw selection of parameters_correction_fitter()
+    skew = np.abs(cols[var + '_skew'])
+    dt = cols['flash_time'] - params.time_delay - cols['mcT0']
+    return ((skew > skew_low_limit) & (skew < skew_high_limit) &
+            (cols['is_nu'] == 1) & (cols['slices'] == 1) &
+            (0. <= cols['mcT0']) & (cols['mcT0'] <= beam_spill_time_end) &
+            (dt >= 0.) & (dt <= params.tolerable_time_diff) &
+            (cols['charge_x'] >= x_low) & (cols['charge_x'] <= x_up) &
+            (new_hypo_x >= 0.) &
+            tolerable_mask(cols, var, params.detector))
+
+
+# metrics in the 1D and 3D scores
+SCORE_METRICS = ['dy', 'dz', 'ratio', 'petoq']
+SCORE_3D_METRICS = ['dy', 'dz', 'rr', 'ratio', 'petoq']
+
+
+def bad_cells(md, names=SCORE_3D_METRICS):
+    # 3D cells without a spread (empty, or a single entry), where the 3D
+    # score can not be computed. Returns a mask over the (x, y, z) cells.
+    bad = np.zeros(md[names[0]].spreads3.shape, dtype=bool)
+    for name in names:
+        bad_metric = ~(md[name].spreads3 > 0.)
+        if bad_metric.any():
+            print(f"Warning {name}: {bad_metric.sum()} of {bad_metric.size} 3D cells "
+                  "have no spread, events in them get no 3D score")
+        bad |= bad_metric
+    return bad
+
+
+def match_scores(cols, md, new_flash_y, new_flash_z, xbin_width, bad=None):
+    # Match scores of all events, from the dense means and spreads of the
+    # metrics (the means/spreads and means3/spreads3 arrays of md).
+    # The 3D score is NaN for the events in bad cells.
+    values = {'dy': new_flash_y - cols['charge_y'],
+              'dz': new_flash_z - cols['charge_z'],
+              'rr': cols['flash_rr'],
+              'ratio': cols['flash_ratio'],
+              'petoq': cols['petoq']}
+
+    # 1D score, using the means and spreads at the charge X bin
+    nx = len(md['dy'].means)
+    isl = np.clip((cols['charge_x'] / xbin_width).astype(np.int64), 0, nx - 1)
+    score = np.zeros(len(isl))
+    for name in SCORE_METRICS:
+        score += (np.abs(values[name] - np.asarray(md[name].means)[isl]) /
+                  np.asarray(md[name].spreads)[isl])
+
+    # 3D score, using the 3D profiles at the charge (X, Y, Z) cell;
+    # events outside the profiles use the closest cell
+    cells = tuple(np.clip(np.digitize(c, e) - 1, 0, len(e) - 2) for c, e in
+                  zip([cols['charge_x'], cols['charge_y'], cols['charge_z']], md['dy'].edges3))
+    if bad is None:
+        bad = bad_cells(md)
+    bad_events = bad[cells]
+    score_3D = np.zeros(len(isl))
+    for name in SCORE_3D_METRICS:
+        spread = np.where(bad_events, 1., md[name].spreads3[cells])
+        score_3D += np.abs(values[name] - md[name].means3[cells]) / spread
+    score_3D[bad_events] = np.nan
+    return score, score_3D
+
+
+class columnar_templates:
+    # The steps of generator() as separate stages, each a pass over a chain
+    # of NumPy column chunks (a nuslice_chain, or any other iterable of
+    # column dicts that can be iterated more than once, e.g. [cols]):
+    #   x_estimate: rr and ratio metrics, for the flash X estimates
+    #   correction: profiles for the fits of the polynomial corrections
+    #   metrics:    the other metrics, with the corrected flash Y and Z
+    # Only one chunk is in memory; the derived columns of a chunk are
+    # recomputed when needed, with the same random numbers.
+    #
+    # The statistics filled in a stage are sums, so a stage can be run on
+    # shards of the sample, each starting from the state of the previous
+    # stage, and the shards merged before finishing the stage.
+    #
+    # With nboot > 0 the metric profiles are also filled for nboot Poisson
+    # bootstrap replicas, in the same pass. The X estimates and the
+    # corrections are those of the nominal sample in all replicas.
+    STAGES = ['x_estimate', 'correction', 'metrics']
+    STAGE_METRICS = {'x_estimate': ['rr', 'ratio'], 'correction': [],
+                     'metrics': ['dy', 'dz', 'slope', 'petoq']}
+    CORRECTIONS = ['y', 'z']
+
+    def __init__(self, pset, params, seed=None, shard=0, nboot=0):
+        self.pset = pset
+        self.params = params
+        self.shard = shard
+        self.nboot = nboot
+        # the same seed is needed in all the stages, keep its entropy
+        self.entropy = np.random.SeedSequence(seed).entropy
+        self.beam_spill_time_end = pset.BeamSpillTimeEnd - pset.BeamSpillTimeStart
+        self.md = {name: columnar_metric(name, pset, nboot) for name in METRICS}
+        self.fit_profs = {var: binned_stats([regular_axis(pset.XBins, 0., pset.DriftDistance)])
+                          for var in self.CORRECTIONS}
+        self.pol_coeffs = None
+        self.lookups = None
+        self.stage = None  # last stage filled
+        self.finished = False  # whether it is finished
+
+    def rng(self, ichunk):
+        # Independent random stream for each chunk of each shard
+        return np.random.default_rng(np.random.SeedSequence(self.entropy,
+                                                            spawn_key=(self.shard, ichunk)))
+
+    def replica_weights(self, chunk, ichunk):
+        # Poisson(1) weights of the events of a chunk in each bootstrap
+        # replica, from their own stream so the templates do not change
+        if not self.nboot:
+            return None
+        rng = np.random.default_rng(np.random.SeedSequence(self.entropy,
+                                                           spawn_key=(self.shard, ichunk, 1)))
+        # small integers, kept small in memory
+        return rng.poisson(1., size=(len(chunk['charge_x']), self.nboot)).astype(np.uint8)
+
+    def stage_stats(self, stage):
+        stats = {f"{name}.{k}": st for name in self.STAGE_METRICS[stage]
+                 for k, st in self.md[name].stats().items()}
+        if stage == 'correction':
+            stats.update({f"fit_{var}": self.fit_profs[var] for var in self.CORRECTIONS})
+        return stats
+
+    def fill(self, stage, chain):
+        # Run a stage on the chain. The stages before it must be finished.
+        if stage == 'x_estimate':
+            # fill rr_h2 and ratio_h2 first, with all the events
+            for ichunk, chunk in enumerate(chain):
+                qx, qy, qz = chunk['charge_x'], chunk['charge_y'], chunk['charge_z']
+                rw = self.replica_weights(chunk, ichunk)
+                self.md['rr'].fill(qx, qy, qz, chunk['flash_rr'], rw)
+                self.md['ratio'].fill(qx, qy, qz, chunk['flash_ratio'], rw)
+        elif stage == 'correction':
+            for ichunk, chunk in enumerate(chain):
+                new_hypo_x = self.hypo_columns(chunk, ichunk)['new_hypo_x']
+                for var in self.CORRECTIONS:
+                    mask = correction_fit_mask(chunk, new_hypo_x, var, self.params,
+                                               0., self.pset.DriftDistance,
+                                               self.beam_spill_time_end,
+                                               self.pset[f'SkewLimit{var.upper()}'])
+                    fit_y = ((chunk[f'flash_{var}b'][mask] - chunk[f'charge_{var}'][mask]) /
+                             chunk[f'{var}_skew'][mask])
+                    self.fit_profs[var].fill([new_hypo_x[mask]], fit_y)
+        elif stage == 'metrics':
+            # Use the new corrected terms to fill the rest of H2s and Profs
+            for ichunk, chunk in enumerate(chain):
+                derived = self.derived_columns(chunk, ichunk)
+                good = quality_mask(chunk, self.beam_spill_time_end, self.params.drift_distance)
+                gx, gy, gz = chunk['charge_x'][good], chunk['charge_y'][good], chunk['charge_z'][good]
+                rw = self.replica_weights(chunk, ichunk)
+                rw = rw[good] if rw is not None else None
+                self.md['dy'].fill(gx, gy, gz, derived['new_flash_y'][good] - gy, rw)
+                self.md['dz'].fill(gx, gy, gz, derived['new_flash_z'][good] - gz, rw)
+                self.md['slope'].fill(gx, gy, gz, chunk['flash_xw'][good], rw)
+                self.md['petoq'].fill(gx, gy, gz, chunk['petoq'][good], rw)
+        self.stage = stage
+        self.finished = False
+
+    def merge(self, other):
+        # Add up the statistics of the stage filled in another shard
+        assert self.stage == other.stage and self.entropy == other.entropy
+        assert not (self.finished or other.finished)
+        for key, st in self.stage_stats(self.stage).items():
+            st.merge(other.stage_stats(other.stage)[key])
+        return self
+
+    def finish(self, stage, fitter=correction_fitter):
+        # What follows a stage, once the stage is filled with all events
+        if stage == 'x_estimate':
+            # Use rr_h2 and ratio_h2 to compute flash drift distance estimates
+            self.lookups = {name: x_projection_lookup(self.md[name].h2, self.params.xbin_width,
+                                                      self.params.drift_distance)
+                            for name in ['rr', 'ratio']}
+        elif stage == 'correction':
+            self.pol_coeffs = {var: fitter(self.fit_profs[var], var,
+                                           self.pset[f'fit_func_{var}'])
+                               for var in self.CORRECTIONS}
+            if self.params.detector == "icarus":
+                self.pol_coeffs['z'] = [0.]  # No Z corrections for ICARUS
+        elif stage == 'metrics':
+            for m in self.md.values():
+                m.update_metrics(self.params.get('min_entries3', 0))
+        self.finished = True
+
+    def hypo_columns(self, chunk, ichunk):
+        rng = self.rng(ichunk)
+        derived = {}
+        derived['new_hypo_x_rr'], derived['new_hypo_x_rr_err'] = \
+            self.lookups['rr'].estimate(chunk['flash_rr'], rng)
+        derived['new_hypo_x_ratio'], derived['new_hypo_x_ratio_err'] = \
+            self.lookups['ratio'].estimate(chunk['flash_ratio'], rng)
+        derived['new_hypo_x'], derived['new_hypo_x_err'] = hypo_flashx(
+            derived['new_hypo_x_rr'], derived['new_hypo_x_rr_err'],
+            derived['new_hypo_x_ratio'], derived['new_hypo_x_ratio_err'])
+        return derived
+
+    def derived_columns(self, chunk, ichunk):
+        # Using the new estimation new_hypo_x, and the fitted polynomial
+        # coefficients; get the corrected new_flash_y and new_flash_z
+        derived = self.hypo_columns(chunk, ichunk)
+        derived['new_flash_y'] = chunk['flash_yb'] - polynomial_correction(
+            chunk['y_skew'], derived['new_hypo_x'], self.pol_coeffs['y'], self.pset.SkewLimitY)
+        derived['new_flash_z'] = chunk['flash_zb'] - polynomial_correction(
+            chunk['z_skew'], derived['new_hypo_x'], self.pol_coeffs['z'], self.pset.SkewLimitZ)
+        return derived
+
+    def scores(self, chain, chunk_callback):
+        # chunk_callback(chunk, derived, scores) gets the final columns of
+        # each chunk
+        bad = bad_cells(self.md)
+        n_bad = 0
+        for ichunk, chunk in enumerate(chain):
+            derived = self.derived_columns(chunk, ichunk)
+            score, score_3D = match_scores(chunk, self.md, derived['new_flash_y'],
+                                           derived['new_flash_z'], self.params.xbin_width, bad)
+            n_bad += np.isnan(score_3D).sum()
+            chunk_callback(chunk, derived, {'score': score, 'score_3D': score_3D})
+        if n_bad:
+            print(f"Warning {n_bad} events in 3D cells without spread have no 3D score")
+
+    def save(self, filename):
+        # all the statistics of the stages filled so far, and the fit results
+        d = {}
+        for stage in self.STAGES[:self.STAGES.index(self.stage) + 1]:
+            for key, st in self.stage_stats(stage).items():
+                d.update(st.to_dict(key))
+        if self.pol_coeffs is not None:
+            d.update({f"pol_coeffs_{var}": np.asarray(c) for var, c in self.pol_coeffs.items()})
+        np.savez_compressed(filename, stage=self.stage, finished=self.finished,
+                            entropy=str(self.entropy), nboot=self.nboot, **d)
+
+    @classmethod
+    def load(cls, filename, pset, params, shard=0):
+        # Loads a saved state. The finished stages are finished again, which
+        # needs no fit since the coefficients are saved.
+        with np.load(filename) as f:
+            d = {k: f[k] for k in f.files}
+        templates = cls(pset, params, int(str(d['entropy'])), shard, int(d['nboot']))
+        templates.stage = str(d['stage'])
+        for stage in cls.STAGES[:cls.STAGES.index(templates.stage) + 1]:
+            for key, st in templates.stage_stats(stage).items():
+                st.from_dict(d, key)
+        if 'pol_coeffs_y' in d:
+            templates.pol_coeffs = {var: d[f"pol_coeffs_{var}"].tolist() for var in cls.CORRECTIONS}
+        nfinished = cls.STAGES.index(templates.stage) + bool(d['finished'])
+        for stage in cls.STAGES[:nfinished]:
+            if stage != 'correction':
+                templates.finish(stage)
+        templates.finished = bool(d['finished'])
+        return templates
+
+
+def columnar_generator(chain, pset, params, seed, fitter=correction_fitter, chunk_callback=None,
+                       nboot=0):
+    # All the steps of generator() on one chain. fitter(profile, var,
+    # fit_func) fits the polynomial correction coefficients to a
+    # binned_stats profile. Returns the metrics and the correction
+    # coefficients.
+    templates = columnar_templates(pset, params, seed, nboot=nboot)
+    for stage in columnar_templates.STAGES:
+        templates.fill(stage, chain)
+        templates.finish(stage, fitter)
+    if chunk_callback is not None:
+        templates.scores(chain, chunk_callback)
+    return templates.md, templates.pol_coeffs
+
+
+# Flat template files: the templates FlashPredict reads from the metrics
+# file, as plain arrays in an uncompressed npz. Each array is a .npy
+# stored as it is in the zip, so a reader can map it from the file (see
+# read_flat_templates(mapped=True)) and find bins with arithmetic on the
+# regular edges.
+# The arrays are named "<flash type>/<name>", with for each flash type:
+#   x_edges, <metric>_mean, <metric>_spread   as the <metric>_h1
+#   <metric>_entries                         of the <metric>_prof
+#   edges3_x, edges3_y, edges3_z,
+#   <metric>_index3                          leaf of each (x, y, z) cell of
+#                                            the <metric>_prof3, -1 if empty
+#   <metric>_mean3, <metric>_spread3,
+#   <metric>_entries3                        of each leaf
+#   rr_h2, ratio_h2                          with under/overflow, (x, metric)
+#   rr_edges, ratio_edges                    the metric axis of the H2s
+#   pol_coeffs_y, pol_coeffs_z
+# plus "detector", "format_version" and "checksum", the SHA-256 of all
+# the other arrays. The leaves are the merged cells of adaptive_profile3,
+# or the non-empty cells themselves.
+def flat_checksum(arrays):
+    sha = hashlib.sha256()
+    for key in sorted(arrays):
+        a = np.ascontiguousarray(arrays[key])
+        sha.update(f"{key}:{a.dtype.str}:{a.shape}:".encode())
+        sha.update(a.tobytes())
+    return sha.hexdigest()
+
+
+def write_flat_templates(filename, arrays):
+    np.savez(filename, format_version=np.array(FLAT_FORMAT_VERSION),
+             checksum=np.array(flat_checksum(arrays)), **arrays)
+
+
+def read_flat_templates(filename, verify=True, mapped=False):
+    # With mapped, the arrays are read-only views of the mapped file
+    if mapped:
+        arrays = map_npz(filename)
+    else:
+        with np.load(filename) as f:
+            arrays = {k: f[k] for k in f.files}
+    version = int(arrays.pop('format_version'))
+    checksum = str(arrays.pop('checksum'))
+    if version != FLAT_FORMAT_VERSION:
+        raise ValueError(f"{filename} has flat template format {version}, "
+                         f"expected {FLAT_FORMAT_VERSION}")
+    if verify and flat_checksum(arrays) != checksum:
+        raise ValueError(f"{filename} is corrupted, its checksum does not match")
+    return arrays
+
+
+def map_npz(filename):
+    # np.load() reads the arrays of an npz into memory whatever its
+    # mmap_mode, so find each stored .npy in the zip and map it here
+    arrays = {}
+    with open(filename, 'rb') as f, zipfile.ZipFile(f) as z:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} in {filename} is compressed, it cannot be mapped")
+            # the member follows its local header, whose extra field can
+            # differ from the one in the central directory
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran_order, dtype = read_header(f)
+            a = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=f.tell())
+            arrays[info.filename.removesuffix('.npy')] = a.reshape(
+                shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+def dense_index(entries3):
+    # every non-empty cell a leaf of its own
+    index = np.full(entries3.shape, -1, dtype=np.int32)
+    filled = entries3 > 0
+    index[filled] = np.arange(filled.sum())
+    return index
+
+
+def flat_leaves(index, *dense):
+    # the values of each leaf of index, from dense arrays with the values
+    # of its leaf in every cell
+    leaves, first = np.unique(index.ravel(), return_index=True)
+    first = first[leaves >= 0]
+    return [d.ravel()[first] for d in dense]
+
+
+def flat_lookup3(arrays, name, x, y, z):
+    # leaf of the 3D template of a metric at each (x, y, z), -1 where it is
+    # empty. arrays are the flat templates of one flash type, without the
+    # "<flash type>/" in their names.
+    return arrays[f"{name}_index3"][flat_bin(arrays['edges3_x'], x),
+                                    flat_bin(arrays['edges3_y'], y),
+                                    flat_bin(arrays['edges3_z'], z)]
+
+
+def flat_arrays(x_edges, edges3, pol_coeffs, metrics):
+    # The flat templates of one flash type, without the "<flash type>/" in
+    # their names. metrics has a dict of arrays for each metric: mean,
+    # spread and entries along X, mean3, spread3 and entries3 of every 3D
+    # cell, index3 of the leaves (None for a leaf per non-empty cell) and,
+    # for rr and ratio, h2 and the edges of its metric axis.
+    arrays = {"x_edges": x_edges,
+              "edges3_x": edges3[0], "edges3_y": edges3[1], "edges3_z": edges3[2],
+              "pol_coeffs_y": np.asarray(pol_coeffs['y'], dtype=np.float64),
+              "pol_coeffs_z": np.asarray(pol_coeffs['z'], dtype=np.float64)}
+    for name, m in metrics.items():
+        index = m['index3'] if m['index3'] is not None else dense_index(m['entries3'])
+        means3, spreads3, entries3 = flat_leaves(index, m['mean3'], m['spread3'], m['entries3'])
+        arrays.update({f"{name}_mean": m['mean'], f"{name}_spread": m['spread'],
+                       f"{name}_entries": m['entries'],
+                       f"{name}_index3": index, f"{name}_mean3": means3,
+                       f"{name}_spread3": spreads3, f"{name}_entries3": entries3})
+        if name in ['rr', 'ratio']:
+            arrays[f"{name}_h2"] = m['h2']
+            arrays[f"{name}_edges"] = m['edges']
+    return arrays
+
+
+def columnar_flat_arrays(md, pol_coeffs):
+    # The flat templates of one flash type from the columnar metrics
+    metrics = {}
+    for name, m in md.items():
+        metrics[name] = {'mean': m.prof.inner(m.prof.means()),
+                         'spread': m.prof.inner(m.prof.spreads()),
+                         'entries': m.prof.inner(m.prof.sumw),
+                         'mean3': m.means3, 'spread3': m.spreads3, 'entries3': m.entries3,
+                         'index3': m.adaptive3.index if m.adaptive3 is not None else None,
+                         'h2': m.h2.sumw, 'edges': m.vaxis.edges()}
+    m = next(iter(md.values()))
+    return flat_arrays(m.xaxis.edges(), m.edges3, pol_coeffs, metrics)
+
+
+def flat_bin(edges, values):
+    # bin of values in the regular edges, from 0; out of range values are
+    # in the first or last bin
+    nbins = len(edges) - 1
+    ib = np.floor(nbins*(np.asarray(values) - edges[0])/(edges[-1] - edges[0]))
+    return np.clip(np.nan_to_num(ib, nan=nbins - 1), 0, nbins - 1).astype(np.intp)
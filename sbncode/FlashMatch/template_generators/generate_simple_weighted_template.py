@@ -9,15 +9,25 @@
 #
 # Usage:
 #
-# generate_simple_weighted_template.py (--sbnd | --icarus) file
+# generate_simple_weighted_template.py (--sbnd | --icarus) file [file ...]
 #
 # Options:
 #
 # [-h|--help] - Print help message.
 # (--sbnd or --icarus) to select for which experiment generate metrics
+# [--no-plots] - Do not make the diagnostic plots.
 # Arguments:
 #
-# file  ... - Input file.
+# file  ... - Input files.
+#
+# Map-reduce over many files, with the columnar engine. Each stage is
+# mapped over shards of the files, each with a different --shard, and the
+# shards reduced before the next stage. The last reduce writes the metrics:
+#
+# generate_simple_weighted_template.py --sbnd --map x_estimate --seed S --shard I -o shardI files ...
+# generate_simple_weighted_template.py --sbnd --reduce -o state shard0 shard1 ...
+# generate_simple_weighted_template.py --sbnd --map correction --state state --shard I -o shardI files ...
+# ...
 #
 ######################################################################
 
@@ -25,15 +35,17 @@ import sys
 import os
 import string
 import argparse
+import multiprocessing
 import numpy as np
-from time import sleep
 from array import array
 
 from ROOT import TStyle, TCanvas, TColor, TGraph, TGraphErrors
-from ROOT import TH1D, TH2D, TProfile, TProfile3D, TFile, TF1
-from ROOT import gROOT, TList, TTree, TDirectoryFile
+from ROOT import TH1D, TH2D, TH3D, TH3I, TProfile, TProfile3D, TFile, TF1
+from ROOT import gROOT, TList, TTree, TChain, TDirectoryFile
 import ROOT
 
+import flashmatch_columnar as fmc
+
 try:
     # import project_utilities
     import larbatch_posix
@@ -72,7 +84,8 @@ class metrics_stuff:
         self.z_bins  = pset.z_bins
         self.z_low   = pset.z_low
         self.z_up    = pset.z_up
-        self.xvals   = np.arange(xbin_width/2., drift_distance, xbin_width)
+        xbin_width   = pset.DriftDistance/pset.XBins
+        self.xvals   = np.arange(xbin_width/2., pset.DriftDistance, xbin_width)
         self.xerrs   = np.array([xbin_width/2.] * len(self.xvals))
         self.bins    = int(pset[name]['bins'])
         self.low     = pset[name]['low']
@@ -91,6 +104,18 @@ class metrics_stuff:
                                   # self.low, self.up,
                                   profile_option)
         self.h1      = TH1D(name+"_h1", "", self.x_bins, self.x_low, self.x_up)
+        self.edges3  = [np.linspace(self.x_low, self.x_up, self.x_bins_+1),
+                        np.linspace(self.y_low, self.y_up, self.y_bins+1),
+                        np.linspace(self.z_low, self.z_up, self.z_bins+1)]
+        self.means3   = None
+        self.spreads3 = None
+        self.entries3 = None
+        self.errs     = []  # bootstrap uncertainties
+        # merged cells of the 3D profile: the leaf of each cell, and the
+        # leaves3 profile and index3 histogram that replace the prof3
+        self.index3   = None
+        self.leaves3  = None
+        self.index3_h = None
 
     def update_metrics(self):
         # fill histograms for match score calculation from profile histograms
@@ -105,81 +130,201 @@ class metrics_stuff:
                       f"index: {ib}. spread: {self.spreads[ib]} \n",
                       "Setting to 0.001")
                 self.spreads[ib] = 0.001
+        # dense copies of the 3D profile, for the match scores
+        self.means3, self.spreads3, self.entries3 = profile_arrays(
+            self.prof3, (self.x_bins_, self.y_bins, self.z_bins))
+
+    def load_columnar(self, cm):
+        # fill the histograms from the binned sums of the columnar engine
+        set_hist_contents(self.h2, cm.h2)
+        set_profile_contents(self.prof, cm.prof)
+        set_profile_contents(self.prof3, cm.prof3)
+        self.update_metrics()
+        if cm.adaptive3 is not None:
+            self.load_leaves(cm)
+        if cm.boot is not None:
+            for what, errs in [('mean', cm.mean_errs), ('spread', cm.spread_errs)]:
+                h = TH1D(f"{self.name}_{what}_err", "", self.x_bins, self.x_low, self.x_up)
+                set_error_contents(h, errs)
+                self.errs.append(h)
+            for what, errs in [('mean', cm.mean_errs3), ('spread', cm.spread_errs3)]:
+                h = TH3D(f"{self.name}_{what}_err3", "",
+                         self.x_bins_, self.x_low, self.x_up,
+                         self.y_bins, self.y_low, self.y_up,
+                         self.z_bins, self.z_low, self.z_up)
+                set_error_contents(h, errs)
+                self.errs.append(h)
+
+    def load_leaves(self, cm):
+        # the merged cells of the columnar metric cm, with its dense
+        # arrays for the match scores, every cell with its leaf
+        adaptive3 = cm.adaptive3
+        self.means3, self.spreads3, self.entries3 = cm.means3, cm.spreads3, cm.entries3
+        self.index3 = adaptive3.index
+        nbins = adaptive3.leaves.axes[0].nbins
+        self.leaves3 = TProfile(self.name+"_leaves3", "", nbins, 0., nbins,
+                                self.prof3.GetErrorOption())
+        set_profile_contents(self.leaves3, adaptive3.leaves)
+        # the bin of its leaf in leaves3, 0 for empty cells
+        self.index3_h = TH3I(self.name+"_index3", "",
+                             self.x_bins_, self.x_low, self.x_up,
+                             self.y_bins, self.y_low, self.y_up,
+                             self.z_bins, self.z_low, self.z_up)
+        cells = root_array(self.index3_h.GetArray(), self.index3_h.GetNcells(), np.int32)
+        cells.reshape((self.x_bins_ + 2, self.y_bins + 2, self.z_bins + 2),
+                      order='F')[1:-1, 1:-1, 1:-1] = self.index3 + 1
 
     def write_metrics(self):
         self.h2.Write()
         self.prof.Write()
-        self.prof3.Write()
+        if self.index3 is None:
+            self.prof3.Write()
+        else:
+            self.leaves3.Write()
+            self.index3_h.Write()
         self.h1.Write()
+        for h in self.errs:
+            h.Write()
+
+    def flat_arrays(self):
+        # what FlashPredict reads of this metric, for fmc.flat_arrays()
+        means, spreads, entries = profile_arrays(self.prof, (self.x_bins,))
+        arrays = {'mean': means, 'spread': spreads, 'entries': entries,
+                  'mean3': self.means3, 'spread3': self.spreads3, 'entries3': self.entries3,
+                  'index3': self.index3}
+        if self.name in ['rr', 'ratio']:
+            arrays['h2'] = root_array(self.h2.GetArray(), self.h2.GetNcells()).reshape(
+                (self.x_bins + 2, self.bins + 2), order='F').copy()
+            arrays['edges'] = np.linspace(self.low, self.up, self.bins + 1)
+        return arrays
+
+    def plot_data(self):
+        # everything the diagnostic plots need, as arrays that can be
+        # sent to another process
+        shape = (self.x_bins + 2, self.bins + 2)
+        return dotDict(name=self.name,
+                       h2=root_array(self.h2.GetArray(), self.h2.GetNcells()).reshape(
+                           shape, order='F').copy(),
+                       h2_bins=(self.x_bins, self.x_low, self.x_up, self.bins, self.low, self.up),
+                       xvals=self.xvals, xerrs=self.xerrs,
+                       means=np.asarray(self.means, dtype=np.float64),
+                       spreads=np.asarray(self.spreads, dtype=np.float64),
+                       means3=self.means3, spreads3=self.spreads3, edges3=self.edges3)
+
+
+def root_array(buffer, n, dtype=np.float64):
+    # NumPy view of a ROOT array
+    buffer.reshape((n,))
+    return np.frombuffer(buffer, dtype=dtype, count=n)
+
+
+def set_hist_contents(hist, stats):
+    # ROOT cells have the X bin running fastest
+    hist.Reset()
+    root_array(hist.GetArray(), hist.GetNcells())[:] = stats.sumw.ravel(order='F')
+    hist.ResetStats()
+    hist.SetEntries(stats.entries)
+
+
+def set_profile_contents(prof, stats):
+    prof.Reset()
+    n = prof.GetNcells()
+    root_array(prof.GetArray(), n)[:] = stats.sumwv.ravel(order='F')
+    root_array(prof.GetSumw2().GetArray(), n)[:] = stats.sumwv2.ravel(order='F')
+    entries = stats.sumw.ravel(order='F')
+    for b in np.flatnonzero(entries):
+        prof.SetBinEntries(int(b), entries[b])
+    prof.ResetStats()
+    prof.SetEntries(stats.entries)
+
+
+def profile_arrays(prof, shape):
+    # means, spreads (option 's') and entries of the bins of a profile,
+    # without under/overflow, like GetBinContent, GetBinError and
+    # GetBinEntries of each bin
+    n = prof.GetNcells()
+    full = tuple(nb + 2 for nb in shape)
+    sumw = root_array(prof.GetW(), n).reshape(full, order='F')
+    sumwv = root_array(prof.GetArray(), n).reshape(full, order='F')
+    sumwv2 = root_array(prof.GetSumw2().GetArray(), n).reshape(full, order='F')
+    inner = tuple(slice(1, -1) for _ in shape)
+    sumw, sumwv, sumwv2 = sumw[inner], sumwv[inner], sumwv2[inner]
+    means = np.divide(sumwv, sumw, out=np.zeros(shape), where=sumw != 0)
+    sq = np.divide(sumwv2, sumw, out=np.zeros(shape), where=sumw != 0)
+    return means, np.sqrt(np.abs(sq - means*means)), sumw.copy()
+
+
+def render_metric_plots(data, filename):
+    # One multi-page PDF per metric: the (X, metric) H2 with the means and
+    # spreads, then the YZ maps of the means and of the spreads in each
+    # X bin. Takes the arrays of metrics_stuff.plot_data(), so that it can
+    # run in a worker process.
+    name = data.name
+    canv = TCanvas("canv")
+    canv.Print(filename + "[")
+    h2 = TH2D(name + "_h2_plot", "", *data.h2_bins)
+    root_array(h2.GetArray(), h2.GetNcells())[:] = data.h2.ravel(order='F')
+    h2.ResetStats()
+    h2.SetEntries(data.h2.sum())
+    h2.Draw()
+    crosses = TGraphErrors(len(data.xvals),
+                           array('f', data.xvals), array('f', data.means),
+                           array('f', data.xerrs), array('f', data.spreads))
+    crosses.SetLineColor(ROOT.kAzure+9)
+    crosses.SetLineWidth(3)
+    crosses.Draw("Psame")
+    canv.Print(filename)
+
+    ROOT.gStyle.SetPalette(104)
+    ROOT.gStyle.SetOptStat(0)
+    if name == "dy" or name == "dz":
+        zrange = np.abs(data.means3).max()
+        mean_range = (-1.*zrange, zrange)
+    else:
+        mean_range = (data.means3.min(), data.means3.max())
+    sprd_range = (0., data.spreads3.max())
+    xedges, yedges, zedges = data.edges3
+    for ixb in range(len(xedges) - 1):
+        xb = ixb + 1
+        for what, values, zrange in [("mean", data.means3[ixb], mean_range),
+                                     ("sprd", data.spreads3[ixb], sprd_range)]:
+            yzmap = TH2D(f"{name}_yzmap_{what}_xb_{xb}", f"{name}_yzmap_{what}_xb_{xb}",
+                         len(zedges) - 1, zedges[0], zedges[-1],
+                         len(yedges) - 1, yedges[0], yedges[-1])
+            # Z on the horizontal axis
+            root_array(yzmap.GetArray(), yzmap.GetNcells())[:] = \
+                np.pad(values.T, 1).ravel(order='F')
+            yzmap.GetZaxis().SetRangeUser(*zrange)
+            yzmap.Draw("colz")
+            canv.Print(filename)
+    canv.Print(filename + "]")
+    return filename
+
+
+def metric_plot_jobs(md, flash_type):
+    # the arguments of render_metric_plots() for all the metrics
+    return [(m.plot_data(), f"plots/{flash_type}/{m.name}.pdf") for m in md.values()]
+
+
+def flat_filename(metrics_filename):
+    return os.path.splitext(metrics_filename)[0] + ".npz"
+
+
+def write_flat_part(metrics_filename, md, pol_coeffs, params):
+    # The flat templates of one flash type, next to its metrics file
+    m = next(iter(md.values()))
+    arrays = fmc.flat_arrays(np.linspace(m.x_low, m.x_up, m.x_bins + 1), m.edges3, pol_coeffs,
+                             {name: m.flat_arrays() for name, m in md.items()})
+    fmc.write_flat_templates(flat_filename(metrics_filename),
+                             {params.ftype_long + "/" + k: a for k, a in arrays.items()})
+
+
+def set_error_contents(hist, errs):
+    # bootstrap uncertainties, 0 where all the replicas are empty
+    root_array(hist.GetArray(), hist.GetNcells())[:] = \
+        np.pad(np.nan_to_num(errs), 1).ravel(order='F')
+    hist.ResetStats()
 
-    def draw_metrics(self, canv, directory):
-        self.h2.Draw()
-        crosses = TGraphErrors(x_bins,
-                             array('f', self.xvals), array('f', self.means),
-                             array('f', self.xerrs), array('f', self.spreads))
-        crosses.SetLineColor(ROOT.kAzure+9)
-        crosses.SetLineWidth(3)
-        crosses.Draw("Psame")
-        canv.Print(directory.removesuffix("yzmaps") + f"{self.name}.pdf")
-        canv.Update()
-
-    def draw_3D(self, canv, directory):
-        ROOT.gStyle.SetPalette(104)
-        ROOT.gStyle.SetOptStat(0)
-        m_min =  1.e8
-        m_max = -1.e8
-        s_min =  1.e8
-        s_max = -1.e8
-        for xb in list(range(1, self.x_bins_+1)):
-            # get mins and maxes
-            for yb in list(range(1, self.y_bins+1)):
-                for zb in list(range(1, self.z_bins+1)):
-                    mean = self.prof3.GetBinContent(xb,yb,zb)
-                    sprd = self.prof3.GetBinError(xb,yb,zb)
-                    if mean < m_min: m_min = mean
-                    if mean > m_max: m_max = mean
-                    if sprd < s_min: s_min = sprd
-                    if sprd > s_max: s_max = sprd
-
-        for xb in list(range(1, self.x_bins_+1)):
-            yzmap_m = TH2D(f"{self.name}_yzmap_m_xb_{xb}",
-                           f"{self.name}_yzmap_mean_xb_{xb}",
-                           self.z_bins, self.z_low, self.z_up,
-                           self.y_bins, self.y_low, self.y_up)
-            if self.name == "dy" or self.name == "dz":
-                zrange = max(abs(m_min), abs(m_max))
-                yzmap_m.GetZaxis().SetRangeUser(-1.*zrange, zrange)
-            else:
-                yzmap_m.GetZaxis().SetRangeUser(m_min, m_max)
-            yzmap_s = TH2D(f"{self.name}_yzmap_s_xb_{xb}",
-                           f"{self.name}_yzmap_sprd_xb_{xb}",
-                           self.z_bins, self.z_low, self.z_up,
-                           self.y_bins, self.y_low, self.y_up)
-            yzmap_s.GetZaxis().SetRangeUser(0., s_max)
-
-            for yb in list(range(1, self.y_bins+1)):
-                y_row_means = ''
-                y_row_spdrs = ''
-                for zb in list(range(1, self.z_bins+1)):
-                    mean = self.prof3.GetBinContent(xb,yb,zb)
-                    sprd = self.prof3.GetBinError(xb,yb,zb)
-                    # y_row_means += str(f"{self.prof3.GetBinContent(xb,yb,zb):.1E}  ")
-                    y_row_means += str(f"{mean:.1E}+-{sprd:.1E}  ")
-                    yzmap_m.SetBinContent(zb, yb, mean)
-                    yzmap_s.SetBinContent(zb, yb, sprd)
-                # print(y_row_means)
-            yzmap_m.Draw("colz")
-            canv.Print(directory + f"/{self.name}_yzmap_mean_xb_{xb}.pdf")
-            canv.Update()
-            yzmap_s.Draw("colz")
-            canv.Print(directory + f"/{self.name}_yzmap_sprd_xb_{xb}.pdf")
-            canv.Update()
-        print(f"Finish printing 3D maps of {self.name}")
-
-
-def sig_fig_round(number, digits=3):
-    power = "{:e}".format(number).split('e')[1]
-    return round(number, -(int(power) - digits))
 
 # Globally turn off root warnings.
 # Don't let root see our command line options.
@@ -200,13 +345,18 @@ ROOT.gStyle.SetOptFit(1111)
 
 gROOT.SetBatch(True) # to not show plots
 
-detector = "experiment"
-drift_distance = 0.
-xbins = 0
-xbin_width = 0.
-time_delay = 0.
 tolerable_time_diff = 0.1
 
+
+def task_params(detector, pset, time_delay, min_entries3=0):
+    # Everything a flash type needs besides its pset
+    return dotDict(detector=detector, ftype_long=pset.FlashType,
+                   drift_distance=pset.DriftDistance, x_bins=pset.XBins,
+                   xbin_width=pset.DriftDistance/pset.XBins,
+                   time_delay=time_delay,
+                   tolerable_time_diff=tolerable_time_diff,
+                   min_entries3=min_entries3)
+
 # # Print help
 # def help():
 
@@ -228,72 +378,36 @@ tolerable_time_diff = 0.1
 
 
 
-def hypo_flashx_from_H2(flash_rr, rr_h2, flash_ratio, ratio_h2):
-    rr_hypoX, rr_hypoXRMS = x_estimate_and_rms(flash_rr, rr_h2);
-    ratio_hypoX, ratio_hypoXRMS = x_estimate_and_rms(flash_ratio, ratio_h2);
+def x_lookup_from_H2(metric_h2, params):
+    # Flash X lookup (see flashmatch_columnar.x_projection_lookup) from the
+    # contents of a TH2
+    xaxis, yaxis = metric_h2.GetXaxis(), metric_h2.GetYaxis()
+    stats = fmc.binned_stats([fmc.regular_axis(xaxis.GetNbins(), xaxis.GetXmin(), xaxis.GetXmax()),
+                              fmc.regular_axis(yaxis.GetNbins(), yaxis.GetXmin(), yaxis.GetXmax())])
+    stats.sumw[:] = root_array(metric_h2.GetArray(),
+                               metric_h2.GetNcells()).reshape(stats.shape, order='F')
+    return fmc.x_projection_lookup(stats, params.xbin_width, params.drift_distance)
 
-    drr2 = rr_hypoXRMS * rr_hypoXRMS;
-    dratio2 = ratio_hypoXRMS * ratio_hypoXRMS;
-    rr_hypoXWgt = 1./drr2;
-    ratio_hypoXWgt = 1./dratio2;
 
-    sum_weights = rr_hypoXWgt + ratio_hypoXWgt
-    if sum_weights < 0.0002: return (-10., -10., rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS)
-    hypo_x = (rr_hypoX*rr_hypoXWgt + ratio_hypoX*ratio_hypoXWgt) / sum_weights
-    # consistent estimates, resulting error is smaller
-    hypo_x_err = np.sqrt( 1. / sum_weights)
-    if np.abs(rr_hypoX - ratio_hypoX) > 2.*np.sqrt(drr2+dratio2):
-        # inconsistent estimates, resulting error is larger
-        hypo_x_err = np.sqrt(drr2 + dratio2)
+def hypo_flashx_from_H2(flash_rr, rr_h2, flash_ratio, ratio_h2, params, rng):
+    # Flash drift distance estimates for all the events at once
+    rr_hypoX, rr_hypoXRMS = x_lookup_from_H2(rr_h2, params).estimate(flash_rr, rng)
+    ratio_hypoX, ratio_hypoXRMS = x_lookup_from_H2(ratio_h2, params).estimate(flash_ratio, rng)
+    hypo_x, hypo_x_err = fmc.hypo_flashx(rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS)
     return (hypo_x, hypo_x_err, rr_hypoX, rr_hypoXRMS,
             ratio_hypoX, ratio_hypoXRMS)
 
 
-def x_estimate_and_rms(metric_value, metric_h2):
-    kMinEntriesInProjection = 100
-    bin_ = metric_h2.GetYaxis().FindBin(metric_value);
-    bins = metric_h2.GetNbinsY();
-    metric_hypoX = -1.;
-    bin_buff = 0;
-    while 0 < bin_-bin_buff or bin_+bin_buff <= bins :
-        low_bin = bin_-bin_buff if 0 < bin_-bin_buff else 0
-        high_bin = bin_+bin_buff if bin_+bin_buff <= bins else -1
-        metric_px = metric_h2.ProjectionX("metric_px", low_bin, high_bin);
-        if metric_px.GetEntries() > kMinEntriesInProjection :
-            metric_hypoX = metric_px.GetRandom();
-            metric_rmsX = metric_px.GetRMS();
-            if metric_rmsX < xbin_width/2.: # something went wrong
-                print(f"{metric_h2.GetName()} projected on metric_value: {metric_value}, "
-                      f"bin: {bin_}, bin_buff: {bin_buff}; has {metric_px.GetEntries()} entries.")
-                print(f"  metric_hypoX: {metric_hypoX}, metric_rmsX: {metric_rmsX}")
-                return (-10., drift_distance); # no estimate
-            return (metric_hypoX, metric_rmsX);
-        bin_buff += 1;
-    return (-10., drift_distance); # no estimate
-
-
-def quality_checks(e, beam_spill_time_end):
+def quality_checks(e, beam_spill_time_end, params):
     if e.slices != 1: return False
     if e.is_nu != 1: return False
     if e.mcT0 < 0. or beam_spill_time_end < e.mcT0 : return False
-    if (e.flash_time-time_delay - e.mcT0) < 0. or (e.flash_time-time_delay - e.mcT0) > tolerable_time_diff : False
-    if e.charge_x < 0. or e.charge_x > drift_distance: return False
+    if (e.flash_time-params.time_delay - e.mcT0) < 0. or (e.flash_time-params.time_delay - e.mcT0) > params.tolerable_time_diff : False
+    if e.charge_x < 0. or e.charge_x > params.drift_distance: return False
     return True
 
 
-def polynomial_correction(skew, hypo_x, pol_coeffs, skew_high_limit=10.):
-    # TODO: maybe some other condition to prevent corrections?
-    if np.abs(skew) > skew_high_limit or np.isnan(skew) or np.isnan(hypo_x):
-        return 0.
-    correction = 0.
-    exponent = 1.
-    for coeff in pol_coeffs:
-        correction += coeff * exponent
-        exponent *= hypo_x
-    return correction * skew
-
-
-def parameters_correction_fitter(nuslice_tree, var, flash_type, profile_bins,
+def parameters_correction_fitter(nuslice_tree, var, flash_type, params, profile_bins,
                                  x_low, x_up, fit_func, beam_spill_time_end,
                                  skew_high_limit=10., skew_low_limit=0.05):
     fit_prof = TProfile(f"fit_prof_{var}", "", profile_bins,
@@ -311,10 +425,10 @@ def parameters_correction_fitter(nuslice_tree, var, flash_type, profile_bins,
     # HACK: Filter out from the fit the regions where discrepancy  is
     # not as bad, to give more weight to the edges where there large discrepancy
     filter_tolerable = "true"
-    if detector == "sbnd":
+    if params.detector == "sbnd":
         filter_tolerable = "abs(charge_y) > 60." if var=="y" \
             else "(charge_z<120. || 380.<charge_z)"
-    elif detector == "icarus":
+    elif params.detector == "icarus":
         filter_tolerable = "(charge_y<-65. || 19.<charge_y)" if var=="y" \
             else "(charge_z<-800. || 800.<charge_z)"
 
@@ -324,7 +438,7 @@ def parameters_correction_fitter(nuslice_tree, var, flash_type, profile_bins,
                     f"abs({var}_skew)<{skew_high_limit} && "
                     f"is_nu==1 && slices==1 && "
                     f"0.<=mcT0 && mcT0<={beam_spill_time_end} && "
-                    f"(flash_time-{time_delay} - mcT0) >= 0. && (flash_time-{time_delay} - mcT0) <= {tolerable_time_diff} && "
+                    f"(flash_time-{params.time_delay} - mcT0) >= 0. && (flash_time-{params.time_delay} - mcT0) <= {params.tolerable_time_diff} && "
                     f"charge_x >= {x_low} && charge_x <= {x_up} && new_hypo_x >= 0. &&"
                     f"{filter_tolerable}"
                     )
@@ -334,37 +448,68 @@ def parameters_correction_fitter(nuslice_tree, var, flash_type, profile_bins,
           "\noptions: ", draw_option)
     can = TCanvas("can")
     nuslice_tree.Draw(draw_expression, draw_filters, draw_option)
+    return fit_correction_profile(fit_prof, fit_func, var, flash_type, can)
+
+
+def fit_profile_hist(stats, var):
+    axis = stats.axes[0]
+    fit_prof = TProfile(f"fit_prof_{var}", "", axis.nbins, axis.low, axis.up)
+    set_profile_contents(fit_prof, stats)
+    return fit_prof
+
+
+def columnar_correction_fitter(flash_type, write=True, plots=True):
+    # Same as parameters_correction_fitter(), with the profile filled
+    # by the columnar engine and fitted with NumPy
+    def fitter(stats, var, fit_func):
+        params = fmc.correction_fitter(stats, var, fit_func)
+        if write or plots:
+            fit_prof = fit_profile_hist(stats, var)
+        if write:
+            fit_prof.Write()
+        if plots:
+            draw_correction_fit(fit_prof, stats.axes[0], var, fit_func, params, flash_type)
+        print("The fitted and rounded correction parameters for ", var, " are: ", params)
+        print("These are now stored in the metrics file.\n")
+        return params
+    return fitter
+
+
+def draw_correction_fit(fit_prof, axis, var, fit_func, params, flash_type):
+    # Prints the profile and its fitted correction function
+    can = TCanvas("can")
+    fit_prof.Draw()
+    fit_tf1 = TF1(f"fit_func_{var}", fit_func, axis.low, axis.up)
+    fit_tf1.SetParameters(array('d', params))
+    fit_tf1.Draw("same")
+    can.Print(f"plots/{flash_type}/{var}_correction_fit.pdf")
+
+
+def fit_correction_profile(fit_prof, fit_func, var, flash_type, can):
     fit_result = fit_prof.Fit(fit_func, "S")
     fit_prof.Write()
     # fit_result.Print("V")
     can.Print(f"plots/{flash_type}/{var}_correction_fit.pdf")
     params = []
     for p in fit_result.Parameters():
-        params.append(sig_fig_round(p, 3))
+        params.append(fmc.sig_fig_round(p, 3))
     print("The fitted and rounded correction parameters for ", var, " are: ", params)
     print("These are now stored in the metrics file.\n")
     return params
 
 
-def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
+def generator(nuslice_tree, rootfile, pset, params, flash_type, metrics_filename, seed=None,
+              plots=True):
     # BIG TODO: Metrics should depend on X,Y,Z.
     # Many changes needed everywhere
-    half_bin_width = xbin_width/2.
+    # Returns the jobs of render_metric_plots(), if plots.
+    half_bin_width = params.xbin_width/2.
 
-    directory = "plots/" + flash_type + "/yzmaps"
+    directory = "plots/" + flash_type
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    if detector == "sbnd":
-        x_gl_low = -215
-        x_gl_up = 215
-    elif detector == "icarus":
-        if pset.Cryostat == 0:
-            x_gl_low = -380
-            x_gl_up = -50
-        if pset.Cryostat == 1:
-            x_gl_low = 380
-            x_gl_up = 50
+    x_gl_low, x_gl_up = global_x_range(pset, params.detector)
     beam_spill_time_end = pset.BeamSpillTimeEnd - pset.BeamSpillTimeStart
 
     md = {
@@ -376,51 +521,22 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
         'petoq': metrics_stuff('petoq', pset)
     }
 
-    unfolded_score_scatter = TH2D("unfolded_score_scatter", "Scatter plot of match scores",
-                                  2*pset.XBins, x_gl_low, x_gl_up,
-                                  pset['score']['bins'], pset['score']['low'], pset['score']['up'])
-    unfolded_score_scatter.GetXaxis().SetTitle("X global (cm)")
-    unfolded_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
-    oldunfolded_score_scatter = TH2D("oldunfolded_score_scatter", "Scatter plot of match scores, old metrics",
-                                     2*pset.XBins, x_gl_low, x_gl_up,
-                                     pset['score']['bins'], pset['score']['low'], pset['score']['up'])
-    oldunfolded_score_scatter.GetXaxis().SetTitle("X global (cm)")
-    oldunfolded_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
-    unfolded_score_scatter_3D = TH2D("unfolded_score_scatter_3D", "Scatter plot of match scores 3D",
-                                     2*pset.XBins, x_gl_low, x_gl_up,
-                                     pset['score']['bins'], pset['score']['low'], pset['score']['up'])
-    unfolded_score_scatter_3D.GetXaxis().SetTitle("X global (cm)")
-    unfolded_score_scatter_3D.GetYaxis().SetTitle("match score (arbitrary)")
+    (unfolded_score_scatter, oldunfolded_score_scatter, unfolded_score_scatter_3D,
+     match_score_scatter, match_score_h1) = make_score_histograms(pset, x_gl_low, x_gl_up)
+    hfile_top, hfile = open_metrics_directory(metrics_filename, params)
 
-    match_score_scatter = TH2D("match_score_scatter", "Scatter plot of match scores",
-                               pset.XBins, pset.x_low, pset.x_up,
-                               pset['score']['bins'], pset['score']['low'], pset['score']['up'])
-    match_score_scatter.GetXaxis().SetTitle("distance from anode (cm)")
-    match_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
-    match_score_h1 = TH1D("match_score", "Match Score",
-                          pset['score']['bins'], pset['score']['low'], pset['score']['up'])
-    metrics_filename = 'fm_metrics_' + detector + '.root'
-    hfile_top = TFile(metrics_filename, 'UPDATE',
-                  'Simple flash matching metrics for ' + detector.upper())
-    keys = ROOT.gDirectory.GetListOfKeys()
-    print(keys)
-    print(ftype_long)
-    dir_exists = False
-    for key in keys:
-        if ftype_long == key.GetName():
-            dir_exists = True
-    hfile = hfile_top.Get(metrics_filename+":/" + ftype_long) if(dir_exists==True) else \
-            TDirectoryFile(ftype_long, f"Metrics directory for {ftype_long}")
-    hfile.cd()
-
-    # fill rr_h2 and ratio_h2 first
+    # fill rr_h2 and ratio_h2 first, and keep the columns the
+    # derived ones are computed from
+    cols = {b: [] for b in ['flash_rr', 'flash_ratio', 'flash_yb', 'y_skew',
+                            'flash_zb', 'z_skew', 'charge_x', 'charge_x_gl',
+                            'charge_y', 'charge_z', 'petoq', 'score']}
     for e in nuslice_tree:
         oldunfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
         unfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
         unfolded_score_scatter_3D.SetMarkerColor(ROOT.kBlue)
         match_score_scatter.SetMarkerColor(ROOT.kBlue)
 
-        if not quality_checks(e, beam_spill_time_end):
+        if not quality_checks(e, beam_spill_time_end, params):
             oldunfolded_score_scatter.SetMarkerColor(ROOT.kRed)
             unfolded_score_scatter.SetMarkerColor(ROOT.kRed)
             unfolded_score_scatter_3D.SetMarkerColor(ROOT.kRed)
@@ -433,42 +549,46 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
         md['ratio'].h2.Fill(qX, e.flash_ratio)
         md['ratio'].prof.Fill(qX, e.flash_ratio)
         md['ratio'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.flash_ratio)
+        for b, c in cols.items():
+            c.append(getattr(e, b))
+    cols = {b: np.array(c) for b, c in cols.items()}
 
     # Use rr_h2 and ratio_h2 to compute flash drift distance
-    # estimates, and store them as 'new_'...
+    # estimates, and store them as 'new_'... in a friend tree of the
+    # input, aligned by entry
+    rootfile.cd()
+    derived_tree = TTree(fmc.DERIVED_TREE, "Derived columns of the nuslicetree")
+    hfile.cd()
     new_hypo_x = array('d',[0])
-    new_hypo_x_branch = nuslice_tree.Branch("new_hypo_x", new_hypo_x, "new_hypo_x/D");
+    derived_tree.Branch("new_hypo_x", new_hypo_x, "new_hypo_x/D");
     new_hypo_x_err = array('d',[0])
-    new_hypo_x_err_branch = nuslice_tree.Branch("new_hypo_x_err", new_hypo_x_err, "new_hypo_x_err/D");
+    derived_tree.Branch("new_hypo_x_err", new_hypo_x_err, "new_hypo_x_err/D");
     new_hypo_x_rr = array('d',[0])
-    new_hypo_x_rr_branch = nuslice_tree.Branch("new_hypo_x_rr", new_hypo_x_rr, "new_hypo_x_rr/D");
+    derived_tree.Branch("new_hypo_x_rr", new_hypo_x_rr, "new_hypo_x_rr/D");
     new_hypo_x_rr_err = array('d',[0])
-    new_hypo_x_rr_err_branch = nuslice_tree.Branch("new_hypo_x_rr_err", new_hypo_x_rr_err, "new_hypo_x_rr_err/D");
+    derived_tree.Branch("new_hypo_x_rr_err", new_hypo_x_rr_err, "new_hypo_x_rr_err/D");
     new_hypo_x_ratio = array('d',[0])
-    new_hypo_x_ratio_branch = nuslice_tree.Branch("new_hypo_x_ratio", new_hypo_x_ratio, "new_hypo_x_ratio/D");
+    derived_tree.Branch("new_hypo_x_ratio", new_hypo_x_ratio, "new_hypo_x_ratio/D");
     new_hypo_x_ratio_err = array('d',[0])
-    new_hypo_x_ratio_err_branch = nuslice_tree.Branch("new_hypo_x_ratio_err", new_hypo_x_ratio_err, "new_hypo_x_ratio_err/D");
-    for e in nuslice_tree:
-        # No need to check quality in this loop
-        hypo_x, hypo_x_err, rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS = \
-            hypo_flashx_from_H2(e.flash_rr, md['rr'].h2,
-                                e.flash_ratio, md['ratio'].h2)
-        new_hypo_x[0] = hypo_x
-        new_hypo_x_branch.Fill()
-        new_hypo_x_err[0] = hypo_x_err
-        new_hypo_x_err_branch.Fill()
-        new_hypo_x_rr[0] = rr_hypoX
-        new_hypo_x_rr_branch.Fill()
-        new_hypo_x_rr_err[0] = rr_hypoXRMS
-        new_hypo_x_rr_err_branch.Fill()
-        new_hypo_x_ratio[0] = ratio_hypoX
-        new_hypo_x_ratio_branch.Fill()
-        new_hypo_x_ratio_err[0] = ratio_hypoXRMS
-        new_hypo_x_ratio_err_branch.Fill()
+    derived_tree.Branch("new_hypo_x_ratio_err", new_hypo_x_ratio_err, "new_hypo_x_ratio_err/D");
+    # No need to check quality here
+    (hypo_x, hypo_x_err, rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS) = \
+        hypo_flashx_from_H2(cols['flash_rr'], md['rr'].h2,
+                            cols['flash_ratio'], md['ratio'].h2,
+                            params, np.random.default_rng(seed))
+    for i in range(len(hypo_x)):
+        new_hypo_x[0] = hypo_x[i]
+        new_hypo_x_err[0] = hypo_x_err[i]
+        new_hypo_x_rr[0] = rr_hypoX[i]
+        new_hypo_x_rr_err[0] = rr_hypoXRMS[i]
+        new_hypo_x_ratio[0] = ratio_hypoX[i]
+        new_hypo_x_ratio_err[0] = ratio_hypoXRMS[i]
+        derived_tree.Fill()
+    nuslice_tree.AddFriend(derived_tree)
 
     # Fit and create std::vector objects for polynomial correction
     # coefficients
-    y_pol_coeffs = parameters_correction_fitter(nuslice_tree, "y", flash_type, pset.XBins,
+    y_pol_coeffs = parameters_correction_fitter(nuslice_tree, "y", flash_type, params, pset.XBins,
                                                 0., pset.DriftDistance,
                                                 pset.fit_func_y,
                                                 beam_spill_time_end,
@@ -476,12 +596,12 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
     y_pol_coeffs_vec = ROOT.std.vector['double']()
     for yp in y_pol_coeffs: y_pol_coeffs_vec.push_back(yp)
 
-    z_pol_coeffs = parameters_correction_fitter(nuslice_tree, "z", flash_type, pset.XBins,
+    z_pol_coeffs = parameters_correction_fitter(nuslice_tree, "z", flash_type, params, pset.XBins,
                                                 0., pset.DriftDistance,
                                                 pset.fit_func_z,
                                                 beam_spill_time_end,
                                                 pset.SkewLimitZ)
-    if detector == "icarus":
+    if params.detector == "icarus":
         z_pol_coeffs = [0.] # No Z corrections for ICARUS
     z_pol_coeffs_vec = ROOT.std.vector['double']()
     for zp in z_pol_coeffs: z_pol_coeffs_vec.push_back(zp)
@@ -489,16 +609,18 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
     # Using the new estimation new_hypo_x, and the just fitted
     # polynomial coefficients; get the corrected new_flash_y and new_flash_z
     new_flash_y = array('d',[0])
-    new_flash_y_branch = nuslice_tree.Branch("new_flash_y", new_flash_y, "new_flash_y/D");
+    new_flash_y_branch = derived_tree.Branch("new_flash_y", new_flash_y, "new_flash_y/D");
     new_flash_z = array('d',[0])
-    new_flash_z_branch = nuslice_tree.Branch("new_flash_z", new_flash_z, "new_flash_z/D");
-    for e in nuslice_tree:
-        # No need to check quality in this loop
-        new_flash_y[0] = e.flash_yb - polynomial_correction(
-            e.y_skew, e.new_hypo_x, y_pol_coeffs, pset.SkewLimitY)
+    new_flash_z_branch = derived_tree.Branch("new_flash_z", new_flash_z, "new_flash_z/D");
+    # No need to check quality here
+    flash_y = cols['flash_yb'] - fmc.polynomial_correction(
+        cols['y_skew'], hypo_x, y_pol_coeffs, pset.SkewLimitY)
+    flash_z = cols['flash_zb'] - fmc.polynomial_correction(
+        cols['z_skew'], hypo_x, z_pol_coeffs, pset.SkewLimitZ)
+    for i in range(len(hypo_x)):
+        new_flash_y[0] = flash_y[i]
         new_flash_y_branch.Fill()
-        new_flash_z[0] = e.flash_zb - polynomial_correction(
-            e.z_skew, e.new_hypo_x, z_pol_coeffs, pset.SkewLimitZ)
+        new_flash_z[0] = flash_z[i]
         new_flash_z_branch.Fill()
 
     # Update the file
@@ -509,7 +631,7 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
 
     # Use the new corrected terms to fill the rest of H2s and Profs
     for e in nuslice_tree:
-        if not quality_checks(e, beam_spill_time_end): continue
+        if not quality_checks(e, beam_spill_time_end, params): continue
         qX = e.charge_x
         md['dy'].h2.Fill(qX, e.new_flash_y - e.charge_y)
         md['dy'].prof.Fill(qX, e.new_flash_y - e.charge_y)
@@ -532,63 +654,19 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
     for m in md.values():
         m.update_metrics()
 
-    for e in nuslice_tree:
-        # calculate match score
-        oldunfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
-        unfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
-        unfolded_score_scatter_3D.SetMarkerColor(ROOT.kBlue)
-        match_score_scatter.SetMarkerColor(ROOT.kBlue)
-
-        if not quality_checks(e, beam_spill_time_end):
-            oldunfolded_score_scatter.SetMarkerColor(ROOT.kRed)
-            unfolded_score_scatter.SetMarkerColor(ROOT.kRed)
-            unfolded_score_scatter_3D.SetMarkerColor(ROOT.kRed)
-            match_score_scatter.SetMarkerColor(ROOT.kRed)
-        qX = e.charge_x
-        qXGl = e.charge_x_gl
-        isl = int(qX/xbin_width)
-        score = 0.
-        score += abs((e.new_flash_y-e.charge_y) - md['dy'].means[isl])/md['dy'].spreads[isl]
-        score += abs((e.new_flash_z-e.charge_z) - md['dz'].means[isl])/md['dz'].spreads[isl]
-        score += abs(e.flash_ratio-md['ratio'].means[isl])/md['ratio'].spreads[isl]
-        # score += abs((e.flash_slope - e.charge_slope) - md['slope'].prof3.GetBinContent(xb,yb,zb))/md['slope'].prof3.GetBinError(xb,yb,zb) # TODO: if useful add it to the total score
-        # score += abs(e.flash_xw - md['slope'].means[isl])/md['slope'].spreads[isl] # TODO: if useful add it to the total score
-        score += abs(e.petoq-md['petoq'].means[isl])/md['petoq'].spreads[isl]
-
-        xb  = md['dy'].prof3.GetXaxis().FindBin(e.charge_x)
-        if xb < 1: xb = 1
-        elif xb > pset.x_bins_: xb = pset.x_bins_
-        yb  = md['dy'].prof3.GetYaxis().FindBin(e.charge_y)
-        if yb < 1: yb = 1
-        elif yb > pset.y_bins: yb = pset.y_bins
-        zb  = md['dy'].prof3.GetZaxis().FindBin(e.charge_z)
-        if zb < 1: zb = 1
-        elif zb > pset.z_bins: zb = pset.z_bins
-        try:
-            score_3D = 0.
-            score_3D += abs((e.new_flash_y-e.charge_y) - md['dy'].prof3.GetBinContent(xb,yb,zb))/md['dy'].prof3.GetBinError(xb,yb,zb)
-            score_3D += abs((e.new_flash_z-e.charge_z) - md['dz'].prof3.GetBinContent(xb,yb,zb))/md['dz'].prof3.GetBinError(xb,yb,zb)
-            score_3D += abs(e.flash_rr-md['rr'].prof3.GetBinContent(xb,yb,zb))/md['rr'].prof3.GetBinError(xb,yb,zb)
-            score_3D += abs(e.flash_ratio-md['ratio'].prof3.GetBinContent(xb,yb,zb))/md['ratio'].prof3.GetBinError(xb,yb,zb)
-            # score_3D += abs((e.flash_slope - e.charge_slope) - md['slope'].prof3.GetBinContent(xb,yb,zb))/md['slope'].prof3.GetBinError(xb,yb,zb) # TODO: if useful add it to the total score
-            # score_3D += abs(e.flash_xw - md['slope'].prof3.GetBinContent(xb,yb,zb))/md['slope'].prof3.GetBinError(xb,yb,zb) # TODO: if useful add it to the total score
-            score_3D += abs(e.petoq-md['petoq'].prof3.GetBinContent(xb,yb,zb))/md['petoq'].prof3.GetBinError(xb,yb,zb)
-        except:
-            print(xb, f"{e.charge_x:.3E}", yb, f"{e.charge_y:.3E}", zb, f"{e.charge_z:.3E}", md['dy'].prof3.GetBinContent(xb,yb,zb), md['dy'].prof3.GetBinError(xb,yb,zb))
-            pass
-
-
-        oldunfolded_score_scatter.Fill(qXGl, e.score)
-        unfolded_score_scatter.Fill(qXGl, score)
-        unfolded_score_scatter_3D.Fill(qXGl, score_3D)
-        match_score_scatter.Fill(qX, score)
-        match_score_h1.Fill(score)
+    # calculate match scores
+    score, score_3D = fmc.match_scores(cols, md, flash_y, flash_z, params.xbin_width)
+    fill_score_histograms(cols, score, score_3D,
+                          [oldunfolded_score_scatter, unfolded_score_scatter,
+                           unfolded_score_scatter_3D, match_score_scatter,
+                           match_score_h1])
 
     for m in md.values():
         m.write_metrics()
 
     hfile.WriteObject(y_pol_coeffs_vec, "pol_coeffs_y")
     hfile.WriteObject(z_pol_coeffs_vec, "pol_coeffs_z")
+    write_flat_part(metrics_filename, md, {'y': y_pol_coeffs, 'z': z_pol_coeffs}, params)
     match_score_scatter.Write()
     oldunfolded_score_scatter.Write()
     unfolded_score_scatter.Write()
@@ -596,44 +674,354 @@ def generator(nuslice_tree, rootfile, pset, suffix, flash_type):
     match_score_h1.Write()
     hfile.Close()
 
-    canv = TCanvas("canv")
+    if not plots:
+        return []
+    draw_score_histograms(TCanvas("canv"), flash_type,
+                          [oldunfolded_score_scatter, unfolded_score_scatter,
+                           unfolded_score_scatter_3D, match_score_scatter,
+                           match_score_h1])
+    return metric_plot_jobs(md, flash_type)
+
+
+def global_x_range(pset, detector):
+    if detector == "sbnd":
+        x_gl_low = -215
+        x_gl_up = 215
+    elif detector == "icarus":
+        if pset.Cryostat == 0:
+            x_gl_low = -380
+            x_gl_up = -50
+        if pset.Cryostat == 1:
+            x_gl_low = 380
+            x_gl_up = 50
+    return x_gl_low, x_gl_up
+
+
+def make_score_histograms(pset, x_gl_low, x_gl_up):
+    unfolded_score_scatter = TH2D("unfolded_score_scatter", "Scatter plot of match scores",
+                                  2*pset.XBins, x_gl_low, x_gl_up,
+                                  pset['score']['bins'], pset['score']['low'], pset['score']['up'])
+    unfolded_score_scatter.GetXaxis().SetTitle("X global (cm)")
+    unfolded_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
+    oldunfolded_score_scatter = TH2D("oldunfolded_score_scatter", "Scatter plot of match scores, old metrics",
+                                     2*pset.XBins, x_gl_low, x_gl_up,
+                                     pset['score']['bins'], pset['score']['low'], pset['score']['up'])
+    oldunfolded_score_scatter.GetXaxis().SetTitle("X global (cm)")
+    oldunfolded_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
+    unfolded_score_scatter_3D = TH2D("unfolded_score_scatter_3D", "Scatter plot of match scores 3D",
+                                     2*pset.XBins, x_gl_low, x_gl_up,
+                                     pset['score']['bins'], pset['score']['low'], pset['score']['up'])
+    unfolded_score_scatter_3D.GetXaxis().SetTitle("X global (cm)")
+    unfolded_score_scatter_3D.GetYaxis().SetTitle("match score (arbitrary)")
+
+    match_score_scatter = TH2D("match_score_scatter", "Scatter plot of match scores",
+                               pset.XBins, pset.x_low, pset.x_up,
+                               pset['score']['bins'], pset['score']['low'], pset['score']['up'])
+    match_score_scatter.GetXaxis().SetTitle("distance from anode (cm)")
+    match_score_scatter.GetYaxis().SetTitle("match score (arbitrary)")
+    match_score_h1 = TH1D("match_score", "Match Score",
+                          pset['score']['bins'], pset['score']['low'], pset['score']['up'])
+    return (unfolded_score_scatter, oldunfolded_score_scatter, unfolded_score_scatter_3D,
+            match_score_scatter, match_score_h1)
+
+
+def fill_score_histograms(cols, score, score_3D, hists):
+    (oldunfolded_score_scatter, unfolded_score_scatter, unfolded_score_scatter_3D,
+     match_score_scatter, match_score_h1) = hists
+    n = len(score)
+    if n == 0: return
+    ones = np.ones(n)
+    qXGl = np.ascontiguousarray(cols['charge_x_gl'], dtype=np.float64)
+    qX = np.ascontiguousarray(cols['charge_x'], dtype=np.float64)
+    oldunfolded_score_scatter.FillN(n, qXGl, np.ascontiguousarray(cols['score'], dtype=np.float64), ones)
+    unfolded_score_scatter.FillN(n, qXGl, score, ones)
+    match_score_scatter.FillN(n, qX, score, ones)
+    match_score_h1.FillN(n, score, ones)
+    # no 3D score for the events in cells without spread
+    good = ~np.isnan(score_3D)
+    unfolded_score_scatter_3D.FillN(int(good.sum()), np.ascontiguousarray(qXGl[good]),
+                                    np.ascontiguousarray(score_3D[good]), ones[:good.sum()])
+
+
+def draw_score_histograms(canv, flash_type, hists):
+    for hist, pdf in zip(hists, ["oldunfolded_score_scatter", "unfolded_score_scatter",
+                                 "unfolded_score_scatter_3D", "match_score_scatter",
+                                 "match_score"]):
+        hist.Draw()
+        canv.Print(f"plots/{flash_type}/{pdf}.pdf")
+        canv.Update()
+
+
+def open_metrics_directory(metrics_filename, params):
+    ftype_long = params.ftype_long
+    hfile_top = TFile(metrics_filename, 'UPDATE',
+                  'Simple flash matching metrics for ' + params.detector.upper())
+    keys = ROOT.gDirectory.GetListOfKeys()
+    print(keys)
+    print(ftype_long)
+    dir_exists = False
+    for key in keys:
+        if ftype_long == key.GetName():
+            dir_exists = True
+    hfile = hfile_top.Get(metrics_filename+":/" + ftype_long) if(dir_exists==True) else \
+            TDirectoryFile(ftype_long, f"Metrics directory for {ftype_long}")
+    hfile.cd()
+
+    return hfile_top, hfile
+
+
+def columnar_generator(chain, pset, params, flash_type, metrics_filename,
+                       derived_filename, seed=None, nboot=0, plots=True):
+    # Same as generator(), with the columnar engine in flashmatch_columnar
+
+    directory = "plots/" + flash_type
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # as in generator(), make the histograms before opening the metrics file
+    md = {name: metrics_stuff(name, pset) for name in fmc.METRICS}
+    x_gl_low, x_gl_up = global_x_range(pset, params.detector)
+    (unfolded_score_scatter, oldunfolded_score_scatter, unfolded_score_scatter_3D,
+     match_score_scatter, match_score_h1) = make_score_histograms(pset, x_gl_low, x_gl_up)
+
+    derived_file = fmc.derived_writer(derived_filename)
+
+    def fill_scores(chunk, derived, scores):
+        derived_file.write(derived)
+        fill_score_histograms(chunk, scores['score'], scores['score_3D'],
+                              [oldunfolded_score_scatter, unfolded_score_scatter,
+                               unfolded_score_scatter_3D, match_score_scatter,
+                               match_score_h1])
+
+    hfile_top, hfile = open_metrics_directory(metrics_filename, params)
+    cmd, pol_coeffs = fmc.columnar_generator(chain, pset, params, seed,
+                                             columnar_correction_fitter(flash_type, plots=plots),
+                                             fill_scores, nboot)
+    derived_file.close()
+    write_columnar_metrics(hfile, md, cmd, pol_coeffs)
+    write_flat_part(metrics_filename, md, pol_coeffs, params)
+    match_score_scatter.Write()
+    oldunfolded_score_scatter.Write()
+    unfolded_score_scatter.Write()
+    unfolded_score_scatter_3D.Write()
+    match_score_h1.Write()
+    hfile.Close()
+    hfile_top.Close()
+
+    if not plots:
+        return []
+    draw_score_histograms(TCanvas("canv"), flash_type,
+                          [oldunfolded_score_scatter, unfolded_score_scatter,
+                           unfolded_score_scatter_3D, match_score_scatter,
+                           match_score_h1])
+    return metric_plot_jobs(md, flash_type)
+
+
+def write_columnar_metrics(hfile, md, cmd, pol_coeffs):
+    # Writes the metrics filled by the columnar engine into md
+    for name, cm in cmd.items():
+        md[name].load_columnar(cm)
+
+    hfile.cd()
     for m in md.values():
-        m.draw_metrics(canv, directory)
-        m.draw_3D(canv, directory)
+        m.write_metrics()
 
-    oldunfolded_score_scatter.Draw()
-    canv.Print(f"plots/{flash_type}/oldunfolded_score_scatter.pdf")
-    canv.Update()
+    for var in ['y', 'z']:
+        pol_coeffs_vec = ROOT.std.vector['double']()
+        for p in pol_coeffs[var]: pol_coeffs_vec.push_back(p)
+        hfile.WriteObject(pol_coeffs_vec, "pol_coeffs_" + var)
+
+
+def template_tasks(args):
+    # One task per flash type, with all of its parameters. ICARUS merges
+    # the trees of both cryostats into a single template, with the
+    # parameters of the East one.
+    tasks = []
+    if args.sbnd:
+        detector = "sbnd"
+        fcl_params = fhicl.make_pset('flashmatch_sbnd.fcl')
+        suffix_list = ["", "_op", "_ara", "_opara"]
+        time_delays = [0.15, 0, 0.04, 0] # TODO: Improve timing res to make this obsolete
+        long_names = ["SimpleFlash_PMT", "OpFlash_PMT", "SimpleFlash_ARA", "OpFlash_ARA"]
+        for (dir_, t_delay, l_name) in zip(suffix_list, time_delays, long_names):
+            pset = dotDict(fcl_params["sbnd_simple_flashmatch" + dir_])
+            trees = ["fmatch"+dir_.replace("_", "")+"/nuslicetree"]
+            tasks.append((l_name, pset, task_params(detector, pset, t_delay, args.min_entries3),
+                          trees))
+    elif args.icarus:
+        detector = "icarus"
+        fcl_params = fhicl.make_pset('flashmatch_simple_icarus.fcl')
+        suffix_list = ["", "_op"]
+        long_names = ["SimpleFlash_PMT", "OpFlash_PMT"]
+        for (dir_, l_name) in zip(suffix_list, long_names):
+            pset = dotDict(fcl_params['icarus_simple_flashmatch_E' + dir_])
+            trees = ["fmatch"+dir_.replace("_", "")+cryo+"/nuslicetree"
+                     for cryo in ["CryoE", "CryoW"]]
+            tasks.append((l_name, pset, task_params(detector, pset, 0., args.min_entries3),
+                          trees))
+
+    base = os.path.basename(args.files[0])
+    return [dotDict(flash_type=l_name, pset=pset, params=params, trees=trees,
+                    files=args.files, columnar=args.columnar, seed=args.seed,
+                    nboot=args.bootstrap, plots=not args.no_plots,
+                    stage=args.map, state=args.state, shard=args.shard, output=args.output,
+                    metrics_filename=f"fm_metrics_{params.detector}_{l_name}.root",
+                    derived_filename=f"derived_{l_name}_{base}")
+            for (l_name, pset, params, trees) in tasks]
+
+
+def run_task(task):
+    # Makes the templates of one flash type into its own metrics file.
+    # Returns the file and the plots to render.
+    pretty_print(task.flash_type)
+    params = task.params
+    hfile_top = TFile(task.metrics_filename, 'RECREATE',
+                      'Simple flash matching metrics for ' + params.detector.upper())
+    hfile_top.Close()
+
+    if task.columnar:
+        # the columnar engine reads the trees in chunks, as a chain
+        chain = fmc.nuslice_chain(task.files, task.trees)
+        plot_jobs = columnar_generator(chain, task.pset, params, task.flash_type,
+                                       task.metrics_filename, task.derived_filename,
+                                       task.seed, task.nboot, task.plots)
+        return task.metrics_filename, plot_jobs
+
+    # the input is only read, the new columns go to a friend tree
+    nuslice_tree = TChain("nuslicetree")
+    for f in task.files:
+        for t in task.trees:
+            nuslice_tree.Add(f + "/" + t)
+    rootfile = TFile(task.derived_filename, 'RECREATE')
+    plot_jobs = generator(nuslice_tree, rootfile, task.pset, params, task.flash_type,
+                          task.metrics_filename, task.seed, task.plots)
+    rootfile.Close()
+    return task.metrics_filename, plot_jobs
+
+
+def state_filename(directory, flash_type):
+    return os.path.join(directory, flash_type + ".npz")
+
+
+def map_task(task):
+    # Fills one stage of the templates of one flash type with a shard of
+    # the files, starting from the reduced state of the previous stage
+    pretty_print(task.flash_type)
+    stages = fmc.columnar_templates.STAGES
+    if task.stage == stages[0]:
+        templates = fmc.columnar_templates(task.pset, task.params, task.seed, task.shard,
+                                           task.nboot)
+    else:
+        templates = fmc.columnar_templates.load(state_filename(task.state, task.flash_type),
+                                                task.pset, task.params, task.shard)
+        if templates.stage != stages[stages.index(task.stage) - 1] or not templates.finished:
+            raise RuntimeError(f"{task.state} is not the reduced state before {task.stage}")
+    templates.fill(task.stage, fmc.nuslice_chain(task.files, task.trees))
+    templates.save(state_filename(task.output, task.flash_type))
+    return task.flash_type, []
+
+
+def reduce_task(task):
+    # Merges the shards of a stage of one flash type, and finishes the
+    # stage. After the last stage the metrics go to the metrics file.
+    pretty_print(task.flash_type)
+    directory = "plots/" + task.flash_type
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
-    unfolded_score_scatter.Draw()
-    canv.Print(f"plots/{flash_type}/unfolded_score_scatter.pdf")
-    canv.Update()
+    shards = [fmc.columnar_templates.load(state_filename(d, task.flash_type),
+                                          task.pset, task.params)
+              for d in task.files]
+    templates = shards[0]
+    for other in shards[1:]:
+        templates.merge(other)
+    templates.finish(templates.stage, columnar_correction_fitter(task.flash_type, write=False,
+                                                             plots=task.plots))
+    templates.save(state_filename(task.output, task.flash_type))
+    if templates.stage != fmc.columnar_templates.STAGES[-1]:
+        return None, []
+
+    # the scores need another pass over the events, leave them out
+    md = {name: metrics_stuff(name, task.pset) for name in fmc.METRICS}
+    hfile_top = TFile(task.metrics_filename, 'RECREATE',
+                      'Simple flash matching metrics for ' + task.params.detector.upper())
+    hfile_top.Close()
+    hfile_top, hfile = open_metrics_directory(task.metrics_filename, task.params)
+    write_columnar_metrics(hfile, md, templates.md, templates.pol_coeffs)
+    write_flat_part(task.metrics_filename, md, templates.pol_coeffs, task.params)
+    for var in fmc.columnar_templates.CORRECTIONS:
+        fit_profile_hist(templates.fit_profs[var], var).Write()
+    hfile.Close()
+    hfile_top.Close()
+    return task.metrics_filename, metric_plot_jobs(md, task.flash_type) if task.plots else []
 
-    unfolded_score_scatter_3D.Draw()
-    canv.Print(f"plots/{flash_type}/unfolded_score_scatter_3D.pdf")
-    canv.Update()
 
-    match_score_scatter.Draw()
-    canv.Print(f"plots/{flash_type}/match_score_scatter.pdf")
-    canv.Update()
+def merge_metrics_files(part_filenames, metrics_filename, detector):
+    # Copy the flash type directories of the task files into one file
+    hfile_top = TFile(metrics_filename, 'RECREATE',
+                      'Simple flash matching metrics for ' + detector.upper())
+    for part_filename in part_filenames:
+        part = TFile.Open(part_filename, 'READ')
+        for dir_name in dict.fromkeys(k.GetName() for k in part.GetListOfKeys()):
+            part_dir = part.Get(dir_name)
+            hfile = hfile_top.mkdir(dir_name, part_dir.GetTitle())
+            # only the last cycle of each object
+            for name in dict.fromkeys(k.GetName() for k in part_dir.GetListOfKeys()):
+                hfile.WriteObject(part_dir.Get(name), name)
+        part.Close()
+        os.remove(part_filename)
+    hfile_top.Close()
+    print("Metrics written to ", metrics_filename)
+
+
+def merge_flat_files(part_filenames, filename, detector):
+    # Same as merge_metrics_files(), for the flat templates
+    arrays = {"detector": np.array(detector)}
+    for part_filename in part_filenames:
+        arrays.update(fmc.read_flat_templates(part_filename))
+        os.remove(part_filename)
+    fmc.write_flat_templates(filename, arrays)
+    print("Flat templates written to ", filename)
 
-    match_score_h1.Draw()
-    canv.Print(f"plots/{flash_type}/match_score.pdf")
-    canv.Update()
-    sleep(20)
 
 # Main program.
 def main():
 
     # Parse arguments.
     parser = argparse.ArgumentParser(prog='generate_simple_weighted_template.py')
-    parser.add_argument('file')
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='Input files, or the shard directories with --reduce')
     # parser.add_argument('--help', '-h',
     #                     action='store_true',
     #                     help='help flag' )
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--sbnd', action='store_true', help='Generate metrics for SBND')
     group.add_argument('--icarus', action='store_true', help='Generate metrics for ICARUS')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Read the trees once with uproot and fill all metrics with NumPy')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for the flash X estimates')
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help='Uncertainties of the metrics from N bootstrap replicas (columnar only)')
+    parser.add_argument('--min-entries3', type=int, default=0, metavar='N',
+                        help='Refine the 3D profile cells octree-style down to boxes of N entries, '
+                        'written as <metric>_leaves3 and <metric>_index3 instead of the '
+                        '<metric>_prof3 (columnar only)')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Do not make the diagnostic plots')
+    parser.add_argument('--nproc', type=int, default=0,
+                        help='Number of flash types to process in parallel (default: all)')
+    mapreduce = parser.add_mutually_exclusive_group()
+    mapreduce.add_argument('--map', choices=fmc.columnar_templates.STAGES, default=None,
+                           help='Fill a stage of the columnar templates with a shard of the files')
+    mapreduce.add_argument('--reduce', action='store_true',
+                           help='Merge the shards of a stage and finish it')
+    parser.add_argument('--state', default=None,
+                        help='Directory with the reduced state of the previous stage, for --map')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='Index of the shard, different for each --map job of a stage')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output directory of --map and --reduce')
     args = parser.parse_args()
 
     # if args.help:
@@ -646,87 +1034,75 @@ def main():
     elif args.icarus :
         print("Generate metrics for ICARUS")
 
-    if not larbatch_posix.exists(args.file):
-        print('Input file %s does not exist.' % args.file)
+    if (args.map or args.reduce) and args.output is None:
+        print('--map and --reduce need an --output directory')
         return 1
-
-    print('\nOpening ', args.file)
-    rootfile_orig = TFile.Open(args.file, 'READ')
-    if not rootfile_orig.IsOpen() or rootfile_orig.IsZombie():
-        print('Failed to open ', args.file)
-        return 1
-
-    file_updated = "updated_" + args.file
-    print('\nCopying  ', args.file, ' to ', file_updated)
-    if not rootfile_orig.Cp(file_updated):
-        print('Failed to copy ', args.file)
+    if args.map and args.map != fmc.columnar_templates.STAGES[0] and args.state is None:
+        print('--map %s needs the --state of the previous stage' % args.map)
         return 1
-    rootfile = TFile.Open(file_updated, 'UPDATE')
-    if not rootfile.IsOpen() or rootfile.IsZombie():
-        print('Failed to open ', file_updated)
+    if args.map == fmc.columnar_templates.STAGES[0] and args.seed is None:
+        # all the shards have to use the same seed
+        print('--map %s needs a --seed' % args.map)
         return 1
 
-    global detector
-    global drift_distance
-    global x_bins
-    global xbin_width
-    global time_delay # TODO: Improve timing res to make this obsolete
-    global tolerable_time_diff
-    global suffix_list
-    global ftype_long
-    if args.sbnd:
-        detector = "sbnd"
-        metrics_filename = 'fm_metrics_' + detector + '.root'
-        hfile_top = TFile(metrics_filename, 'RECREATE',
-                      'Simple flash matching metrics for ' + detector.upper())
-        hfile_top.Close()
-        suffix_list = ["", "_op", "_ara", "_opara"]
-        time_delays = [0.15, 0, 0.04, 0]
-        long_names = ["SimpleFlash_PMT", "OpFlash_PMT", "SimpleFlash_ARA", "OpFlash_ARA"]
-        for (dir_, t_delay, l_name) in zip(suffix_list, time_delays, long_names):
-            fcl_params = fhicl.make_pset('flashmatch_sbnd.fcl')
-            fhicl_table = "sbnd_simple_flashmatch" + dir_
-            pset = dotDict(fcl_params[fhicl_table])
-            time_delay = t_delay
-            ftype_long = pset.FlashType
-            dir = rootfile.Get(file_updated+":/fmatch"+dir_.replace("_", ""))
-            nuslice_tree = dir.Get("nuslicetree")
-            drift_distance = pset.DriftDistance
-            x_bins = pset.XBins
-            xbin_width = drift_distance/x_bins
-            pretty_print(l_name)
-            generator(nuslice_tree, rootfile, pset, dir_, l_name)
-    elif args.icarus:
-        fcl_params = fhicl.make_pset('flashmatch_simple_icarus.fcl')
-        time_delay = 0.
-        # by default merge the trees from both Cryos
-        metrics_filename = 'fm_metrics_' + detector + '.root'
-        hfile_top = TFile(metrics_filename, 'RECREATE',
-                      'Simple flash matching metrics for ' + detector.upper())
-        hfile_top.Close()
-        suffix_list = ["", "_op"]
-        long_names = ["SimpleFlash_PMT", "OpFlash_PMT"]
-        for (dir_, l_name) in zip(suffix_list, long_names):
-            detector = "icarus"
-            pset = dotDict(fcl_params['icarus_simple_flashmatch_E' + dir_])
-            fhicl_table_E = "icarus_simple_flashmatch_E" + dir_
-            fhicl_table_W = "icarus_simple_flashmatch_W" + dir_
-            dir0 = rootfile.Get(file_updated+":/fmatch"+dir_.replace("_", "")+"CryoE")
-            nuslice_tree0 = dir0.Get("nuslicetree")
-            dir1 = rootfile.Get(file_updated+":/fmatch"+dir_.replace("_", "")+"CryoW")
-            nuslice_tree1 = dir1.Get("nuslicetree")
-            treelist = TList()
-            treelist.Add(nuslice_tree0)
-            treelist.Add(nuslice_tree1)
-            nuslice_tree = TTree.MergeTrees(treelist);
-            nuslice_tree.SetName("nuslice_tree");
-            # nuslice_tree.Write();
-            ftype_long = pset.FlashType
-            drift_distance = pset.DriftDistance
-            x_bins = pset.XBins
-            xbin_width = drift_distance/x_bins
-            pretty_print(l_name)
-            generator(nuslice_tree, rootfile, pset, dir_, l_name)
+    if not args.reduce:
+        for filename in args.files:
+            if not larbatch_posix.exists(filename):
+                print('Input file %s does not exist.' % filename)
+                return 1
+
+            print('\nOpening ', filename)
+            rootfile_orig = TFile.Open(filename, 'READ')
+            if not rootfile_orig.IsOpen() or rootfile_orig.IsZombie():
+                print('Failed to open ', filename)
+                return 1
+
+            rootfile_orig.Close()
+
+    tasks = template_tasks(args)
+    if args.map:
+        task_func = map_task
+    elif args.reduce:
+        task_func = reduce_task
+    else:
+        task_func = run_task
+    if args.output is not None and not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    # ROOT does not like being forked, start clean processes. The metric
+    # plots are rendered in the background as soon as each task is done.
+    context = multiprocessing.get_context('spawn')
+    plot_pool = None if args.no_plots or args.map else context.Pool()
+    results = []
+    plots = []
+
+    def collect(result):
+        results.append(result[0])
+        for job in result[1]:
+            plots.append(plot_pool.apply_async(render_metric_plots, job))
+
+    nproc = args.nproc if args.nproc else len(tasks)
+    if nproc == 1:
+        for task in tasks:
+            collect(task_func(task))
+    else:
+        with context.Pool(min(nproc, len(tasks))) as pool:
+            for result in pool.imap(task_func, tasks):
+                collect(result)
+
+    if args.map or (args.reduce and None in results):
+        print("State written to ", args.output)
+    else:
+        detector = tasks[0].params.detector
+        merge_metrics_files(results, 'fm_metrics_' + detector + '.root', detector)
+        merge_flat_files([flat_filename(f) for f in results],
+                         'fm_metrics_' + detector + '.npz', detector)
+
+    if plot_pool is not None:
+        plot_pool.close()
+        for p in plots:
+            print("Plots written to ", p.get())
+        plot_pool.join()
 
 
 #    generator(nuslice_tree, rootfile, pset)
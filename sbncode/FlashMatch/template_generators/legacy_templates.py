@@ -0,0 +1,305 @@
+######################################################################
+#
+# Name: legacy_templates.py
+#
+# Purpose: The per-event template generation of the original
+#          generate_simple_weighted_template.py, as the reference of
+#          benchmark_templates.py
+#
+# The loops are the ones of the original generator(), event by event:
+# the flash X estimates from a ProjectionX of the H2s and GetRandom,
+# the corrections with TTree::Draw and TProfile::Fit, and the match
+# scores from GetBinContent and GetBinError. The globals of the original
+# are in params, as in task_params(), and nothing is drawn or written.
+# The 3D profiles are always a cell per bin, --min-entries3 does not
+# apply here.
+#
+######################################################################
+
+import time
+from array import array
+
+import numpy as np
+import ROOT
+from ROOT import TFile, TList, TTree, TProfile
+
+import flashmatch_columnar as fmc
+import generate_simple_weighted_template as gswt
+
+
+def x_estimate_and_rms(metric_value, metric_h2, params):
+    kMinEntriesInProjection = 100
+    bin_ = metric_h2.GetYaxis().FindBin(metric_value);
+    bins = metric_h2.GetNbinsY();
+    metric_hypoX = -1.;
+    bin_buff = 0;
+    while 0 < bin_-bin_buff or bin_+bin_buff <= bins :
+        low_bin = bin_-bin_buff if 0 < bin_-bin_buff else 0
+        high_bin = bin_+bin_buff if bin_+bin_buff <= bins else -1
+        metric_px = metric_h2.ProjectionX("metric_px", low_bin, high_bin);
+        if metric_px.GetEntries() > kMinEntriesInProjection :
+            metric_hypoX = metric_px.GetRandom();
+            metric_rmsX = metric_px.GetRMS();
+            if metric_rmsX < params.xbin_width/2.: # something went wrong
+                print(f"{metric_h2.GetName()} projected on metric_value: {metric_value}, "
+                      f"bin: {bin_}, bin_buff: {bin_buff}; has {metric_px.GetEntries()} entries.")
+                print(f"  metric_hypoX: {metric_hypoX}, metric_rmsX: {metric_rmsX}")
+                return (-10., params.drift_distance); # no estimate
+            return (metric_hypoX, metric_rmsX);
+        bin_buff += 1;
+    return (-10., params.drift_distance); # no estimate
+
+
+def hypo_flashx_from_H2(flash_rr, rr_h2, flash_ratio, ratio_h2, params):
+    rr_hypoX, rr_hypoXRMS = x_estimate_and_rms(flash_rr, rr_h2, params);
+    ratio_hypoX, ratio_hypoXRMS = x_estimate_and_rms(flash_ratio, ratio_h2, params);
+
+    drr2 = rr_hypoXRMS * rr_hypoXRMS;
+    dratio2 = ratio_hypoXRMS * ratio_hypoXRMS;
+    rr_hypoXWgt = 1./drr2;
+    ratio_hypoXWgt = 1./dratio2;
+
+    sum_weights = rr_hypoXWgt + ratio_hypoXWgt
+    if sum_weights < 0.0002: return (-10., -10., rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS)
+    hypo_x = (rr_hypoX*rr_hypoXWgt + ratio_hypoX*ratio_hypoXWgt) / sum_weights
+    # consistent estimates, resulting error is smaller
+    hypo_x_err = np.sqrt( 1. / sum_weights)
+    if np.abs(rr_hypoX - ratio_hypoX) > 2.*np.sqrt(drr2+dratio2):
+        # inconsistent estimates, resulting error is larger
+        hypo_x_err = np.sqrt(drr2 + dratio2)
+    return (hypo_x, hypo_x_err, rr_hypoX, rr_hypoXRMS,
+            ratio_hypoX, ratio_hypoXRMS)
+
+
+def polynomial_correction(skew, hypo_x, pol_coeffs, skew_high_limit=10.):
+    if np.abs(skew) > skew_high_limit or np.isnan(skew) or np.isnan(hypo_x):
+        return 0.
+    correction = 0.
+    exponent = 1.
+    for coeff in pol_coeffs:
+        correction += coeff * exponent
+        exponent *= hypo_x
+    return correction * skew
+
+
+def parameters_correction_fitter(nuslice_tree, var, params, profile_bins,
+                                 x_low, x_up, fit_func, beam_spill_time_end,
+                                 skew_high_limit=10., skew_low_limit=0.05):
+    # as the original, without its PDF
+    fit_prof = TProfile(f"fit_prof_{var}", "", profile_bins,
+                        x_low, x_up)
+    draw_expression = (f"((flash_{var}b-charge_{var})/{var}_skew):new_hypo_x"
+                       f">>fit_prof_{var}")
+    filter_tolerable = "true"
+    if params.detector == "sbnd":
+        filter_tolerable = "abs(charge_y) > 60." if var=="y" \
+            else "(charge_z<120. || 380.<charge_z)"
+    elif params.detector == "icarus":
+        filter_tolerable = "(charge_y<-65. || 19.<charge_y)" if var=="y" \
+            else "(charge_z<-800. || 800.<charge_z)"
+    draw_filters = (f"abs({var}_skew)>{skew_low_limit} && "
+                    f"abs({var}_skew)<{skew_high_limit} && "
+                    f"is_nu==1 && slices==1 && "
+                    f"0.<=mcT0 && mcT0<={beam_spill_time_end} && "
+                    f"(flash_time-{params.time_delay} - mcT0) >= 0. && (flash_time-{params.time_delay} - mcT0) <= {params.tolerable_time_diff} && "
+                    f"charge_x >= {x_low} && charge_x <= {x_up} && new_hypo_x >= 0. &&"
+                    f"{filter_tolerable}"
+                    )
+    nuslice_tree.Draw(draw_expression, draw_filters, "prof goff")
+    fit_result = fit_prof.Fit(fit_func, "SQ0")
+    return [fmc.sig_fig_round(p, 3) for p in fit_result.Parameters()]
+
+
+def merged_tree(filename, trees, directory):
+    # the nuslicetrees of filename as one tree in directory, which the
+    # derived branches are added to, as the original did for ICARUS
+    infile = TFile.Open(filename, 'READ')
+    treelist = TList()
+    for t in trees:
+        treelist.Add(infile.Get(t))
+    directory.cd()
+    nuslice_tree = TTree.MergeTrees(treelist)
+    nuslice_tree.SetName("nuslice_tree")
+    infile.Close()
+    return nuslice_tree
+
+
+def generator(filename, trees, pset, params, workdir, seed=None):
+    # The templates of a flash type as fmc.flat_arrays(), and the seconds
+    # of each stage
+    timings = {}
+    beam_spill_time_end = pset.BeamSpillTimeEnd - pset.BeamSpillTimeStart
+    quality_checks = lambda e: gswt.quality_checks(e, beam_spill_time_end, params)
+    if seed is not None:
+        ROOT.gRandom.SetSeed(seed)
+    rootfile = TFile(f"{workdir}/legacy.root", 'RECREATE')
+    nuslice_tree = merged_tree(filename, trees, rootfile)
+
+    md = {name: gswt.metrics_stuff(name, pset)
+          for name in ['dy', 'dz', 'rr', 'ratio', 'slope', 'petoq']}
+    x_gl_low, x_gl_up = gswt.global_x_range(pset, params.detector)
+    (unfolded_score_scatter, oldunfolded_score_scatter, unfolded_score_scatter_3D,
+     match_score_scatter, match_score_h1) = gswt.make_score_histograms(pset, x_gl_low, x_gl_up)
+
+    start = time.perf_counter()
+    # fill rr_h2 and ratio_h2 first
+    for e in nuslice_tree:
+        oldunfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
+        unfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
+        unfolded_score_scatter_3D.SetMarkerColor(ROOT.kBlue)
+        match_score_scatter.SetMarkerColor(ROOT.kBlue)
+
+        if not quality_checks(e):
+            oldunfolded_score_scatter.SetMarkerColor(ROOT.kRed)
+            unfolded_score_scatter.SetMarkerColor(ROOT.kRed)
+            unfolded_score_scatter_3D.SetMarkerColor(ROOT.kRed)
+            match_score_scatter.SetMarkerColor(ROOT.kRed)
+
+        qX = e.charge_x
+        md['rr'].h2.Fill(qX, e.flash_rr)
+        md['rr'].prof.Fill(qX, e.flash_rr)
+        md['rr'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.flash_rr)
+        md['ratio'].h2.Fill(qX, e.flash_ratio)
+        md['ratio'].prof.Fill(qX, e.flash_ratio)
+        md['ratio'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.flash_ratio)
+
+    # Use rr_h2 and ratio_h2 to compute flash drift distance
+    # estimates, and store them as 'new_'...
+    new_hypo_x = array('d',[0])
+    new_hypo_x_branch = nuslice_tree.Branch("new_hypo_x", new_hypo_x, "new_hypo_x/D");
+    new_hypo_x_err = array('d',[0])
+    new_hypo_x_err_branch = nuslice_tree.Branch("new_hypo_x_err", new_hypo_x_err, "new_hypo_x_err/D");
+    new_hypo_x_rr = array('d',[0])
+    new_hypo_x_rr_branch = nuslice_tree.Branch("new_hypo_x_rr", new_hypo_x_rr, "new_hypo_x_rr/D");
+    new_hypo_x_rr_err = array('d',[0])
+    new_hypo_x_rr_err_branch = nuslice_tree.Branch("new_hypo_x_rr_err", new_hypo_x_rr_err, "new_hypo_x_rr_err/D");
+    new_hypo_x_ratio = array('d',[0])
+    new_hypo_x_ratio_branch = nuslice_tree.Branch("new_hypo_x_ratio", new_hypo_x_ratio, "new_hypo_x_ratio/D");
+    new_hypo_x_ratio_err = array('d',[0])
+    new_hypo_x_ratio_err_branch = nuslice_tree.Branch("new_hypo_x_ratio_err", new_hypo_x_ratio_err, "new_hypo_x_ratio_err/D");
+    for e in nuslice_tree:
+        # No need to check quality in this loop
+        hypo_x, hypo_x_err, rr_hypoX, rr_hypoXRMS, ratio_hypoX, ratio_hypoXRMS = \
+            hypo_flashx_from_H2(e.flash_rr, md['rr'].h2,
+                                e.flash_ratio, md['ratio'].h2, params)
+        new_hypo_x[0] = hypo_x
+        new_hypo_x_branch.Fill()
+        new_hypo_x_err[0] = hypo_x_err
+        new_hypo_x_err_branch.Fill()
+        new_hypo_x_rr[0] = rr_hypoX
+        new_hypo_x_rr_branch.Fill()
+        new_hypo_x_rr_err[0] = rr_hypoXRMS
+        new_hypo_x_rr_err_branch.Fill()
+        new_hypo_x_ratio[0] = ratio_hypoX
+        new_hypo_x_ratio_branch.Fill()
+        new_hypo_x_ratio_err[0] = ratio_hypoXRMS
+        new_hypo_x_ratio_err_branch.Fill()
+    timings['x_estimate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pol_coeffs = parameters_correction_fitter(nuslice_tree, "y", params, pset.XBins,
+                                                0., pset.DriftDistance,
+                                                pset.fit_func_y,
+                                                beam_spill_time_end,
+                                                pset.SkewLimitY)
+    z_pol_coeffs = parameters_correction_fitter(nuslice_tree, "z", params, pset.XBins,
+                                                0., pset.DriftDistance,
+                                                pset.fit_func_z,
+                                                beam_spill_time_end,
+                                                pset.SkewLimitZ)
+    if params.detector == "icarus":
+        z_pol_coeffs = [0.] # No Z corrections for ICARUS
+
+    # Using the new estimation new_hypo_x, and the just fitted
+    # polynomial coefficients; get the corrected new_flash_y and new_flash_z
+    new_flash_y = array('d',[0])
+    new_flash_y_branch = nuslice_tree.Branch("new_flash_y", new_flash_y, "new_flash_y/D");
+    new_flash_z = array('d',[0])
+    new_flash_z_branch = nuslice_tree.Branch("new_flash_z", new_flash_z, "new_flash_z/D");
+    for e in nuslice_tree:
+        # No need to check quality in this loop
+        new_flash_y[0] = e.flash_yb - polynomial_correction(
+            e.y_skew, e.new_hypo_x, y_pol_coeffs, pset.SkewLimitY)
+        new_flash_y_branch.Fill()
+        new_flash_z[0] = e.flash_zb - polynomial_correction(
+            e.z_skew, e.new_hypo_x, z_pol_coeffs, pset.SkewLimitZ)
+        new_flash_z_branch.Fill()
+    timings['correction'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Use the new corrected terms to fill the rest of H2s and Profs
+    for e in nuslice_tree:
+        if not quality_checks(e): continue
+        qX = e.charge_x
+        md['dy'].h2.Fill(qX, e.new_flash_y - e.charge_y)
+        md['dy'].prof.Fill(qX, e.new_flash_y - e.charge_y)
+        md['dy'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.new_flash_y - e.charge_y)
+        md['dz'].h2.Fill(qX, e.new_flash_z - e.charge_z)
+        md['dz'].prof.Fill(qX, e.new_flash_z - e.charge_z)
+        md['dz'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.new_flash_z - e.charge_z)
+        md['slope'].h2.Fill(qX, e.flash_xw)
+        md['slope'].prof.Fill(qX, e.flash_xw)
+        md['slope'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.flash_xw)
+        md['petoq'].h2.Fill(qX, e.petoq)
+        md['petoq'].prof.Fill(qX, e.petoq)
+        md['petoq'].prof3.Fill(e.charge_x, e.charge_y, e.charge_z, e.petoq)
+
+    # fill histograms for match score calculation from profile histograms
+    for m in md.values():
+        m.update_metrics()
+    timings['metrics'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for e in nuslice_tree:
+        # calculate match score
+        oldunfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
+        unfolded_score_scatter.SetMarkerColor(ROOT.kBlue)
+        unfolded_score_scatter_3D.SetMarkerColor(ROOT.kBlue)
+        match_score_scatter.SetMarkerColor(ROOT.kBlue)
+
+        if not quality_checks(e):
+            oldunfolded_score_scatter.SetMarkerColor(ROOT.kRed)
+            unfolded_score_scatter.SetMarkerColor(ROOT.kRed)
+            unfolded_score_scatter_3D.SetMarkerColor(ROOT.kRed)
+            match_score_scatter.SetMarkerColor(ROOT.kRed)
+        qX = e.charge_x
+        qXGl = e.charge_x_gl
+        isl = int(qX/params.xbin_width)
+        score = 0.
+        score += abs((e.new_flash_y-e.charge_y) - md['dy'].means[isl])/md['dy'].spreads[isl]
+        score += abs((e.new_flash_z-e.charge_z) - md['dz'].means[isl])/md['dz'].spreads[isl]
+        score += abs(e.flash_ratio-md['ratio'].means[isl])/md['ratio'].spreads[isl]
+        score += abs(e.petoq-md['petoq'].means[isl])/md['petoq'].spreads[isl]
+
+        xb  = md['dy'].prof3.GetXaxis().FindBin(e.charge_x)
+        if xb < 1: xb = 1
+        elif xb > pset.x_bins_: xb = pset.x_bins_
+        yb  = md['dy'].prof3.GetYaxis().FindBin(e.charge_y)
+        if yb < 1: yb = 1
+        elif yb > pset.y_bins: yb = pset.y_bins
+        zb  = md['dy'].prof3.GetZaxis().FindBin(e.charge_z)
+        if zb < 1: zb = 1
+        elif zb > pset.z_bins: zb = pset.z_bins
+        try:
+            score_3D = 0.
+            score_3D += abs((e.new_flash_y-e.charge_y) - md['dy'].prof3.GetBinContent(xb,yb,zb))/md['dy'].prof3.GetBinError(xb,yb,zb)
+            score_3D += abs((e.new_flash_z-e.charge_z) - md['dz'].prof3.GetBinContent(xb,yb,zb))/md['dz'].prof3.GetBinError(xb,yb,zb)
+            score_3D += abs(e.flash_rr-md['rr'].prof3.GetBinContent(xb,yb,zb))/md['rr'].prof3.GetBinError(xb,yb,zb)
+            score_3D += abs(e.flash_ratio-md['ratio'].prof3.GetBinContent(xb,yb,zb))/md['ratio'].prof3.GetBinError(xb,yb,zb)
+            score_3D += abs(e.petoq-md['petoq'].prof3.GetBinContent(xb,yb,zb))/md['petoq'].prof3.GetBinError(xb,yb,zb)
+        except:
+            pass
+
+        oldunfolded_score_scatter.Fill(qXGl, e.score)
+        unfolded_score_scatter.Fill(qXGl, score)
+        unfolded_score_scatter_3D.Fill(qXGl, score_3D)
+        match_score_scatter.Fill(qX, score)
+        match_score_h1.Fill(score)
+    timings['scores'] = time.perf_counter() - start
+
+    m = md['dy']
+    arrays = fmc.flat_arrays(np.linspace(m.x_low, m.x_up, m.x_bins + 1), m.edges3,
+                             {'y': y_pol_coeffs, 'z': z_pol_coeffs},
+                             {name: m.flat_arrays() for name, m in md.items()})
+    rootfile.Close()
+    return arrays, timings
@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+######################################################################
+#
+# Name: synthetic_nuslicetree.py
+#
+# Purpose: Synthetic nuslicetrees and stub parameter sets, to run and
+#          time generate_simple_weighted_template.py without MC files
+#          or fhicl
+#
+# Usage:
+#
+# synthetic_nuslicetree.py (--sbnd | --icarus) [-n N] [--seed S] [-o file]
+#
+# The stub parameter sets follow the layout of the tables in
+# flashmatch_sbnd.fcl and flashmatch_simple_icarus.fcl, with
+# approximate values. The columns follow simple models of how the
+# flash metrics change with the drift distance, with gaussian noise.
+#
+######################################################################
+
+import sys
+import argparse
+import numpy as np
+
+import flashmatch_columnar as fmc
+
+
+def _metric(bins, low, up):
+    return {'bins': bins, 'low': low, 'up': up}
+
+
+def _sbnd_pset(flash_type):
+    return {'FlashType': flash_type, 'Cryostat': 0,
+            'DriftDistance': 202.05, 'XBins': 40, 'x_bins_': 5,
+            'x_low': 0., 'x_up': 202.05,
+            'y_bins': 8, 'y_low': -200., 'y_up': 200.,
+            'z_bins': 10, 'z_low': 0., 'z_up': 500.,
+            'BeamSpillTimeStart': 0., 'BeamSpillTimeEnd': 1.6,
+            'fit_func_y': 'pol2', 'fit_func_z': 'pol2',
+            'SkewLimitY': 10., 'SkewLimitZ': 10.,
+            'dy': _metric(100, -200., 200.), 'dz': _metric(100, -200., 200.),
+            'rr': _metric(100, 0., 200.), 'ratio': _metric(100, 0., 1.),
+            'slope': _metric(100, -5., 10.), 'petoq': _metric(100, 0., 2.),
+            'score': _metric(100, 0., 50.)}
+
+
+def _icarus_pset(flash_type, cryostat):
+    return {'FlashType': flash_type, 'Cryostat': cryostat,
+            'DriftDistance': 148.2, 'XBins': 30, 'x_bins_': 5,
+            'x_low': 0., 'x_up': 148.2,
+            'y_bins': 8, 'y_low': -185., 'y_up': 135.,
+            'z_bins': 18, 'z_low': -900., 'z_up': 900.,
+            'BeamSpillTimeStart': 0., 'BeamSpillTimeEnd': 1.6,
+            'fit_func_y': 'pol2', 'fit_func_z': 'pol1',
+            'SkewLimitY': 10., 'SkewLimitZ': 10.,
+            'dy': _metric(100, -200., 200.), 'dz': _metric(100, -200., 200.),
+            'rr': _metric(100, 0., 200.), 'ratio': _metric(100, 0., 1.),
+            'slope': _metric(100, -5., 10.), 'petoq': _metric(100, 0., 2.),
+            'score': _metric(100, 0., 50.)}
+
+
+def stub_fcl_params(detector):
+    # Stand-in for fhicl.make_pset() of the flash matching fcl file
+    if detector == "sbnd":
+        return {"sbnd_simple_flashmatch" + dir_: _sbnd_pset(ftype)
+                for dir_, ftype in [("", "simpleflash_pmt"), ("_op", "opflash_pmt"),
+                                    ("_ara", "simpleflash_ara"), ("_opara", "opflash_ara")]}
+    elif detector == "icarus":
+        return {f"icarus_simple_flashmatch_{cryo}" + dir_: _icarus_pset(ftype, icryo)
+                for icryo, cryo in enumerate(["E", "W"])
+                for dir_, ftype in [("", "simpleflash_pmt"), ("_op", "opflash_pmt")]}
+    raise ValueError(f"Unknown detector {detector}")
+
+
+def flash_types(detector):
+    # (long name, fcl table, nuslicetrees, time delay) of each flash type,
+    # as in template_tasks() of generate_simple_weighted_template.py
+    if detector == "sbnd":
+        return [(l_name, "sbnd_simple_flashmatch" + dir_,
+                 ["fmatch" + dir_.replace("_", "") + "/nuslicetree"], t_delay)
+                for dir_, t_delay, l_name in zip(
+                        ["", "_op", "_ara", "_opara"], [0.15, 0, 0.04, 0],
+                        ["SimpleFlash_PMT", "OpFlash_PMT", "SimpleFlash_ARA", "OpFlash_ARA"])]
+    elif detector == "icarus":
+        return [(l_name, "icarus_simple_flashmatch_E" + dir_,
+                 ["fmatch" + dir_.replace("_", "") + cryo + "/nuslicetree"
+                  for cryo in ["CryoE", "CryoW"]], 0.)
+                for dir_, l_name in zip(["", "_op"], ["SimpleFlash_PMT", "OpFlash_PMT"])]
+    raise ValueError(f"Unknown detector {detector}")
+
+
+def synthetic_columns(n, pset, rng, detector, time_delay=0.):
+    # n slices with the nuslicetree branches read by the generator
+    drift = pset['DriftDistance']
+    spill = pset['BeamSpillTimeEnd'] - pset['BeamSpillTimeStart']
+    x = rng.uniform(0., drift, n)
+    cols = {'charge_x': x,
+            'charge_y': rng.uniform(pset['y_low'], pset['y_up'], n),
+            'charge_z': rng.uniform(pset['z_low'], pset['z_up'], n)}
+    # the cathode is in the middle of the two TPCs of each cryostat
+    cathode_x = 0. if detector == "sbnd" else [-215., 215.][pset['Cryostat']]
+    cols['charge_x_gl'] = cathode_x + rng.choice([-1., 1.], n)*(drift - x)
+    cols['slices'] = np.where(rng.random(n) < 0.95, 1, 2).astype(np.int32)
+    cols['is_nu'] = np.where(rng.random(n) < 0.9, 1, 0).astype(np.int32)
+    # some of the neutrinos out of the beam spill
+    cols['mcT0'] = np.where(rng.random(n) < 0.9, rng.uniform(0., spill, n),
+                            rng.uniform(spill, spill + 5., n))
+    cols['flash_time'] = cols['mcT0'] + time_delay + rng.normal(0., 0.02, n)
+
+    # farther from the PDS, flashes are wider, less peaked and dimmer
+    cols['flash_rr'] = 20. + 0.5*x + rng.normal(0., 1., n)*(5. + 0.05*x)
+    cols['flash_ratio'] = np.clip(0.03 + 0.35*np.exp(-x/80.) + rng.normal(0., 0.02, n), 0., 1.)
+    cols['flash_xw'] = 0.02*x + rng.normal(0., 0.5, n)
+    cols['petoq'] = 0.2 + 1.2*np.exp(-x/100.)*rng.normal(1., 0.1, n)
+    # the barycenters are biased along the skewness of the flash
+    cols['y_skew'] = rng.normal(0., 0.8, n)
+    cols['z_skew'] = rng.normal(0., 0.8, n)
+    cols['flash_yb'] = (cols['charge_y'] + cols['y_skew']*(2. + 0.1*x + 2e-4*x*x) +
+                        rng.normal(0., 1., n)*(5. + 0.05*x))
+    # no Z bias for ICARUS, as it has no Z corrections
+    z_corr = 1. + 0.05*x if detector == "sbnd" else 0.
+    cols['flash_zb'] = (cols['charge_z'] + cols['z_skew']*z_corr +
+                        rng.normal(0., 1., n)*(8. + 0.05*x))
+    cols['score'] = rng.gamma(2., 3., n)
+    return cols
+
+
+def write_synthetic_file(filename, detector, n, seed=None, ftypes=None,
+                         chunk_size=1000000):
+    # n slices in each nuslicetree of the flash types (all by default),
+    # written in chunks so any n fits in memory
+    import uproot
+    fcl_params = stub_fcl_params(detector)
+    rng = np.random.default_rng(seed)
+    with uproot.recreate(filename) as rootfile:
+        for l_name, table, trees, t_delay in flash_types(detector):
+            if ftypes is not None and l_name not in ftypes:
+                continue
+            for tree_path in trees:
+                # each ICARUS cryostat with its own parameters
+                pset = fcl_params[table.replace("_E", "_W")] if "CryoW" in tree_path \
+                    else fcl_params[table]
+                for start in range(0, n, chunk_size):
+                    cols = synthetic_columns(min(chunk_size, n - start), pset, rng,
+                                             detector, t_delay)
+                    cols = {b: cols[b] for b in fmc.BRANCHES}
+                    if start == 0:
+                        rootfile[tree_path] = cols
+                    else:
+                        rootfile[tree_path].extend(cols)
+    return filename
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='synthetic_nuslicetree.py')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--sbnd', action='store_true', help='SBND nuslicetrees')
+    group.add_argument('--icarus', action='store_true', help='ICARUS nuslicetrees')
+    parser.add_argument('-n', type=float, default=1e5, help='Slices in each nuslicetree')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    parser.add_argument('-o', '--output', default='synthetic_nuslicetree.root',
+                        help='Output file')
+    args = parser.parse_args()
+
+    detector = "sbnd" if args.sbnd else "icarus"
+    write_synthetic_file(args.output, detector, int(args.n), args.seed)
+    print("Synthetic nuslicetrees written to ", args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+
+import flashmatch_columnar as fmc
+
+
+def fixed_profile():
+    # a pol2 along X with gaussian noise, and a few bins with a single entry
+    rng = np.random.default_rng(12345)
+    x = np.concatenate([rng.uniform(0., 150., 2000), [152.5, 167.5, 182.5]])
+    y = 2. + 0.1*x + 2e-4*x*x + rng.normal(0., 3., len(x))
+    prof = fmc.binned_stats([fmc.regular_axis(20, 0., 200.)])
+    prof.fill([x], y)
+    return prof, x, y
+
+
+def test_profile_errors_single_entry_bins():
+    prof, x, y = fixed_profile()
+    single = prof.inner(prof.sumw) == 1
+    assert single.sum() == 3
+
+    errors = fmc.profile_errors(prof)
+    assert np.all(errors[single] == 0.)
+    assert np.all(errors[~single & (prof.inner(prof.sumw) > 0)] > 0.)
+
+    # TProfile::Approximate(): twice the spread of the whole profile
+    approx = fmc.profile_errors(prof, approximate=True)
+    assert np.allclose(approx[single], 2*y.std())
+    assert np.allclose(approx[~single], errors[~single])
+
+    # the single entry bins change the fit only when they have an error
+    coeffs = fmc.fit_polynomial(prof, 2)[0]
+    without = fmc.binned_stats(prof.axes)
+    without.fill([x[:-3]], y[:-3])
+    assert np.allclose(coeffs, fmc.fit_polynomial(without, 2)[0])
+    assert not np.allclose(coeffs, fmc.fit_polynomial(prof, 2, approximate=True)[0])
+
+
+@pytest.mark.parametrize("approximate", [False, True])
+def test_fit_against_root(approximate):
+    ROOT = pytest.importorskip("ROOT")
+    prof, x, y = fixed_profile()
+    axis = prof.axes[0]
+    root_prof = ROOT.TProfile(f"fit_prof_{approximate}", "", axis.nbins, axis.low, axis.up)
+    for xi, yi in zip(x, y):
+        root_prof.Fill(xi, yi)
+    ROOT.TProfile.Approximate(approximate)
+    try:
+        fit_result = root_prof.Fit("pol2", "SQ0")
+        root_coeffs = [fit_result.Parameter(i) for i in range(3)]
+    finally:
+        ROOT.TProfile.Approximate(False)
+    coeffs = fmc.fit_polynomial(prof, 2, approximate)[0]
+    assert np.allclose(coeffs, root_coeffs, rtol=1e-6, atol=1e-9)
+
+
+def test_bootstrap_blocks():
+    # the same sums in one block of replicas as in many
+    rng = np.random.default_rng(7)
+    n, nboot = 5000, 37
+    x, y = rng.uniform(0., 200., n), rng.normal(0., 1., n)
+    y[::50] = np.nan
+    replica_weights = rng.poisson(1., (n, nboot)).astype(np.uint8)
+    axes = [fmc.regular_axis(20, 0., 200.)]
+    one, many = fmc.bootstrap_stats(axes, nboot), fmc.bootstrap_stats(axes, nboot)
+    one.fill([x], y, replica_weights)
+    many.BLOCK_ELEMENTS = 3*n
+    many.fill([x], y, replica_weights)
+    for a in fmc.binned_stats.SUMS:
+        assert np.allclose(getattr(one, a), getattr(many, a))
+    # and each replica as a weighted binned_stats
+    ref = fmc.binned_stats(axes)
+    ref.fill([x], y, replica_weights[:, 5].astype(np.float64))
+    assert np.allclose(many.sumwv2[5], ref.sumwv2)
+
+
+def test_flat_templates_mapped(tmp_path):
+    rng = np.random.default_rng(3)
+    entries3 = rng.poisson(0.5, (4, 3, 2)).astype(np.float64)
+    metrics = {name: {'mean': rng.normal(size=5), 'spread': rng.uniform(size=5),
+                      'entries': rng.poisson(10., 5).astype(np.float64),
+                      'mean3': rng.normal(size=entries3.shape),
+                      'spread3': rng.uniform(size=entries3.shape),
+                      'entries3': entries3, 'index3': None,
+                      'h2': np.asfortranarray(rng.uniform(size=(7, 12))),
+                      'edges': np.linspace(0., 1., 11)}
+               for name in ['dy', 'rr']}
+    edges3 = [np.linspace(0., 1., n + 1) for n in entries3.shape]
+    arrays = fmc.flat_arrays(np.linspace(0., 5., 6), edges3, {'y': [1., 2.], 'z': [3.]}, metrics)
+    assert arrays['dy_index3'].max() + 1 == len(arrays['dy_mean3']) == (entries3 > 0).sum()
+    assert 'rr_h2' in arrays and 'dy_h2' not in arrays
+
+    filename = str(tmp_path / "flat.npz")
+    fmc.write_flat_templates(filename, dict(detector=np.array("sbnd"), **arrays))
+    read = fmc.read_flat_templates(filename)
+    mapped = fmc.read_flat_templates(filename, mapped=True)
+    assert sorted(read) == sorted(mapped)
+    for key, a in read.items():
+        assert a.dtype == mapped[key].dtype and np.array_equal(a, mapped[key]), key
+    assert not mapped['rr_h2'].flags.writeable and mapped['rr_h2'].flags.f_contiguous
+    assert str(mapped['detector']) == "sbnd"
+
+    # a changed value is caught by the checksum
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read())
+    data[data.index(arrays['dy_mean'].tobytes())] ^= 1
+    with open(filename, 'wb') as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        fmc.read_flat_templates(filename, mapped=True)
+
+
+def test_adaptive_profile3_sparse_octant():
+    # sparse octants are merged only with sparse neighbours and do not
+    # stop the dense ones from being split down to single cells
+    rng = np.random.default_rng(11)
+    axes = [fmc.regular_axis(8, 0., 8.) for _ in range(3)]
+    prof3 = fmc.binned_stats(axes)
+    octant = lambda x: tuple((x >= 4.).astype(int))
+    low, high, beside = (0, 0, 0), (1, 1, 1), (1, 0, 0)
+    dense = rng.uniform(0., 8., (3, 20000))
+    dense = dense[:, [octant(x) not in (low, high, beside) for x in dense.T]]
+    prof3.fill(list(dense), rng.normal(size=dense.shape[1]))
+    prof3.fill([[0.5, 3.5, 6.5, 4.5, 5.5, 7.5, 4.5, 6.5, 7.5, 5.5],
+                [0.5, 3.5, 2.5, 0.5, 1.5, 3.5, 5.5, 6.5, 7.5, 4.5],
+                [0.5, 3.5, 1.5, 2.5, 3.5, 0.5, 4.5, 5.5, 6.5, 7.5]], np.arange(10.))
+
+    adaptive = fmc.adaptive_profile3(prof3, 20)
+    sumw = prof3.inner(prof3.sumw)
+    cells = lambda o: tuple(slice(4*i, 4*i + 4) for i in o)
+    # the two sparse octants next to each other along X are one leaf, the
+    # one in the opposite corner is a leaf of its own with too few entries
+    merged, corner = adaptive.index[0, 0, 0], adaptive.index[7, 7, 7]
+    assert np.all(adaptive.index[cells(low)] == merged)
+    assert np.all(adaptive.index[cells(beside)] == merged)
+    assert (adaptive.index == merged).sum() == 2*4**3
+    assert np.all(adaptive.index[cells(high)] == corner)
+    assert (adaptive.index == corner).sum() == 4**3
+    # the five dense octants are refined on their own, down to (nearly)
+    # single cells
+    for o in np.ndindex(2, 2, 2):
+        if o in (low, high, beside):
+            continue
+        mask = np.zeros(sumw.shape, dtype=bool)
+        mask[cells(o)] = True
+        inside = np.unique(adaptive.index[mask])
+        assert len(inside) > 50
+        assert not np.isin(inside, adaptive.index[~mask]).any()
+    # every leaf is a box
+    for leaf in range(adaptive.nleaves):
+        where = np.argwhere(adaptive.index == leaf)
+        assert len(where) == np.prod(where.max(axis=0) - where.min(axis=0) + 1)
+
+    leaves = adaptive.leaves
+    assert leaves.axes[0].nbins == adaptive.nleaves
+    assert leaves.inner(leaves.sumw)[merged] == 6 and leaves.inner(leaves.sumw)[corner] == 4
+    assert np.all(adaptive.index[sumw > 0] >= 0)
+    for a in fmc.binned_stats.SUMS:
+        assert np.isclose(getattr(leaves, a).sum(), getattr(prof3, a).sum())
+    # every cell gets the mean of its leaf
+    expanded = adaptive.expanded()
+    means = leaves.inner(leaves.means())
+    filled = adaptive.index >= 0
+    assert np.allclose(expanded.inner(expanded.means())[filled], means[adaptive.index[filled]])
+
+    # too few entries overall, a single leaf
+    few = fmc.adaptive_profile3(prof3, 10**6)
+    assert few.nleaves == 1 and np.all(few.index == 0)
+    empty = fmc.adaptive_profile3(fmc.binned_stats(axes), 20)
+    assert empty.nleaves == 0 and np.all(empty.index == -1)
@@ -0,0 +1,192 @@
+import os
+import numpy as np
+import awkward as ak
+import multiprocessing
+from helpers import *
+from selection import CutFlow, NUMU_CUTS
+
+# Runs the selection over flat CAF files in chunks of events, in a process
+# pool, accumulating histograms, cut-flow counts and the (run, subrun)s of the
+# sample. Only one chunk per process is in memory, and a chunk only loads the
+# branches its cuts, histograms and derived columns use. The results of the
+# chunks are sums, so they are the same however the sample is chunked or split
+# in runs over several file lists.
+#
+# Usage:
+#
+#   hists = {"recop": Histogram(lambda d: d["slc.ptrk.recop"], np.linspace(0, 2, 21), when="crthit")}
+#   ovrl = run(files, hists, derive=add_ptrk_columns, nproc=8)
+#   h = ovrl.hists["recop"] * goal_pot / NeutrinoPOT(ovrl.subruns)
+#
+# and, with the weights of each universe,
+#
+#   hists["recop_univ"] = UniverseHistogram(lambda d: d["slc.ptrk.recop"], bins, universe_weights, when="crthit")
+#   nominal, cov = universe_covariance(ovrl.hists["recop_univ"], goal_pot / NeutrinoPOT(ovrl.subruns))
+
+# Histogram of var(data) of the slices passing when: the name of a cut of the
+# cut-flow (the slices passing it and all the ones before), a function of the
+# data, or None for all of them
+class Histogram(object):
+    def __init__(self, var, bins, when=None):
+        self.var = var
+        self.bins = np.asarray(bins)
+        self.when = when
+
+    def selected(self, data, flow):
+        if isinstance(self.when, str):
+            return flow.when(self.when)
+        elif self.when is not None:
+            return self.when(data)
+        return None
+
+    def fill(self, data, flow):
+        var = self.var(data)
+        when = self.selected(data, flow)
+        if when is not None:
+            var = var[when]
+        if isinstance(var, ak.Array):
+            var = ak.to_numpy(ak.flatten(var, axis=None))
+        return np.histogram(var, bins=self.bins)[0]
+
+# Histograms of a per-slice var(data) in every systematic universe at once.
+# weights(data, when) returns the (N_slice x N_universe) weights of the
+# selected slices (all of them if when is None), e.g. from the SBNEventWeight
+# universes of their neutrinos. The counts are an (N_bin x (1 + N_universe))
+# array: the nominal histogram, then the histogram of each universe. Only the
+# weights of the selected slices of a chunk are in memory.
+class UniverseHistogram(Histogram):
+    def __init__(self, var, bins, weights, when=None):
+        super(UniverseHistogram, self).__init__(var, bins, when)
+        self.weights = weights
+
+    def fill(self, data, flow):
+        var = np.asarray(self.var(data))
+        when = self.selected(data, flow)
+        if when is not None:
+            var = var[when]
+        weights = np.asarray(self.weights(data, when))
+        nbins = len(self.bins) - 1
+
+        # the bin of each slice, once for all the universes (the last edge in
+        # the last bin, as np.histogram)
+        ibin = np.searchsorted(self.bins, var, side="right") - 1
+        ibin[var == self.bins[-1]] = nbins - 1
+        valid = (ibin >= 0) & (ibin < nbins)
+        ibin, weights = ibin[valid], weights[valid]
+
+        # sums of the weights of the slices of each bin, as consecutive rows
+        order = np.argsort(ibin, kind="stable")
+        ibin = ibin[order]
+        starts = np.flatnonzero(np.concatenate([[True], ibin[1:] != ibin[:-1]])) if len(ibin) else []
+
+        ret = np.zeros((nbins, weights.shape[1] + 1))
+        ret[:, 0] = np.bincount(ibin, minlength=nbins)
+        if len(ibin):
+            ret[ibin[starts], 1:] = np.add.reduceat(weights[order], starts, axis=0)
+        return ret
+
+# Nominal spectrum and covariance matrix of the counts of a UniverseHistogram,
+# scaled by the POT normalization. The spread of the universes is taken around
+# the nominal spectrum, or around their mean with center="mean"
+def universe_covariance(counts, scale=1., center="nominal"):
+    counts = counts * scale
+    nominal, universes = counts[:, 0], counts[:, 1:]
+    ref = nominal if center == "nominal" else universes.mean(axis=1)
+    diff = universes - ref[:, None]
+    return nominal, diff @ diff.T / universes.shape[1]
+
+# Unweighted counts of a run, to be scaled by the POT normalization of the
+# whole sample
+class RunResult(object):
+    def __init__(self, hists, cutflow, nslc, subruns, nevt):
+        self.hists = hists        # name -> counts in each bin
+        self.cutflow = cutflow    # slices passing each cut, cumulatively
+        self.nslc = nslc          # slices before any cut
+        self.subruns = subruns
+        self.nevt = nevt
+
+    def merge(self, other):
+        return RunResult({k: h + other.hists[k] for k, h in self.hists.items()},
+                         self.cutflow + other.cutflow, self.nslc + other.nslc,
+                         self.subruns.merge(other.subruns), self.nevt + other.nevt)
+
+# The slices of a flat CAF tree in entries [start, stop), as LazyData. The
+# branches of the slices ("slc.*") are flattened over the events, as the
+# per-slice arrays of the notebooks, and the branches in the groupings are
+# grouped by their counts as in load_caf (e.g. "slc.reco.trk.len" by
+# "slc.reco.ntrk", a list of tracks for each slice)
+def caf_chunk(tree, start, stop, cache=None, groupings=GROUPINGS):
+    def load(data, key):
+        d = tree["rec." + key].array(entry_start=start, entry_stop=stop)
+        for g in groupings:
+            if key.startswith(g + "."):
+                # the rows of all the events, in lists of the counts, which
+                # are themselves in lists of the events outside the slices
+                counts = data[grouping_counts(g)]
+                d = group(ak.flatten(d, axis=1), ak.flatten(counts, axis=None))
+                if counts.ndim > 1:
+                    d = group(d, ak.num(counts, axis=1))
+                break
+        else:
+            if key.startswith("slc."):
+                d = ak.flatten(d, axis=1)
+        return ak.to_numpy(d) if d.ndim == 1 else d
+    return LazyData(load, cache=cache)
+
+# The entry ranges of the chunks of each file
+def chunk_tasks(filenames, treename="recTree", step_size=100000):
+    import uproot
+    tasks = []
+    for fname in filenames:
+        with uproot.open(fname) as rootf:
+            nentries = rootf[treename].num_entries
+        tasks += [(fname, start, min(start + step_size, nentries)) for start in range(0, nentries, step_size)]
+    return tasks
+
+# Set by the pool initializer: with fork, the functions of the job (which
+# can be lambdas of a notebook) are inherited by the workers, not pickled
+_job = None
+def _init(job):
+    global _job
+    _job = job
+
+def _run_chunk(task):
+    import uproot
+    fname, start, stop = task
+    with uproot.open(fname) as rootf:
+        cache = None
+        if _job["cache_dir"] is not None:
+            cache = ColumnCache(os.path.join(_job["cache_dir"], file_fingerprint(fname, start, stop)))
+        data = caf_chunk(rootf[_job["treename"]], start, stop, cache)
+        if _job["derive"] is not None:
+            data.derive(_job["derive"])
+        flow = CutFlow(data, 1., _job["cuts"])
+        hists = {name: h.fill(data, flow) for name, h in _job["histograms"].items()}
+        return RunResult(hists, flow.counts(), flow.total(), SubrunSet.from_data(data), stop - start)
+
+# Runs the cuts and fills the histograms over the files. derive(data) adds
+# derived columns to each chunk before the cuts (see LazyData.derive). With
+# cache_dir, the cut masks and the columns derived with data.cached() are kept
+# on disk for each chunk, and reloaded in the next runs with the same
+# step_size and the same code of derive
+def run(filenames, histograms, cuts=NUMU_CUTS, derive=None, treename="recTree",
+        step_size=100000, nproc=4, cache_dir=None):
+    filenames = [filenames] if isinstance(filenames, str) else filenames
+    tasks = chunk_tasks(filenames, treename, step_size)
+    job = {"histograms": histograms, "cuts": cuts, "derive": derive, "treename": treename,
+           "cache_dir": cache_dir}
+    if nproc <= 1:
+        _init(job)
+        results = map(_run_chunk, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.get_context("fork").Pool(nproc, _init, (job,))
+        results = pool.imap_unordered(_run_chunk, tasks)
+
+    result = None
+    for r in results:
+        result = r if result is None else result.merge(r)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return result
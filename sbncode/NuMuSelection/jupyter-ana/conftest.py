@@ -0,0 +1,90 @@
+import numpy as np
+import awkward as ak
+import pytest
+
+from helpers import group
+
+# A small sample in the layout of a flat CAF file: every branch (without the
+# leading "rec.") a list per event, with the slices of each event and the
+# tracks of all its slices one after the other
+def make_events(nevt=300, seed=5):
+    rng = np.random.default_rng(seed)
+    nslc = rng.poisson(2., nevt)
+    ns = nslc.sum()
+    ntrk = rng.poisson(2., ns)
+    nt = ntrk.sum()
+    # the tracks of each event, one slice after the other
+    ntrk_evt = ak.to_numpy(ak.sum(group(ntrk, nslc), axis=1))
+    ncrt_hits = rng.poisson(1., nevt)
+    ncrt_tracks = rng.poisson(1., nevt)
+
+    slc = {
+        "slc.vertex.x": rng.uniform(-220., 220., ns),
+        "slc.vertex.y": rng.uniform(-220., 220., ns),
+        "slc.vertex.z": rng.uniform(-20., 520., ns),
+        "slc.nu_score": rng.uniform(0., 1., ns),
+        "slc.is_clear_cosmic": rng.random(ns) < 0.2,
+        "slc.fmatch.time": rng.uniform(-1., 3., ns),
+        "slc.fmatch.score": rng.uniform(0., 15., ns),
+        "slc.truth.index": rng.integers(-1, 2, ns),
+        "slc.truth.iscc": rng.random(ns) < 0.7,
+        "slc.truth.pdg": rng.choice([14, -14, 12], ns),
+        "slc.reco.ntrk": ntrk,
+    }
+    # the tracks start near the vertex of their slice
+    vertex = np.stack([np.repeat(slc["slc.vertex." + c], ntrk) for c in "xyz"])
+    start = vertex + rng.normal(0., 8., (3, nt))
+    end = start + rng.normal(0., 150., (3, nt))
+    trk = {
+        "slc.reco.trk.len": rng.uniform(0., 300., nt),
+        "slc.reco.trk.parent_is_primary": rng.random(nt) < 0.8,
+        "slc.reco.trk.bestplane": rng.integers(0, 3, nt),
+        "slc.reco.trk.rangeP.p_muon": rng.uniform(0., 3., nt),
+        "slc.reco.trk.mcsP.fwdP_muon": rng.uniform(-1., 9., nt),
+        "slc.reco.trk.crthit.distance": np.where(rng.random(nt) < 0.3, np.nan, rng.uniform(0., 20., nt)),
+        "slc.reco.trk.crthit.hit.time": rng.uniform(-2., 4., nt),
+        "slc.reco.trk.crttrack.angle": np.where(rng.random(nt) < 0.5, np.nan, rng.uniform(0., 0.2, nt)),
+        "slc.reco.trk.truth.p.pdg": rng.choice([13, -13, 211, 2212], nt),
+        "slc.reco.trk.truth.bestmatch.energy": rng.uniform(0., 1., nt),
+        # tracks without visible energy on the plane
+        "slc.reco.trk.truth.p.planeVisE": np.where(rng.random(nt) < 0.2, 0., rng.uniform(0., 1.5, nt)),
+    }
+    for c, i in zip("xyz", range(3)):
+        trk["slc.reco.trk.start." + c] = start[i]
+        trk["slc.reco.trk.end." + c] = end[i]
+    for p in range(3):
+        trk["slc.reco.trk.chi2pid%d.chi2_muon" % p] = rng.uniform(0., 60., nt)
+        trk["slc.reco.trk.chi2pid%d.chi2_proton" % p] = rng.uniform(0., 120., nt)
+
+    run = np.full(nevt, 1)
+    subrun = np.arange(nevt) // 40
+    events = {
+        "hdr.run": run, "hdr.subrun": subrun, "hdr.evt": np.arange(nevt),
+        # the subrun totals on the first event of each subrun
+        "hdr.pot": np.where(np.arange(nevt) % 40 == 0, 1e18 * (1 + subrun), 0.),
+        "hdr.ngenevt": np.where(np.arange(nevt) % 40 == 0, 40., 0.),
+        "nslc": nslc, "ncrt_hits": ncrt_hits, "ncrt_tracks": ncrt_tracks,
+        "crt_hits.time": group(rng.uniform(-3., 5., ncrt_hits.sum()), ncrt_hits),
+        "crt_tracks.time": group(rng.uniform(-3., 5., ncrt_tracks.sum()), ncrt_tracks),
+        "crt_tracks.hita.position.y": group(rng.uniform(-400., 400., ncrt_tracks.sum()), ncrt_tracks),
+        "crt_tracks.hitb.position.y": group(rng.uniform(-400., 400., ncrt_tracks.sum()), ncrt_tracks),
+    }
+    events.update({k: group(v, nslc) for k, v in slc.items()})
+    events.update({k: group(v, ntrk_evt) for k, v in trk.items()})
+    return events
+
+# The per-slice arrays of the notebooks: the slice branches flattened over the
+# events, the track branches grouped by the tracks of each slice
+def notebook_layout(events):
+    data = {}
+    for k, v in events.items():
+        if k.startswith("slc."):
+            v = ak.flatten(v, axis=1)
+        data[k] = ak.to_numpy(v) if v.ndim == 1 else v
+    for k in [k for k in data if k.startswith("slc.reco.trk.")]:
+        data[k] = group(data[k], data["slc.reco.ntrk"])
+    return data
+
+@pytest.fixture
+def events():
+    return make_events()
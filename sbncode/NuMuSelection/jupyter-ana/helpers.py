@@ -1,36 +1,285 @@
+import os
+import json
+import types
+import inspect
+import hashlib
 import numpy as np
 import awkward as ak
 
 # Broadcast a numpy array (var) over a sequence (nbroadcast)
 def broadcast(var, nbroadcast):
-    return np.repeat(var, nbroadcast)
+    return np.repeat(np.asarray(var), np.asarray(nbroadcast))
 
-# Broadcast an awkward array (var) over a sequence (nbroadcast)
+# Broadcast an awkward array (var) over a sequence (nbroadcast): each list of
+# var is repeated nbroadcast times
 def broadcast_ak(var, nbroadcast):
-    flat_var = var.flatten()
-    flat_nbroadcast = np.repeat(nbroadcast, var.counts)
+    counts = ak.to_numpy(ak.num(var, axis=1))
+    nbroadcast = np.asarray(nbroadcast)
 
-    flat_var_repeat = np.repeat(flat_var, flat_nbroadcast)
-    
-    # TODO: VECTORIZE THIS STEP!
-    reindex = np.hstack([np.add.outer(np.arange(0, var.counts[i]) * nbroadcast[i], np.arange(0, nbroadcast[i])).flatten("F") for i in range(len(nbroadcast))])
+    # start of each list of var and of each list of the output, in the flat arrays
+    starts = np.cumsum(counts) - counts
+    out_counts = np.repeat(counts, nbroadcast)
+    out_starts = np.cumsum(out_counts) - out_counts
 
-    reindex += np.repeat(np.hstack([[0], np.cumsum(nbroadcast * var.counts)[:-1]]), nbroadcast * var.counts)
-    flat_var_repeat_ordered = flat_var_repeat[reindex]
-    return group(flat_var_repeat_ordered, np.repeat(var.counts, nbroadcast))
+    reindex = np.arange(out_counts.sum()) + np.repeat(np.repeat(starts, nbroadcast) - out_starts, out_counts)
+    return group(ak.flatten(var, axis=1)[reindex], out_counts)
 
 # Group a numpy array (var) into an awkward array by groups (ngroup)
 def group(var, ngroup):
-    return ak.JaggedArray.fromcounts(ngroup, var)
+    return ak.unflatten(var, np.asarray(ngroup))
+
+# Directory of the modules of this analysis, whose functions are part of the
+# source hash of the functions that use them
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _is_local(fn):
+    try:
+        return fn.__module__ == "__main__" or os.path.dirname(os.path.abspath(inspect.getsourcefile(fn))) == _HERE
+    except TypeError:
+        return False
+
+# Hash of the source of fn, of the functions of this analysis (or of the
+# notebook) it calls, and of the constants it uses (scalars, arrays and
+# containers of them, as globals or in its closure), so a column is
+# recomputed only when the code that derives it changes
+def source_hash(fn):
+    h = hashlib.sha1()
+    seen = set()
+    def add_value(name, value):
+        value = getattr(value, "py_func", value) # numba
+        if isinstance(value, types.FunctionType):
+            if _is_local(value):
+                add(value)
+        elif isinstance(value, (bool, int, float, str, type(None))):
+            h.update(("%s=%r" % (name, value)).encode())
+        elif isinstance(value, (np.ndarray, np.generic)) and not value.dtype.hasobject:
+            h.update(("%s=%s%r" % (name, value.dtype.str, np.shape(value))).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (list, tuple)) and id(value) not in seen:
+            seen.add(id(value))
+            h.update(("%s=%s(%d)" % (name, type(value).__name__, len(value))).encode())
+            for i, v in enumerate(value):
+                add_value("%s[%d]" % (name, i), v)
+        elif isinstance(value, dict) and not isinstance(value, LazyData) and id(value) not in seen:
+            seen.add(id(value))
+            for k in sorted(value, key=repr):
+                add_value("%s[%r]" % (name, k), value[k])
+    def add(fn):
+        fn = getattr(fn, "py_func", fn) # numba
+        if fn in seen:
+            return
+        seen.add(fn)
+        try:
+            h.update(inspect.getsource(fn).encode())
+        except (OSError, TypeError):
+            h.update(fn.__code__.co_code)
+        for name, cell in zip(fn.__code__.co_freevars, fn.__closure__ or ()):
+            try:
+                add_value(name, cell.cell_contents)
+            except ValueError: # not set yet
+                pass
+        codes = [fn.__code__]
+        while codes:
+            code = codes.pop()
+            codes += [c for c in code.co_consts if inspect.iscode(c)]
+            for name in code.co_names:
+                if name in fn.__globals__:
+                    add_value(name, fn.__globals__[name])
+    add(fn)
+    return h.hexdigest()[:16]
+
+# Name of the cache directory of a CAF file (and of a part of it, e.g. an
+# entry range), changing with its path, size and modification time
+def file_fingerprint(filename, *extra):
+    st = os.stat(filename)
+    key = "%s:%d:%d:%r" % (os.path.realpath(filename), st.st_size, st.st_mtime_ns, extra)
+    return os.path.basename(filename) + "-" + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+# Derived columns of one CAF file (or chunk) on disk: fn(data) is stored as
+# <key>-<source_hash(fn)>.npz in directory (with the hash of the code that
+# derived its inputs, see LazyData.derive), and loaded instead of recomputed
+# while neither the file nor that code changes
+class ColumnCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key, fn, upstream=""):
+        h = source_hash(fn)
+        if upstream:
+            h = hashlib.sha1((h + upstream).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, "%s-%s.npz" % (key, h))
+
+    @staticmethod
+    def save(path, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(value, ak.Array):
+            form, length, buffers = ak.to_buffers(value)
+            arrays = dict(buffers, _form=np.array(form.to_json()), _length=np.array(length))
+        else:
+            arrays = {"values": np.asarray(value)}
+        # written aside and moved, so readers never see a partial file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            if "_form" in f:
+                buffers = {k: f[k] for k in f.files if not k.startswith("_")}
+                return ak.from_buffers(json.loads(str(f["_form"])), int(f["_length"]), buffers)
+            return f["values"]
+
+# Dictionary of CAF branches (keys without the leading "rec."), each loaded
+# on first access with loader(data, key). Derived quantities are set with
+# derive(), or computed once with cached(), also across sessions with a
+# ColumnCache. Columns set in any other way are unhashed: the cache cannot
+# tell when the code behind them changes, so what is computed from them is
+# never kept on disk
+class LazyData(dict):
+    def __init__(self, loader=None, data=None, cache=None):
+        super().__init__(data or {})
+        self.loader = loader
+        self.cache = cache
+        self.loaded = []
+        self.upstream = ""   # hash of the code of the derive()s so far
+        self.unhashed = set(self.keys())
+        self._reads = None   # keys read by the column being computed
+        self._deriving = False
+
+    def __missing__(self, key):
+        if self.loader is None:
+            raise KeyError(key)
+        value = self.loader(self, key)
+        dict.__setitem__(self, key, value)
+        self.loaded.append(key)
+        return value
+
+    def __getitem__(self, key):
+        if self._reads is not None:
+            self._reads.add(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self._deriving:
+            self.unhashed.discard(key)
+        else:
+            self.unhashed.add(key)
+
+    # Runs fn(self), which sets derived columns (e.g. add_ptrk_columns). The
+    # source hash of fn is part of the cache key of every column computed
+    # from then on
+    def derive(self, fn):
+        self.upstream = hashlib.sha1((self.upstream + source_hash(fn)).encode()).hexdigest()[:16]
+        self._deriving = True
+        try:
+            fn(self)
+        finally:
+            self._deriving = False
+
+    # fn(self), from the cache if there is one
+    def column(self, key, fn):
+        return self._column(key, fn)[0]
+
+    # fn(self), and whether it read only columns whose code is in the key
+    def _column(self, key, fn):
+        path = self.cache.path(key, fn, self.upstream) if self.cache is not None else None
+        if path is not None and os.path.exists(path):
+            return self.cache.load(path), True
+        outer, self._reads = self._reads, set()
+        try:
+            value = fn(self)
+        finally:
+            reads, self._reads = self._reads, outer
+            if outer is not None:
+                outer |= reads
+        hashed = not (reads & self.unhashed)
+        if path is not None and hashed:
+            self.cache.save(path, value)
+        return value, hashed
+
+    def cached(self, key, fn):
+        if not dict.__contains__(self, key):
+            value, hashed = self._column(key, fn)
+            dict.__setitem__(self, key, value)
+            if not hashed:
+                self.unhashed.add(key)
+        return self[key]
+
+# fn(data), computed once and kept in data if it is a LazyData
+def cached(data, key, fn):
+    if isinstance(data, LazyData):
+        return data.cached(key, fn)
+    return fn(data)
+
+# Branches of a flat CAF file, loaded only when they are used. Branches in
+# the groupings are grouped by their counts (e.g. "slc.reco.trk.len" by
+# "slc.reco.ntrk"), as in the notebooks. With cache_dir, the derived columns
+# are kept on disk
+GROUPINGS = ["slc.reco.trk", "crt_hits", "mc.nu.prim", "slc.truth.prim", "crt_tracks"]
+
+# The branch with the counts of a grouping, e.g. "slc.reco.ntrk"
+def grouping_counts(g):
+    return g.replace(g.split(".")[-1], "n"+g.split(".")[-1])
+
+def load_caf(rootf, treenames, groupings=GROUPINGS, cache_dir=None):
+    def load(data, key):
+        keyname = "rec." + key
+        for t in treenames:
+            if not keyname.startswith(t):
+                continue
+            try:
+                d = rootf["recTree"][t].array(keyname)
+            except KeyError:
+                continue
+            break
+        else:
+            raise KeyError(keyname)
+
+        for g in groupings:
+            if key.startswith(g):
+                d = group(d, data[grouping_counts(g)])
+        return d
+    cache = ColumnCache(os.path.join(cache_dir, file_fingerprint(rootf.file_path))) if cache_dir else None
+    return LazyData(load, cache=cache)
+
+# The (run, subrun)s of a sample with their POT and generated events, each
+# counted once. Sets of chunks or files of a sample merge into the set of
+# the whole sample, whatever the chunking. Within a subrun the largest value
+# is kept, so it does not matter which events carry the subrun totals
+class SubrunSet(object):
+    def __init__(self, run=(), subrun=(), pot=(), ngenevt=()):
+        keys = np.stack([np.asarray(run, dtype=np.int64), np.asarray(subrun, dtype=np.int64)], axis=-1).reshape(-1, 2)
+        keys, inv = np.unique(keys, axis=0, return_inverse=True)
+        inv = inv.reshape(-1)
+        self.run, self.subrun = keys[:, 0], keys[:, 1]
+        self.pot = np.zeros(len(keys))
+        self.ngenevt = np.zeros(len(keys))
+        np.maximum.at(self.pot, inv, np.asarray(pot, dtype=float))
+        np.maximum.at(self.ngenevt, inv, np.asarray(ngenevt, dtype=float))
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data["hdr.run"], data["hdr.subrun"], data["hdr.pot"], data["hdr.ngenevt"])
+
+    def merge(self, other):
+        return SubrunSet(np.concatenate([self.run, other.run]), np.concatenate([self.subrun, other.subrun]),
+                         np.concatenate([self.pot, other.pot]), np.concatenate([self.ngenevt, other.ngenevt]))
+
+    def __len__(self):
+        return len(self.run)
+
+def _subruns(data):
+    return data if isinstance(data, SubrunSet) else SubrunSet.from_data(data)
 
-# normalize
+# normalize (data is a sample or its SubrunSet)
 def NeutrinoPOT(data):
-    _, ind = np.unique(data["hdr.subrun"] + data["hdr.run"]*100, return_index=True)
-    return np.sum(data["hdr.pot"][ind])
+    return np.sum(_subruns(data).pot)
 
 def NGenEvt(data):
-    _, ind = np.unique(data["hdr.subrun"] + data["hdr.run"]*100, return_index=True)
-    return np.sum(data["hdr.ngenevt"][ind])
+    return np.sum(_subruns(data).ngenevt)
 
 def NEvt(data):
     return len(data["hdr.evt"])
@@ -39,6 +288,5 @@ def NEvt(data):
 POT_PER_SPILL = 5e12
 def CosmicPOT(cosmic, nu):
     neutrino_per_spill = (NGenEvt(nu) * POT_PER_SPILL) / NeutrinoPOT(nu)
-    _, ind = np.unique(nu["hdr.subrun"] + nu["hdr.run"]*100, return_index=True)
     n_cosmic_evt = NGenEvt(cosmic)
     return n_cosmic_evt * POT_PER_SPILL / (1. - neutrino_per_spill)
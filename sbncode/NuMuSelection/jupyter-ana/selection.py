@@ -1,4 +1,6 @@
 import numpy as np
+import awkward as ak
+import numba
 from helpers import *
 
 def InBeam(t): # us
@@ -21,45 +23,133 @@ def InFV(x, y, z): # cm
     return (x > xmin) & (x < xmax) & (y > ymin) & (y < ymax) & (z > zmin) & (z < zmax)
 
 # Primary track calculation
+#
+# The kernels loop once over the tracks of each slice, using the offsets of
+# the per-slice track arrays, and return flat arrays aligned with the slices
+# with the index of the track in its slice (-1 for none).
+
+# Flat values and offsets of a per-slice (jagged) track array
+def track_offsets(var):
+    counts = ak.to_numpy(ak.num(var, axis=1))
+    return np.concatenate([[0], np.cumsum(counts)])
+
+def track_values(var):
+    return ak.to_numpy(ak.flatten(var, axis=1))
+
+@numba.njit
+def _primary_track_kernel(offsets, atslc, parent_is_primary, contained, length, chi2_proton, chi2_muon):
+    ret = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    for i in range(len(offsets) - 1):
+        best = -np.inf
+        for j in range(offsets[i], offsets[i+1]):
+            # these are the tracks that we consider as coming from the neutrino vertex
+            if not (atslc[j] and parent_is_primary[j]):
+                continue
+            if contained[j]:
+                maybe_muon = (chi2_proton[j] > 60) and (chi2_muon[j] < 30) and (length[j] > 50)
+            else:
+                maybe_muon = length[j] > 100
+            # the longest one
+            if maybe_muon and length[j] > best:
+                best = length[j]
+                ret[i] = j - offsets[i]
+    return ret
+
 def get_primary_tracks(data):
-    # these are the tracks that we consider as coming from the neutrino vertex
-    from_slice = data["slc.reco.trk.atslc"] & data["slc.reco.trk.parent_is_primary"]
-    
-    maybe_muon_exiting = np.invert(data["slc.reco.trk.contained"]) & (data["slc.reco.trk.len"] > 100)
-    maybe_muon_contained = data["slc.reco.trk.contained"] & (data["slc.reco.trk.bestplane.chi2_proton"] > 60) & (data["slc.reco.trk.bestplane.chi2_muon"] < 30) & (data["slc.reco.trk.len"] > 50)
-    # In cases where all the tracks are contained, first apply cuts on the particle ID
-    maybe_muon = from_slice & (maybe_muon_contained | maybe_muon_exiting)
-    has_maybe_muon = maybe_muon.any()
-    
-    # Cases where all the tracks are contained
-    ret = (data["slc.reco.trk.len"]*maybe_muon).argmax().max()
-    # map very small to -1
-    ret[ret < 0] = -1
-    ret[np.invert(has_maybe_muon)] = -1
+    length = data["slc.reco.trk.len"]
+    return _primary_track_kernel(track_offsets(length),
+        track_values(data["slc.reco.trk.atslc"]), track_values(data["slc.reco.trk.parent_is_primary"]),
+        track_values(data["slc.reco.trk.contained"]), track_values(length),
+        track_values(data["slc.reco.trk.bestplane.chi2_proton"]), track_values(data["slc.reco.trk.bestplane.chi2_muon"]))
+
+# numpy division, as the array expression it replaces: a track with energy
+# but no visible energy on the plane (energy/0 = inf) is matched, one with
+# neither (0/0 = nan) is not
+@numba.njit(error_model="numpy")
+def _true_primary_track_kernel(offsets, pdg, energy, visE):
+    ret = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    for i in range(len(offsets) - 1):
+        # the first track matched to a true muon
+        for j in range(offsets[i], offsets[i+1]):
+            if abs(pdg[j]) == 13 and energy[j] / visE[j] > 0.5:
+                ret[i] = j - offsets[i]
+                break
     return ret
 
 # Using truth to get the primary track
 def get_true_primary_track(data):
-    ret = ((np.abs(data["slc.reco.trk.truth.p.pdg"]) == 13) & \
-    (data["slc.reco.trk.truth.bestmatch.energy"] / data["slc.reco.trk.truth.p.planeVisE"] > 0.5)).argmax().max()
+    pdg = data["slc.reco.trk.truth.p.pdg"]
+    ret = _true_primary_track_kernel(track_offsets(pdg), track_values(pdg),
+        track_values(data["slc.reco.trk.truth.bestmatch.energy"]), track_values(data["slc.reco.trk.truth.p.planeVisE"]))
     is_numu_cc = (data["slc.truth.index"] >= 0) & data["slc.truth.iscc"] & (np.abs(data["slc.truth.pdg"]) == 14)
     # ignore non cc numu cases
     ret[np.invert(is_numu_cc)] = -1
-    ret[ret<0] = -1
-    # setup for index
-    #ret = group(ret, np.ones(ret.shape, dtype="int"))
     return ret
 
+# The values of var (a per-slice track array) of the primary track of each
+# slice, NaN (or False) for slices without one
+def ptrk_values(var, primary_track):
+    has_ptrk = primary_track >= 0
+    values = track_values(var)
+    index = track_offsets(var)[:-1][has_ptrk] + primary_track[has_ptrk]
+    if values.dtype == bool:
+        ptrk = np.zeros(len(primary_track), dtype=bool)
+    else:
+        ptrk = np.full(len(primary_track), np.nan)
+    ptrk[has_ptrk] = values[index]
+    return ptrk
+
+# Set the "slc.ptrk.*" variables of each slice from the "slc.reco.trk.*" of
+# its primary track, NaN (or False) for slices without one
+def set_ptrk_columns(data, primary_track):
+    for k in [k for k in data.keys() if k.startswith("slc.reco.trk.")]:
+        data[k.replace(".reco.trk.", ".ptrk.")] = ptrk_values(data[k], primary_track)
+    data["slc.has_ptrk"] = primary_track >= 0
+
+# The derived track columns of the notebooks (contained, atslc, recop and the
+# chi2s of the best plane) and the "slc.ptrk.*" of the primary track of each
+# slice, e.g. as the derive of caf_runner.run. In a LazyData the "slc.ptrk.*"
+# are only made when they are used, from the "slc.reco.trk.*" they need
+def add_ptrk_columns(data):
+    trk = lambda v: data["slc.reco.trk." + v]
+    data["slc.reco.trk.contained"] = InFV(trk("end.x"), trk("end.y"), trk("end.z"))
+    data["slc.reco.trk.atslc"] = np.sqrt((trk("start.x") - data["slc.vertex.x"])**2 +
+                                         (trk("start.y") - data["slc.vertex.y"])**2 +
+                                         (trk("start.z") - data["slc.vertex.z"])**2) < 10
+    data["slc.reco.trk.recop"] = ak.where(trk("contained"), trk("rangeP.p_muon"), trk("mcsP.fwdP_muon"))
+    for chi2 in ["chi2_muon", "chi2_proton"]:
+        data["slc.reco.trk.bestplane." + chi2] = ak.where(trk("bestplane") == 0, trk("chi2pid0." + chi2),
+            ak.where(trk("bestplane") == 1, trk("chi2pid1." + chi2), trk("chi2pid2." + chi2)))
+
+    primary_track = get_primary_tracks(data)
+    if not isinstance(data, LazyData):
+        set_ptrk_columns(data, primary_track)
+        return
+    data["slc.has_ptrk"] = primary_track >= 0
+    load = data.loader
+    def load_ptrk(data, key):
+        if key.startswith("slc.ptrk."):
+            return ptrk_values(data[key.replace(".ptrk.", ".reco.trk.")], primary_track)
+        return load(data, key)
+    data.loader = load_ptrk
+
 # Define the Cuts!!!!!
+
+# Whether any entry of each event passes (a jagged mask), as a numpy array
+def any_per_evt(mask):
+    return ak.to_numpy(ak.any(mask, axis=1))
+
 def crtveto(data):
-    return broadcast(np.invert(InBeamVeto(data["crt_hits.time"]).any()), data["nslc"])
+    return broadcast(np.invert(any_per_evt(InBeamVeto(data["crt_hits.time"]))), data["nslc"])
+def crttrack_inbeam(data):
+    return cached(data, "crt_tracks.inbeam", lambda d: InBeamVeto(d["crt_tracks.time"]))
 def crttrackveto_perevt(data):
-    return np.invert(InBeamVeto(data["crt_tracks.time"]).any())
+    return np.invert(any_per_evt(crttrack_inbeam(data)))
 def crttrackveto(data):
     return broadcast(crttrackveto_perevt(data), data["nslc"])
 
 def crttrackveto_nobottom_perevt(data):
-    return np.invert((InBeamVeto(data["crt_tracks.time"]) & (data["crt_tracks.hita.position.y"] > -357.) & (data["crt_tracks.hitb.position.y"] > -357.)).any())
+    return np.invert(any_per_evt(crttrack_inbeam(data) & (data["crt_tracks.hita.position.y"] > -357.) & (data["crt_tracks.hitb.position.y"] > -357.)))
 def crttrackveto_nobottom(data):
     return broadcast(crttrackveto_nobottom_perevt(data), data["nslc"])
 
@@ -77,3 +167,102 @@ def crttrack(data):
     return np.isnan(data["slc.ptrk.crttrack.angle"]) | (data["slc.ptrk.crttrack.angle"] > 0.05)
 def crthit(data):
     return np.isnan(data["slc.ptrk.crthit.distance"]) | (data["slc.ptrk.crthit.distance"] > 5) | InBeam(data["slc.ptrk.crthit.hit.time"])
+
+# The NuMu selection, in order
+NUMU_CUTS = [
+    ("fid", fid),
+    ("nu_score", nu_score),
+    ("f_time", f_time),
+    ("f_score", f_score),
+    ("ptrk", ptrk),
+    ("crttrack", crttrack),
+    ("crthit", crthit),
+    ("crtveto", crtveto),
+]
+
+# Named cuts on the slices of a sample, applied cumulatively. Each cut is
+# evaluated once, on first use, and the branches it reads are loaded only
+# then when data is a LazyData (see load_caf). With a ColumnCache, the masks
+# are reloaded until the code of their cut, or of the derive() of the columns
+# it reads, changes. Counts are scaled by the
+# POT normalization of the sample (pot_scale).
+class CutFlow(object):
+    def __init__(self, data, pot_scale=1., cuts=NUMU_CUTS):
+        self.data = data if isinstance(data, LazyData) else LazyData(data=data)
+        self.pot_scale = pot_scale
+        self.cuts = []
+        self.masks = {}
+        self._cumulative = None
+        for name, cut in cuts:
+            self.add(name, cut)
+
+    def add(self, name, cut):
+        self.cuts.append((name, cut))
+        self._cumulative = None
+        return self
+
+    def names(self):
+        return [name for name, _ in self.cuts]
+
+    # The slices passing a single cut
+    def mask(self, name):
+        if name not in self.masks:
+            self.masks[name] = self.data.column("cut." + name, dict(self.cuts)[name])
+        return self.masks[name]
+
+    # The slices passing each cut and all the ones before it, in one pass
+    def cumulative(self):
+        if self._cumulative is None:
+            self._cumulative = []
+            when = None
+            for name in self.names():
+                when = self.mask(name) if when is None else when & self.mask(name)
+                self._cumulative.append(when)
+        return self._cumulative
+
+    # The slices passing all the cuts up to (and including) the cut upto,
+    # leaving out the ones in without
+    def when(self, upto=None, without=()):
+        names = self.names()
+        names = names[:names.index(upto)+1] if upto is not None else names
+        if upto is not None and not without:
+            return self.cumulative()[len(names)-1]
+        when = np.ones(self._nslc(), dtype=bool)
+        for name in names:
+            if name not in without:
+                when = when & self.mask(name)
+        return when
+
+    def _nslc(self):
+        return len(self.mask(self.names()[0]))
+
+    def _category(self, category):
+        # a mask, a function of the data (like Category.when) or None
+        if category is None:
+            return np.ones(self._nslc(), dtype=bool)
+        return category(self.data) if callable(category) else category
+
+    # POT-weighted number of slices in the category before any cut
+    def total(self, category=None):
+        return self.pot_scale * np.sum(self._category(category))
+
+    # POT-weighted number of slices in the category after each cut
+    def counts(self, category=None):
+        category = self._category(category)
+        return np.array([self.pot_scale * np.sum(when & category) for when in self.cumulative()])
+
+    # Fraction of the slices in the category left after each cut
+    def efficiencies(self, category=None):
+        return self.counts(category) / self.total(category)
+
+    # The CAF branches loaded to evaluate the cuts
+    def branches(self):
+        return list(self.data.loaded)
+
+# Counts and efficiencies of the cut-flows of several samples together (e.g.
+# overlay and intime cosmics), each with its POT normalization
+def cutflow_counts(flows, category=None):
+    return np.sum([f.counts(category) for f in flows], axis=0)
+
+def cutflow_efficiencies(flows, category=None):
+    return cutflow_counts(flows, category) / np.sum([f.total(category) for f in flows])
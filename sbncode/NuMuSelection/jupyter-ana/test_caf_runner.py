@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import uproot
+import pytest
+
+from conftest import notebook_layout
+from selection import *
+from caf_runner import *
+
+@pytest.fixture
+def caf_file(tmp_path, events):
+    fname = str(tmp_path / "sample.flat.root")
+    branches = {"rec." + k: v for k, v in events.items()}
+    with uproot.recreate(fname) as f:
+        f.mktree("recTree", {k: v.type.content if isinstance(v, ak.Array) else v.dtype for k, v in branches.items()})
+        f["recTree"].extend(branches)
+    return fname
+
+def _histograms():
+    return {"recop": Histogram(lambda d: d["slc.ptrk.recop"], np.linspace(0, 3, 16), when="crthit"),
+            "ntrk": Histogram(lambda d: d["slc.reco.ntrk"], np.arange(8)),
+            "trk_len": Histogram(lambda d: d["slc.reco.trk.len"], np.linspace(0, 300, 11), when="fid")}
+
+def test_chunking(caf_file, events):
+    ref = None
+    for step_size, nproc in [(300, 1), (70, 1), (33, 2), (7, 3)]:
+        r = run(caf_file, _histograms(), derive=add_ptrk_columns, step_size=step_size, nproc=nproc)
+        assert r.nevt == len(events["nslc"])
+        if ref is None:
+            ref = r
+            continue
+        assert NeutrinoPOT(r.subruns) == NeutrinoPOT(ref.subruns)
+        assert NGenEvt(r.subruns) == NGenEvt(ref.subruns)
+        assert r.nslc == ref.nslc
+        assert np.array_equal(r.cutflow, ref.cutflow)
+        for name, h in ref.hists.items():
+            assert np.array_equal(r.hists[name], h), (step_size, name)
+
+    # the same as the whole sample at once, in the layout of the notebooks
+    data = notebook_layout(events)
+    add_ptrk_columns(data)
+    flow = CutFlow(data)
+    assert np.array_equal(ref.cutflow, flow.counts())
+    for name, h in _histograms().items():
+        assert np.array_equal(ref.hists[name], h.fill(data, flow)), name
+    assert NeutrinoPOT(ref.subruns) == NeutrinoPOT(data) > 0
+
+def test_caf_chunk_groups_tracks(caf_file, events):
+    with uproot.open(caf_file) as rootf:
+        data = caf_chunk(rootf["recTree"], 10, 60)
+        ntrk = data["slc.reco.ntrk"]
+        length = data["slc.reco.trk.len"]
+        assert np.array_equal(ak.num(length, axis=1), ntrk)
+        assert len(ntrk) == events["nslc"][10:60].sum()
+        assert ak.to_list(data["crt_hits.time"]) == ak.to_list(events["crt_hits.time"][10:60])
+        # the tracks of each slice, as get_primary_tracks needs them
+        add_ptrk_columns(data)
+        assert len(data["slc.ptrk.len"]) == len(ntrk)
+
+# add_ptrk_columns with no primary tracks, as a change of get_primary_tracks
+def _derive_no_ptrk(data):
+    add_ptrk_columns(data)
+    data["slc.has_ptrk"] = np.zeros(len(data["slc.has_ptrk"]), dtype=bool)
+
+def test_cache_follows_derive(caf_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    flows = []
+    for derive in [add_ptrk_columns, _derive_no_ptrk, add_ptrk_columns]:
+        cached = run(caf_file, {}, derive=derive, step_size=100, nproc=1, cache_dir=cache_dir)
+        fresh = run(caf_file, {}, derive=derive, step_size=100, nproc=1)
+        assert np.array_equal(cached.cutflow, fresh.cutflow)
+        flows.append(cached.cutflow)
+    assert not np.array_equal(flows[0], flows[1])
+    # the second run of add_ptrk_columns loads its masks
+    assert len(os.listdir(cache_dir)) == 3
+
+def _universe_weights(data, when):
+    # ten universes, the weights a function of each slice
+    x = data["slc.vertex.x"] if when is None else data["slc.vertex.x"][when]
+    return 1. + 0.5*np.sin(np.outer(x, np.arange(1, 11)) / 50.)
+
+def test_universe_fill():
+    rng = np.random.default_rng(9)
+    n = 5000
+    bins = np.linspace(0., 10., 21)
+    var = rng.uniform(-1., 11., n)
+    var[rng.random(n) < 0.05] = np.nan
+    # on the first, inner and last edges
+    var[:30] = bins[-1]
+    var[30:40] = bins[0]
+    var[40:50] = bins[7]
+    data = {"var": var, "slc.vertex.x": rng.uniform(-200., 200., n), "pass": rng.random(n) < 0.7}
+    for when in [None, lambda d: d["pass"]]:
+        h = UniverseHistogram(lambda d: d["var"], bins, _universe_weights, when=when)
+        counts = h.fill(data, None)
+        sel = np.ones(n, dtype=bool) if when is None else data["pass"]
+        weights = _universe_weights(data, None)[sel]
+        assert counts.shape == (len(bins) - 1, 11)
+        assert np.array_equal(counts[:, 0], np.histogram(var[sel], bins)[0])
+        for u in range(10):
+            assert np.allclose(counts[:, u + 1], np.histogram(var[sel], bins, weights=weights[:, u])[0])
+    # nothing selected
+    h = UniverseHistogram(lambda d: d["var"], bins, _universe_weights, when=lambda d: np.zeros(n, dtype=bool))
+    assert np.array_equal(h.fill(data, None), np.zeros((len(bins) - 1, 11)))
+
+def test_universe_chunking(caf_file, events):
+    def histograms():
+        return {"univ": UniverseHistogram(lambda d: d["slc.ptrk.recop"], np.linspace(0, 3, 16),
+                                          _universe_weights, when="crthit")}
+    ref = run(caf_file, histograms(), derive=add_ptrk_columns, step_size=300, nproc=1)
+    for step_size, nproc in [(70, 1), (33, 2), (7, 3)]:
+        r = run(caf_file, histograms(), derive=add_ptrk_columns, step_size=step_size, nproc=nproc)
+        assert np.allclose(r.hists["univ"], ref.hists["univ"], rtol=1e-12, atol=0.), (step_size, nproc)
+    data = notebook_layout(events)
+    add_ptrk_columns(data)
+    assert np.allclose(ref.hists["univ"], histograms()["univ"].fill(data, CutFlow(data)), rtol=1e-12)
+    assert ref.hists["univ"][:, 0].sum() > 0
+
+def test_universe_covariance():
+    rng = np.random.default_rng(10)
+    counts = rng.uniform(50., 100., (6, 1 + 40))
+    scale = 0.3
+    nominal, cov = universe_covariance(counts, scale)
+    assert np.allclose(nominal, scale*counts[:, 0])
+    ref = np.zeros((6, 6))
+    for u in range(1, 41):
+        d = scale*(counts[:, u] - counts[:, 0])
+        ref += np.outer(d, d) / 40
+    assert np.allclose(cov, ref)
+    # around the mean of the universes, the (biased) covariance of the universes
+    nominal, cov = universe_covariance(counts, scale, center="mean")
+    assert np.allclose(nominal, scale*counts[:, 0])
+    assert np.allclose(cov, np.cov(scale*counts[:, 1:], bias=True))
+    assert np.all(np.linalg.eigvalsh(cov) > -1e-9)
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+import awkward as ak
+
+from helpers import *
+
+# The reindexing of broadcast_ak before it was vectorized, with awkward 2
+# in place of the JaggedArray methods
+def _broadcast_ak_loop(var, nbroadcast):
+    counts = ak.to_numpy(ak.num(var, axis=1))
+    flat_var = ak.to_numpy(ak.flatten(var, axis=1))
+    flat_nbroadcast = np.repeat(nbroadcast, counts)
+    flat_var_repeat = np.repeat(flat_var, flat_nbroadcast)
+    reindex = np.hstack([[]] + [np.add.outer(np.arange(0, counts[i]) * nbroadcast[i], np.arange(0, nbroadcast[i])).flatten("F")
+                                for i in range(len(nbroadcast))]).astype(np.int64)
+    reindex += np.repeat(np.hstack([[0], np.cumsum(nbroadcast * counts)[:-1]]), nbroadcast * counts).astype(np.int64)
+    return group(flat_var_repeat[reindex], np.repeat(counts, nbroadcast))
+
+def test_broadcast_ak():
+    rng = np.random.default_rng(2)
+    for counts, nbroadcast in [(rng.integers(0, 4, 200), rng.integers(0, 4, 200)),
+                               (np.array([0, 2, 0, 3]), np.array([2, 0, 1, 3])),
+                               (np.zeros(3, dtype=int), np.array([1, 2, 0])),
+                               (np.array([1, 2]), np.zeros(2, dtype=int))]:
+        var = group(rng.normal(size=counts.sum()), counts)
+        ret = broadcast_ak(var, nbroadcast)
+        assert len(ret) == nbroadcast.sum()
+        assert ak.to_list(ret) == ak.to_list(_broadcast_ak_loop(var, nbroadcast))
+
+def test_broadcast_ak_empty():
+    var = group(np.zeros(0), np.zeros(0, dtype=int))
+    assert len(broadcast_ak(var, np.zeros(0, dtype=int))) == 0
+
+def test_broadcast():
+    assert list(broadcast(np.array([1, 2, 3]), [2, 0, 1])) == [1, 1, 3]
+
+SCALE = np.array([1., 2.])
+
+def _double(d):
+    return d["x"] * 2
+
+def _triple(d):
+    return d["x"] * 3
+
+upstream = _double
+
+def _derive(d):
+    d["y"] = upstream(d)
+
+def _cut(d):
+    return d["y"] > 5
+
+def _scaled(d):
+    return d["x"] * SCALE[1]
+
+def _with_closure(scale):
+    return lambda d: d["x"] * scale
+
+def _lazy(tmp_path):
+    return LazyData(lambda d, key: np.arange(5.), cache=ColumnCache(str(tmp_path)))
+
+def test_source_hash():
+    global upstream
+    before = source_hash(_derive)
+    upstream = _triple
+    try:
+        assert source_hash(_derive) != before
+    finally:
+        upstream = _double
+    assert source_hash(_derive) == before
+
+    before = source_hash(_scaled)
+    SCALE[1] = 4.
+    try:
+        assert source_hash(_scaled) != before
+    finally:
+        SCALE[1] = 2.
+    assert source_hash(_with_closure(2.)) != source_hash(_with_closure(3.))
+
+def test_mask_follows_derive(tmp_path):
+    # the mask of a cut on a derived column is recomputed when the function
+    # that derives the column changes
+    global upstream
+    data = _lazy(tmp_path)
+    data.derive(_derive)
+    assert list(data.column("cut", _cut)) == [False, False, False, True, True]
+    assert len(os.listdir(tmp_path)) == 1
+
+    upstream = _triple
+    try:
+        data = _lazy(tmp_path)
+        data.derive(_derive)
+        assert list(data.column("cut", _cut)) == [False, False, True, True, True]
+    finally:
+        upstream = _double
+    assert len(os.listdir(tmp_path)) == 2
+    # reloaded with the first derive
+    data = _lazy(tmp_path)
+    data.derive(_derive)
+    assert os.path.exists(data.cache.path("cut", _cut, data.upstream))
+    assert list(data.column("cut", _cut)) == [False, False, False, True, True]
+
+def test_unhashed_columns_not_cached(tmp_path):
+    # columns set outside derive() are not kept, nor what is computed from them
+    data = _lazy(tmp_path)
+    data["y"] = data["x"] * 2
+    assert list(data.cached("z", _cut)) == [False, False, False, True, True]
+    assert "z" in data.unhashed
+    data.column("w", lambda d: d["z"] & True)
+    # only what reads the branches is kept
+    data.column("v", lambda d: d["x"] > 1)
+    assert [f.split("-")[0] for f in os.listdir(tmp_path)] == ["v"]
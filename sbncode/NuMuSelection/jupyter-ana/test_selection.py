@@ -0,0 +1,73 @@
+import numpy as np
+import awkward as ak
+
+from conftest import make_events, notebook_layout
+from selection import *
+
+def test_make_events_empty_last_event():
+    # the tracks of each event are those of its slices, also when the
+    # last events have no slices
+    events = make_events(2000, 3)
+    assert events["nslc"][-1] == 0
+    assert np.array_equal(ak.num(events["slc.reco.trk.len"], axis=1),
+                          ak.sum(events["slc.reco.ntrk"], axis=1))
+
+def test_numu_cutflow(events):
+    data = notebook_layout(events)
+    add_ptrk_columns(data)
+    flow = CutFlow(data)
+    nslc = len(data["slc.vertex.x"])
+    masks = [flow.mask(name) for name in flow.names()]
+    for name, mask in zip(flow.names(), masks):
+        assert isinstance(mask, np.ndarray) and mask.dtype == bool and mask.shape == (nslc,), name
+    when = np.logical_and.accumulate(masks)
+    assert np.array_equal(flow.counts(), when.sum(axis=1))
+    assert flow.total() == nslc
+    assert 0 < flow.counts()[-1] < flow.counts()[0]
+    assert np.allclose(cutflow_efficiencies([flow, CutFlow(data, 2.)]), flow.efficiencies())
+
+def test_crt_vetoes(events):
+    data = notebook_layout(events)
+    # one event at a time
+    veto, trackveto, nobottom = [], [], []
+    for evt in range(len(data["nslc"])):
+        hits = np.asarray(data["crt_hits.time"][evt])
+        tracks = np.asarray(data["crt_tracks.time"][evt])
+        ya = np.asarray(data["crt_tracks.hita.position.y"][evt])
+        yb = np.asarray(data["crt_tracks.hitb.position.y"][evt])
+        inbeam = (tracks > 0.) & (tracks < 2.2)
+        veto.append(not np.any((hits > 0.) & (hits < 2.2)))
+        trackveto.append(not np.any(inbeam))
+        nobottom.append(not np.any(inbeam & (ya > -357.) & (yb > -357.)))
+    assert np.array_equal(crtveto(data), np.repeat(veto, data["nslc"]))
+    assert np.array_equal(crttrackveto(data), np.repeat(trackveto, data["nslc"]))
+    assert np.array_equal(crttrackveto_nobottom(data), np.repeat(nobottom, data["nslc"]))
+    assert crttrackveto_perevt(LazyData(data=data)).dtype == bool
+
+def test_ptrk_columns_lazy(events):
+    # the same "slc.ptrk.*" made on first use in a LazyData
+    data = notebook_layout(events)
+    add_ptrk_columns(data)
+    lazy = LazyData(lambda d, key: notebook_layout(events)[key])
+    add_ptrk_columns(lazy)
+    assert not any(k.startswith("slc.ptrk.") for k in lazy)
+    for k in ["slc.ptrk.recop", "slc.ptrk.crthit.distance", "slc.ptrk.atslc", "slc.has_ptrk"]:
+        assert np.array_equal(lazy[k], data[k], equal_nan=lazy[k].dtype != bool), k
+
+def test_true_primary_track(events):
+    data = notebook_layout(events)
+    visE = data["slc.reco.trk.truth.p.planeVisE"]
+    assert ak.any(visE == 0)
+    ret = get_true_primary_track(data)
+
+    # the first true muon with more than half of its visible energy, with the
+    # division of numpy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        match = (np.abs(data["slc.reco.trk.truth.p.pdg"]) == 13) & \
+            (data["slc.reco.trk.truth.bestmatch.energy"] / visE > 0.5)
+    first = ak.to_numpy(ak.fill_none(ak.argmax(match, axis=1), -1))
+    first[~ak.to_numpy(ak.any(match, axis=1))] = -1
+    is_numu_cc = (data["slc.truth.index"] >= 0) & data["slc.truth.iscc"] & (np.abs(data["slc.truth.pdg"]) == 14)
+    first[~is_numu_cc] = -1
+    assert np.array_equal(ret, first)
+    assert np.any(ret >= 0)